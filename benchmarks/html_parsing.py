@@ -0,0 +1,102 @@
+import argparse
+import glob
+import os
+import re
+import timeit
+from bs4 import BeautifulSoup
+from ppi.html_extraction import PARSER, extract_head, extract_links
+
+"""Micro-benchmark of the HTML extraction used by LibraryOfCongressCrawler.
+
+Compares the previous extraction (two full `html.parser` parses per item page with
+lambda filters, one full parse per search page) with the single-pass extraction in
+`ppi.html_extraction`, over the loc.gov pages under `tests/fixtures/loc`:
+
+    python -m benchmarks.html_parsing
+
+or over other pages saved from loc.gov, e.g.:
+
+    curl -o pages/search_1.html "https://www.loc.gov/pictures/search/?q=Cyanotypes.&sp=1"
+    curl -o pages/item_1.html "https://www.loc.gov/pictures/item/2004664403/"
+    python -m benchmarks.html_parsing pages
+"""
+
+
+LINKS_PATTERN = re.compile("^https://www.loc.gov/pictures/item/")
+
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "tests",
+    "fixtures",
+    "loc",
+)
+
+
+def legacy_item(html: str) -> None:
+    mediums = BeautifulSoup(html, "html.parser").find_all(
+        lambda tag: tag.name == "meta"
+        and tag.has_attr("name")
+        and tag["name"] in ["dc.format"]
+    )
+    ",".join([tag["name"] for tag in mediums])
+    BeautifulSoup(html, "html.parser").find_all(
+        lambda tag: tag.name == "link"
+        and tag.has_attr("type")
+        and tag["type"] == "image/tif"
+    )
+
+
+def legacy_search(html: str) -> None:
+    BeautifulSoup(html, "html.parser").find_all("a", attrs={"href": LINKS_PATTERN})
+
+
+def single_pass_item(html: str) -> None:
+    extract_head(html)
+
+
+def single_pass_search(html: str) -> None:
+    extract_links(html, LINKS_PATTERN)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of the LoC HTML extraction"
+    )
+    parser.add_argument(
+        "fixtures",
+        nargs="?",
+        default=FIXTURES_DIR,
+        help="Directory with saved search_*.html and item_*.html pages "
+        "(default: tests/fixtures/loc)",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions")
+    args = parser.parse_args()
+    print(f"Single-pass backend: {PARSER}")
+    for kind, legacy, single_pass in [
+        ("item", legacy_item, single_pass_item),
+        ("search", legacy_search, single_pass_search),
+    ]:
+        pages = []
+        for path in sorted(glob.glob(os.path.join(args.fixtures, f"{kind}_*.html"))):
+            with open(path, encoding="utf-8") as file:
+                pages.append(file.read())
+        if not pages:
+            continue
+        timings = {}
+        for name, function in [("legacy", legacy), ("single-pass", single_pass)]:
+            timings[name] = min(
+                timeit.repeat(
+                    lambda: [function(page) for page in pages],
+                    number=1,
+                    repeat=args.repeat,
+                )
+            ) / len(pages)
+        print(
+            f"{kind} pages ({len(pages)}): legacy {timings['legacy'] * 1000:.2f} ms/page, "
+            f"single-pass {timings['single-pass'] * 1000:.2f} ms/page, "
+            f"speedup {timings['legacy'] / timings['single-pass']:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+from typing import List, Union
+import yaml
+from loguru import logger
+from ppi.database import Database
+from ppi.image_store import ImageStore
+
+"""Command line interface of ppi, e.g. `python -m ppi classify MODEL`"""
+
+
+def classify(args: argparse.Namespace, config: dict, database: Database) -> None:
+    """Classifies a directory, or the images in the database, with a saved model."""
+    # Imported here so that TensorFlow is only loaded by the commands using it
+    from ppi.classify import ImageClassifier, read_labels
+
+    classify_config = config.setdefault("classify", {})
+    for key in ["batch_size", "top_k", "tiles", "tile_threshold"]:
+        if getattr(args, key) is not None:
+            classify_config[key] = getattr(args, key)
+    classifier = ImageClassifier(
+        config,
+        database,
+        args.model,
+        model_name=args.name,
+        labels=read_labels(args.labels) if args.labels else None,
+    )
+    if args.directory:
+        classifier.classify_directory(args.directory, args.limit, args.workers)
+    else:
+        classifier.classify_images(args.limit, args.workers)
+
+
+def export_model(args: argparse.Namespace, config: dict, database: Database) -> None:
+    """Exports quantized variants of a TensorFlow.js model and reports their cost."""
+    from ppi.classify import read_labels
+    from ppi.model_export import ModelExporter
+
+    ModelExporter(config, database).run(
+        args.tfjs_model,
+        args.model,
+        args.output,
+        labels=read_labels(args.labels) if args.labels else None,
+        limit=args.limit,
+    )
+
+
+def import_store(args: argparse.Namespace, config: dict, database: Database) -> None:
+    """Adds the images downloaded before the image store existed to the store."""
+    image_store = ImageStore(config, database)
+    logger.info(f"Imported {image_store.import_downloads()} downloaded images")
+    if not args.no_backup:
+        logger.info(f"Back up completed, {image_store.backup()} new images")
+
+
+def main(argv: Union[List[str], None] = None) -> None:
+    """Parses the command line and runs the requested command.
+
+    Args:
+        argv: The command line arguments. Defaults to `sys.argv`.
+
+    Returns:
+        None.
+    """
+    parser = argparse.ArgumentParser(prog="python -m ppi")
+    parser.add_argument("--config", default="config.yaml", help="configuration file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    classify_parser = commands.add_parser(
+        "classify",
+        help="record the top-k predictions of a saved model in the predictions table",
+    )
+    classify_parser.add_argument("model", help="saved model file or directory")
+    classify_parser.add_argument(
+        "--directory",
+        help="classify the images of this directory instead of the downloaded images",
+    )
+    classify_parser.add_argument(
+        "--name", help="name recorded with the predictions (default: model name)"
+    )
+    classify_parser.add_argument(
+        "--labels",
+        help="file with one label per line, in the order of the model outputs "
+        "(default: sorted allowed_processes)",
+    )
+    classify_parser.add_argument("--top-k", type=int)
+    classify_parser.add_argument("--batch-size", type=int)
+    classify_parser.add_argument(
+        "--tiles",
+        help="score a grid of tiles per image and aggregate them: mean, max or entropy",
+    )
+    classify_parser.add_argument(
+        "--tile-threshold",
+        type=float,
+        help="center tile probability above which the other tiles are skipped",
+    )
+    classify_parser.add_argument(
+        "--workers", type=int, help="preprocessing processes (default: CPUs)"
+    )
+    classify_parser.add_argument(
+        "--limit", type=int, help="classify at most this many images"
+    )
+    classify_parser.set_defaults(function=classify)
+
+    export_parser = commands.add_parser(
+        "export-model",
+        help="write float16 and uint8 variants of a TensorFlow.js model, with a report",
+    )
+    export_parser.add_argument(
+        "tfjs_model", help="TensorFlow.js model directory, e.g. docs/multiclass/model"
+    )
+    export_parser.add_argument(
+        "--model",
+        help="saved model it was converted from, to measure accuracy and latency",
+    )
+    export_parser.add_argument(
+        "--output", help="output directory (default: dir.model_export/<app>)"
+    )
+    export_parser.add_argument(
+        "--labels",
+        help="file with the medium of each model output, one per line "
+        "(default: sorted allowed_processes)",
+    )
+    export_parser.add_argument(
+        "--limit", type=int, help="evaluate on at most this many validation images"
+    )
+    export_parser.set_defaults(function=export_model)
+
+    import_parser = commands.add_parser(
+        "import-store",
+        help="add the images downloaded before the image store existed to the store",
+    )
+    import_parser.add_argument(
+        "--no-backup", action="store_true", help="do not back up the imported images"
+    )
+    import_parser.set_defaults(function=import_store)
+
+    args = parser.parse_args(argv)
+    with open(args.config, "r") as yamlfile:
+        config = yaml.load(yamlfile, Loader=yaml.FullLoader)
+    database = Database(db_name=config["db_name"], pragmas=config["db_pragmas"])
+    try:
+        args.function(args, config, database)
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
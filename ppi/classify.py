@@ -0,0 +1,407 @@
+import datetime as dt
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from loguru import logger
+from PIL import Image
+from ppi.database import Database
+from ppi.preprocessing import bounded_map, load_model_input
+
+"""Class for classifying collections of images offline with a saved model"""
+
+
+DEFAULT_CLASSIFY_CONFIG: Dict[str, Any] = {
+    "image_size": 1000,
+    "crop_size": 400,
+    "top_k": 3,
+    "batch_size": 32,
+    "workers": None,
+    "log_interval": 10,
+    "tiles": None,
+    "tile_threshold": 0.9,
+}
+
+# The source recorded for the images of a directory, whose IDs are their absolute paths
+DIRECTORY_SOURCE = "file"
+
+# Methods aggregating the probabilities of the tiles of an image, see `aggregate`
+AGGREGATIONS = ("mean", "max", "entropy")
+
+
+def load_keras_model(path: str) -> keras.layers.Layer:
+    """Loads a saved model as a Keras model or layer.
+
+    Supports `.keras` and `.h5` files, and the SavedModel directories written by
+    `model.save(...)` in the notebooks, which Keras 3 can only load for inference.
+
+    Args:
+        path: The path of the model.
+
+    Returns:
+        The model, whose `weights` can be read and assigned.
+    """
+    if os.path.isdir(path):
+        return keras.layers.TFSMLayer(path, call_endpoint="serving_default")
+    return keras.models.load_model(path, compile=False)
+
+
+def model_predictor(model: keras.layers.Layer) -> Callable[[np.ndarray], np.ndarray]:
+    """Wraps a Keras model or layer into a function from a batch of crops to probabilities.
+
+    Args:
+        model: The model, see `load_keras_model`.
+
+    Returns:
+        A function mapping a float32 batch of shape (n, height, width, 3), with values in
+        [0, 255], to the probabilities of shape (n, classes).
+    """
+
+    def predict(batch: np.ndarray) -> np.ndarray:
+        with tf.device("/CPU:0"):
+            outputs = model(tf.constant(batch), training=False)
+        if isinstance(outputs, dict):
+            outputs = next(iter(outputs.values()))
+        return np.asarray(outputs)
+
+    return predict
+
+
+def load_model(path: str) -> Callable[[np.ndarray], np.ndarray]:
+    """Loads a saved model as a function from a batch of crops to class probabilities.
+
+    Args:
+        path: The path of the model, see `load_keras_model`.
+
+    Returns:
+        The function computing the probabilities of a batch, see `model_predictor`.
+    """
+    return model_predictor(load_keras_model(path))
+
+
+def aggregate(probabilities: np.ndarray, method: str) -> np.ndarray:
+    """Aggregates the class probabilities of the tiles of an image.
+
+    Args:
+        probabilities: The probabilities of each tile, of shape (tiles, classes).
+        method: `mean` averages the tiles, `max` takes the highest probability of each
+            class over the tiles, and `entropy` averages the tiles weighted by their
+            confidence, one minus their normalized entropy.
+
+    Returns:
+        The probabilities of the image, of shape (classes,), summing to one.
+    """
+    if method == "mean":
+        return probabilities.mean(axis=0)
+    if method == "max":
+        maxima = probabilities.max(axis=0)
+        return maxima / maxima.sum()
+    if method == "entropy":
+        clipped = np.clip(probabilities, 1e-12, 1)
+        entropy = -(clipped * np.log(clipped)).sum(axis=1)
+        weights = 1 - entropy / np.log(probabilities.shape[1])
+        if weights.sum() <= 0:
+            return probabilities.mean(axis=0)
+        return weights @ probabilities / weights.sum()
+    raise ValueError(f"Unknown aggregation {method}, expected one of {AGGREGATIONS}")
+
+
+def read_labels(path: str) -> List[str]:
+    """Reads class labels, one per line, e.g. the `class_names.txt` of the web apps.
+
+    Args:
+        path: The path of the labels file.
+
+    Returns:
+        The labels, in the order of the model outputs.
+    """
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+class ImageClassifier:
+    """Classifies the images of a directory or of the database with a saved model.
+
+    Images are decoded and preprocessed as in the notebooks (centered square, resized to
+    `image_size`, center crop of `crop_size`) in worker processes, which run ahead of
+    inference by a bounded number of images, while the model scores batches on CPU. The
+    top-k labels and probabilities of each image are recorded in the `predictions`
+    table under the name of the model, and images that already have predictions of the
+    model are skipped.
+
+    With `tiles` set to an aggregation method (see `aggregate`), the whole image is
+    resized so that its shorter side is `image_size` and cut into a grid of tiles (see
+    `load_tiles`). The center tiles of a batch of images are scored first, and the
+    other tiles of an image are only scored, as one batch, if the probability of its
+    center tile is below `tile_threshold`. The prediction of the image aggregates all
+    its tiles. Confident images thus cost one tile, and only ambiguous ones pay for the
+    whole grid.
+
+    Attributes:
+        config: The configuration data.
+        database: The database to record the predictions in.
+        classify_config: The `classify` section of the configuration, with defaults.
+        model_name: The name the predictions are recorded under.
+        labels: The class labels, in the order of the model outputs.
+        predict: The function computing the probabilities of a batch, see `load_model`.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        database: Database,
+        model_path: str,
+        model_name: Union[str, None] = None,
+        labels: Union[List[str], None] = None,
+        predict: Union[Callable[[np.ndarray], np.ndarray], None] = None,
+    ) -> None:
+        """Initializes the classifier and loads the model.
+
+        Args:
+            config: The configuration data.
+            database: The database to record the predictions in.
+            model_path: The path of the saved model.
+            model_name: The name the predictions are recorded under. Defaults to the
+                file or directory name of the model, followed by `:tiles-<method>` when
+                tiling.
+            labels: The class labels, in the order of the model outputs. Defaults to the
+                sorted `allowed_processes`, the order `image_dataset_from_directory`
+                gives the classes of the notebooks.
+            predict: The function computing the probabilities of a batch. Defaults to
+                the loaded model.
+        """
+        self.config = config
+        self.database = database
+        self.classify_config = {
+            **DEFAULT_CLASSIFY_CONFIG,
+            **config.get("classify", {}),
+        }
+        tiles = self.classify_config["tiles"]
+        if tiles is not None and tiles not in AGGREGATIONS:
+            raise ValueError(
+                f"Unknown aggregation {tiles}, expected one of {AGGREGATIONS}"
+            )
+        self.model_name = model_name or os.path.basename(os.path.normpath(model_path))
+        if model_name is None and tiles is not None:
+            self.model_name += f":tiles-{tiles}"
+        self.labels = labels or sorted(config["allowed_processes"])
+        self.predict = predict or load_model(model_path)
+
+    def _predict_batches(self, crops: np.ndarray) -> np.ndarray:
+        """Runs the model over crops, `batch_size` crops at a time.
+
+        Args:
+            crops: The crops, of shape (n, height, width, 3).
+
+        Returns:
+            The probabilities of the crops, of shape (n, classes).
+        """
+        batch_size = self.classify_config["batch_size"]
+        probabilities = np.concatenate(
+            [
+                self.predict(crops[i : i + batch_size])
+                for i in range(0, len(crops), batch_size)
+            ]
+        )
+        if probabilities.shape[-1] != len(self.labels):
+            raise ValueError(
+                f"The model has {probabilities.shape[-1]} outputs but {len(self.labels)} labels were given"
+            )
+        return probabilities
+
+    def _score(self, keys: List[Tuple[str, str]], crops: List[np.ndarray]) -> int:
+        """Scores a batch of images and records their top-k predictions.
+
+        Args:
+            keys: The source and ID of each image.
+            crops: The crops of each image, center crop first, see `load_model_input`.
+
+        Returns:
+            The number of crops scored.
+        """
+        probabilities = self._predict_batches(np.stack([crop[0] for crop in crops]))
+        threshold = self.classify_config["tile_threshold"]
+        uncertain = [
+            i
+            for i, image_crops in enumerate(crops)
+            if len(image_crops) > 1
+            and (threshold is None or probabilities[i].max() < threshold)
+        ]
+        scored = len(crops)
+        if uncertain:
+            tiles = self._predict_batches(
+                np.concatenate([crops[i][1:] for i in uncertain])
+            )
+            first = 0
+            for i in uncertain:
+                count = len(crops[i]) - 1
+                probabilities[i] = aggregate(
+                    np.concatenate(
+                        [probabilities[i : i + 1], tiles[first : first + count]]
+                    ),
+                    self.classify_config["tiles"],
+                )
+                first += count
+            scored += len(tiles)
+        top_k = min(self.classify_config["top_k"], len(self.labels))
+        ranking = np.argsort(-probabilities, axis=1, kind="stable")[:, :top_k]
+        date = dt.datetime.now().isoformat()
+        self.database.save_predictions(
+            [
+                {
+                    "source": source,
+                    "id": id,
+                    "model": self.model_name,
+                    "rank": rank + 1,
+                    "label": self.labels[label],
+                    "probability": float(probabilities[i, label]),
+                    "date": date,
+                }
+                for i, (source, id) in enumerate(keys)
+                for rank, label in enumerate(ranking[i])
+            ]
+        )
+        return scored
+
+    def _classify(
+        self,
+        items: Iterable[Tuple[str, str, str]],
+        limit: Union[int, None] = None,
+        workers: Union[int, None] = None,
+    ) -> int:
+        """Classifies images through the prefetching, batched pipeline.
+
+        Args:
+            items: The source, ID and path of each image to classify.
+            limit: The maximum number of images to classify.
+            workers: The number of preprocessing processes. Defaults to `workers` in the
+                `classify` configuration, or the number of CPUs.
+
+        Returns:
+            The number of images classified.
+        """
+        workers = workers or self.classify_config["workers"] or os.cpu_count() or 1
+        batch_size = self.classify_config["batch_size"]
+        load = partial(
+            load_model_input,
+            image_size=self.classify_config["image_size"],
+            crop_size=self.classify_config["crop_size"],
+            tiles=self.classify_config["tiles"] is not None,
+        )
+        keys: List[Tuple[str, str]] = []
+        crops: List[np.ndarray] = []
+        classified = scored = 0
+        start = last_log = time.perf_counter()
+        # Spawned workers only import the preprocessing, not TensorFlow
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            inputs = bounded_map(
+                executor,
+                load,
+                itertools.islice(items, limit),
+                batch_size + 2 * workers,
+            )
+            for source, id, image_crops, error in inputs:
+                if error is not None:
+                    logger.error(f"Could not preprocess image {source}_{id}: {error}")
+                    continue
+                keys.append((source, id))
+                crops.append(image_crops)
+                if len(keys) == batch_size:
+                    scored += self._score(keys, crops)
+                    classified += len(keys)
+                    keys, crops = [], []
+                    if (
+                        time.perf_counter() - last_log
+                        >= self.classify_config["log_interval"]
+                    ):
+                        last_log = time.perf_counter()
+                        logger.info(
+                            f"Classified {classified} images ({classified / (last_log - start):.1f} images/s)"
+                        )
+            if keys:
+                scored += self._score(keys, crops)
+                classified += len(keys)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Classified {classified} images in {elapsed:.1f}s ({classified / elapsed if elapsed else 0:.1f} images/s, {scored / classified if classified else 0:.1f} crops/image)"
+        )
+        return classified
+
+    def _iter_unscored_images(
+        self, batch_size: int = 1000
+    ) -> Iterator[Tuple[str, str, str]]:
+        """Yields the stored images without predictions of the model.
+
+        Args:
+            batch_size: The number of images claimed from the database at once.
+
+        Returns:
+            An iterator over the source, ID and path of each image.
+        """
+        cursor = 0
+        while True:
+            batch = self.database.claim_unscored_images(
+                self.model_name, batch_size, cursor
+            )
+            if not batch:
+                break
+            cursor = batch[-1][0]
+            for _, source, id, file_path in batch:
+                yield source, id, file_path
+
+    def classify_images(
+        self, limit: Union[int, None] = None, workers: Union[int, None] = None
+    ) -> int:
+        """Classifies the downloaded images in the database without predictions of the model.
+
+        Args:
+            limit: The maximum number of images to classify.
+            workers: The number of preprocessing processes.
+
+        Returns:
+            The number of images classified.
+        """
+        return self._classify(self._iter_unscored_images(), limit, workers)
+
+    def classify_directory(
+        self,
+        directory: str,
+        limit: Union[int, None] = None,
+        workers: Union[int, None] = None,
+    ) -> int:
+        """Classifies the images in a directory tree without predictions of the model.
+
+        Predictions are recorded with source `file` and the absolute path of each image
+        as its ID.
+
+        Args:
+            directory: The directory to classify the images of, recursively.
+            limit: The maximum number of images to classify.
+            workers: The number of preprocessing processes.
+
+        Returns:
+            The number of images classified.
+        """
+        extensions = set(Image.registered_extensions())
+        scored = self.database.get_scored_ids(self.model_name, DIRECTORY_SOURCE)
+
+        def iter_files() -> Iterator[Tuple[str, str, str]]:
+            for root, dirs, files in os.walk(os.path.abspath(directory)):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    if (
+                        os.path.splitext(name)[1].lower() in extensions
+                        and path not in scored
+                    ):
+                        yield DIRECTORY_SOURCE, path, path
+
+        return self._classify(iter_files(), limit, workers)
@@ -1,15 +1,120 @@
-from sqlalchemy import create_engine, text, inspect
-from sqlalchemy.engine.result import Result
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine, Row
+from sqlalchemy.pool import QueuePool
 import pandas as pd
 import datetime as dt
+import atexit
+import functools
+import threading
+import time
+import weakref
 from enum import Enum
-from typing import List, Tuple
-from typing import Union, Literal
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Set, Tuple
+from typing import Optional, Union, Literal, TYPE_CHECKING
 from loguru import logger
 
+if TYPE_CHECKING:
+    from ppi.processed_url_index import ProcessedUrlIndex
+
 """Classes for interacting with SQLite Database"""
 
 
+# Ordered schema migrations. The position of a migration in this list is the
+# schema version it upgrades to, and the version reached is stored in SQLite's
+# `user_version` pragma. Tables use `if not exists` so that databases created
+# by earlier versions (through `pandas.to_sql`) are migrated in place.
+MIGRATIONS: List[List[str]] = [
+    # 1: explicit tables for the log, image metadata and mapped mediums
+    [
+        "create table if not exists log (source TEXT, action TEXT, status TEXT, url TEXT, date TEXT)",
+        "create index if not exists ix_log_action_url on log (action, url)",
+        "create table if not exists images (source TEXT, id TEXT, url TEXT, medium TEXT)",
+        "create index if not exists ix_images_source_id on images (source, id)",
+        "create index if not exists ix_images_url on images (url)",
+        "create index if not exists ix_images_medium on images (medium)",
+        "create table if not exists mediums (source TEXT, id TEXT, new_medium TEXT)",
+        "create index if not exists ix_mediums_id on mediums (id)",
+        "create index if not exists ix_mediums_new_medium on mediums (new_medium)",
+    ],
+    # 2: download status on images, backfilled from the download log
+    [
+        "alter table images add column download_status TEXT",
+        "update images set download_status = (select log.status from log where log.action = 'download' and log.url = images.url order by log.rowid desc limit 1)",
+        "create index if not exists ix_images_download_status on images (download_status)",
+    ],
+    # 3: size variants of images (derivatives and IIIF image services)
+    [
+        "create table if not exists image_variants (source TEXT, id TEXT, url TEXT, kind TEXT, mimetype TEXT, width INTEGER, height INTEGER)",
+        "create index if not exists ix_image_variants_source_id on image_variants (source, id)",
+    ],
+    # 4: content-addressed image store, the files of each image and their backups
+    [
+        "create table if not exists blobs (sha256 TEXT PRIMARY KEY, size INTEGER, path TEXT)",
+        "alter table images add column sha256 TEXT",
+        "alter table images add column file_path TEXT",
+        "alter table images add column backup_path TEXT",
+        "create index if not exists ix_images_sha256 on images (sha256)",
+        "create index if not exists ix_images_pending_backup on images (sha256) where file_path is not null and backup_path is null",
+    ],
+    # 5: resized training images derived from the stored files
+    [
+        "create table if not exists derivatives (source TEXT, id TEXT, source_sha256 TEXT, path TEXT, width INTEGER, height INTEGER, sha256 TEXT, thumbnail_path TEXT)",
+        "create unique index if not exists ix_derivatives_source_id on derivatives (source, id)",
+    ],
+    # 6: perceptual hashes of images (as signed 64-bit integers) and their duplicate clusters
+    [
+        "create table if not exists image_hashes (source TEXT, id TEXT, phash INTEGER, dhash INTEGER, cluster TEXT)",
+        "create unique index if not exists ix_image_hashes_source_id on image_hashes (source, id)",
+        "create index if not exists ix_image_hashes_cluster on image_hashes (cluster)",
+    ],
+    # 7: incremental medium mapping: one mapped medium per image, the mapping of each
+    # source medium, and a key-value table for watermarks
+    [
+        "delete from mediums where rowid not in (select max(rowid) from mediums group by source, id)",
+        "create unique index if not exists ix_mediums_source_id on mediums (source, id)",
+        "create table if not exists medium_mappings (old_medium TEXT PRIMARY KEY, new_medium TEXT, pending INTEGER)",
+        "create table if not exists meta (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    # 8: rows of the backbone features of each crop of an image in the feature store
+    [
+        "create table if not exists features (source TEXT, id TEXT, crop TEXT, row INTEGER, sha256 TEXT)",
+        "create unique index if not exists ix_features_source_id_crop on features (source, id, crop)",
+    ],
+    # 9: top-k predictions of a model for each image
+    [
+        "create table if not exists predictions (source TEXT, id TEXT, model TEXT, rank INTEGER, label TEXT, probability REAL, date TEXT)",
+        "create unique index if not exists ix_predictions_model_source_id_rank on predictions (model, source, id, rank)",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Tables owned by the schema above. They are never dropped, so their indexes survive.
+MANAGED_TABLES = (
+    "log",
+    "images",
+    "mediums",
+    "image_variants",
+    "blobs",
+    "derivatives",
+    "image_hashes",
+    "medium_mappings",
+    "meta",
+    "features",
+    "predictions",
+)
+
+# Pragmas set on every new connection. WAL lets readers (e.g. a stats dashboard) run
+# while the crawler is writing, and synchronous=NORMAL is durable enough under WAL.
+DEFAULT_PRAGMAS: Dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "busy_timeout": 5000,
+}
+
+
 class DBAction(Enum):
     """An enumeration of all actions recorded on the database."""
 
@@ -23,6 +128,185 @@ class DBActionStatus(Enum):
 
     SUCCESS = "SUCCESS"
     FAILURE = "FAILURE"
+    DUPLICATE = "DUPLICATE"
+
+
+class LogWriter:
+    """Buffers log entries and writes them to the database in batches.
+
+    Entries are kept as plain tuples and flushed with a single `executemany` inside one
+    transaction, once `flush_every` entries are buffered or, from a timer thread,
+    `flush_interval` seconds after the first entry was buffered, so entries are written
+    even when no further entry follows. Download entries also take their image off the
+    download queue in the same transaction. `close` should be called on shutdown; it is
+    also called when the writer is garbage collected, or at exit if it is still open.
+
+    Attributes:
+        engine: A SQLAlchemy engine.
+        flush_every: The number of buffered entries that triggers a flush.
+        flush_interval: The number of seconds after which buffered entries are flushed.
+    """
+
+    def __init__(
+        self, engine: Engine, flush_every: int = 500, flush_interval: float = 5.0
+    ) -> None:
+        """Initializes an empty log buffer.
+
+        Args:
+            engine: A SQLAlchemy engine.
+            flush_every: The number of buffered entries that triggers a flush.
+            flush_interval: The number of seconds after which buffered entries are flushed.
+        """
+        self.engine = engine
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._buffer: List[Tuple[str, str, str, str, str]] = []
+        self._pending: Set[Tuple[str, str]] = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._timer: Union[threading.Timer, None] = None
+        self._closed = False
+        # Like the timer, the exit hook only holds a weak reference to the writer
+        self._exit_hook = functools.partial(self._close_at_exit, weakref.ref(self))
+        atexit.register(self._exit_hook)
+
+    def write(
+        self, source: str, action: DBAction, status: DBActionStatus, url: str
+    ) -> None:
+        """Buffers a log entry, flushing the buffer if it is full or old enough.
+
+        Args:
+            source: The source of the log entry.
+            action: The action that was performed.
+            status: The status of the action.
+            url: The URL that the action was performed on.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            self._buffer.append(
+                (
+                    source,
+                    action.value,
+                    status.value,
+                    url,
+                    dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+                )
+            )
+            self._pending.add((action.value, url))
+            if (
+                len(self._buffer) >= self.flush_every
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self.flush()
+            elif self._timer is None and not self._closed:
+                # The timer only holds a weak reference, so that it does not keep an
+                # abandoned writer alive until it fires
+                self._timer = threading.Timer(
+                    self.flush_interval, self._flush_on_timer, [weakref.ref(self)]
+                )
+                self._timer.daemon = True
+                self._timer.start()
+
+    @staticmethod
+    def _flush_on_timer(writer_ref: "weakref.ref[LogWriter]") -> None:
+        """Flushes the buffer from the timer thread, logging errors instead of raising them.
+
+        Args:
+            writer_ref: A weak reference to the log writer.
+
+        Returns:
+            None.
+        """
+        writer = writer_ref()
+        if writer is None:
+            return
+        try:
+            writer.flush()
+        except Exception as e:
+            logger.error(
+                f"An exception of type {type(e).__name__} occurred: {str(e)} while flushing the log."
+            )
+
+    @staticmethod
+    def _close_at_exit(writer_ref: "weakref.ref[LogWriter]") -> None:
+        """Closes the writer at exit, if it is still alive.
+
+        Args:
+            writer_ref: A weak reference to the log writer.
+
+        Returns:
+            None.
+        """
+        writer = writer_ref()
+        if writer is not None:
+            writer.close()
+
+    def contains(self, action: DBAction, url: str) -> bool:
+        """Checks whether a not yet flushed entry exists for the given action and URL.
+
+        Args:
+            action: The action to check for.
+            url: The URL to check for.
+
+        Returns:
+            True if an entry is buffered for the given action and URL, False otherwise.
+        """
+        with self._lock:
+            return (action.value, url) in self._pending
+
+    def flush(self) -> None:
+        """Writes all buffered entries to the database in one transaction.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+            downloads = [
+                (entry[2], entry[3])
+                for entry in self._buffer
+                if entry[1] == DBAction.DOWNLOAD.value
+            ]
+            with self.engine.begin() as connection:
+                connection.exec_driver_sql(
+                    "insert into log (source, action, status, url, date) values (?, ?, ?, ?, ?)",
+                    self._buffer,
+                )
+                if downloads:
+                    connection.exec_driver_sql(
+                        "update images set download_status = ? where url = ?",
+                        downloads,
+                    )
+            self._buffer = []
+            self._pending = set()
+
+    def close(self) -> None:
+        """Flushes all buffered entries and stops the timer.
+
+        Entries written afterwards are flushed when the buffer is full, or by the next
+        `flush` or `close`.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            self._closed = True
+            self.flush()
+        atexit.unregister(self._exit_hook)
+
+    def __del__(self) -> None:
+        """Flushes all buffered entries when the writer is garbage collected."""
+        try:
+            self.close()
+        except Exception:
+            pass  # The database may already be gone at interpreter shutdown
 
 
 class Database:
@@ -30,40 +314,180 @@ class Database:
 
     Attributes:
         engine: A SQLAlchemy engine.
+        pragmas: The SQLite pragmas set on each connection.
+        log_writer: The buffered writer for log entries.
+        url_indexes: The in-memory URL indexes kept in sync with the log.
     """
 
-    def __init__(self, db_name: str) -> None:
-        """Initializes a new SQLite engine.
+    def __init__(
+        self,
+        db_name: str,
+        pragmas: Optional[Dict[str, Any]] = None,
+        pool_size: int = 5,
+        log_flush_every: int = 500,
+        log_flush_interval: float = 5.0,
+    ) -> None:
+        """Initializes a new SQLite engine and brings the schema up to date.
+
+        Connections are kept open in a pool and configured with the given pragmas when
+        they are first opened.
 
         Args:
             db_name: The name of the database file.
+            pragmas: The SQLite pragmas to set on each connection. Defaults to `DEFAULT_PRAGMAS`.
+            pool_size: The number of connections kept open.
+            log_flush_every: The number of buffered log entries that triggers a flush.
+            log_flush_interval: The number of seconds after which buffered log entries are flushed.
+
+        Returns:
+            None.
+        """
+        self.engine = create_engine(
+            "sqlite:///" + db_name,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            connect_args={"check_same_thread": False},
+        )
+        self.pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+        event.listen(self.engine, "connect", self._set_pragmas)
+        self._migrate()
+        self.log_writer = LogWriter(
+            self.engine, flush_every=log_flush_every, flush_interval=log_flush_interval
+        )
+        self.url_indexes: List["ProcessedUrlIndex"] = []
+
+    def close(self) -> None:
+        """Flushes buffered log entries and releases all connections.
+
+        Returns:
+            None.
+        """
+        self.log_writer.close()
+        self.engine.dispose()
+
+    def _set_pragmas(self, dbapi_connection, connection_record) -> None:
+        """Sets the configured pragmas on a newly opened SQLite connection.
+
+        Args:
+            dbapi_connection: The DBAPI connection that was opened.
+            connection_record: The pool record of the connection.
+
+        Returns:
+            None.
+        """
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.pragmas.items():
+                cursor.execute(f"pragma {name} = {value}")
+        finally:
+            cursor.close()
+
+    def _migrate(self) -> None:
+        """Applies all schema migrations newer than the version stored in the database.
 
         Returns:
             None.
         """
-        self.engine = create_engine("sqlite:///" + db_name)
+        with self.engine.begin() as connection:
+            version = connection.exec_driver_sql("pragma user_version").scalar() or 0
+            for target_version in range(version + 1, SCHEMA_VERSION + 1):
+                logger.info(f"Migrating database schema to version {target_version}")
+                for statement in MIGRATIONS[target_version - 1]:
+                    connection.exec_driver_sql(statement)
+                connection.exec_driver_sql(f"pragma user_version = {target_version}")
 
-    def _execute_query(self, query: str) -> Result:
-        """Executes a SQL query.
+    def _execute_query(
+        self, query: str, params: Optional[Dict] = None
+    ) -> Sequence[Row]:
+        """Executes a SQL query on a pooled connection.
 
         Args:
-            query: The SQL query to execute.
-            params: A dictionary of parameters to pass to the query.
+            query: The SQL query to execute, with `:name` placeholders for its parameters.
+            params: A dictionary of parameters to bind to the query.
 
         Returns:
-            The results of the query, or `False` if there is an OperationalError.
+            The rows returned by the query.
         """
-        connection = self.engine.connect()
         try:
-            result = connection.execute(text(query))
-            return result
+            with self.engine.connect() as connection:
+                return connection.execute(text(query), params or {}).fetchall()
         except Exception as e:
             logger.error(
                 f"An exception {str(e)} of type {type(e).__name__} occurred while executing query {query}."
             )
             raise e
-        finally:
-            connection.close()
+
+    def _iter_query(
+        self, query: str, params: Optional[Dict] = None, chunk_size: int = 10000
+    ) -> Iterator[Sequence[Row]]:
+        """Executes a SQL query and yields its rows in chunks.
+
+        The connection is held until the iteration finishes, and SQLite steps the cursor
+        lazily, so memory use is bounded by the chunk size instead of the result size.
+
+        Args:
+            query: The SQL query to execute, with `:name` placeholders for its parameters.
+            params: A dictionary of parameters to bind to the query.
+            chunk_size: The maximum number of rows per chunk.
+
+        Returns:
+            An iterator over chunks of rows returned by the query.
+        """
+        with self.engine.connect() as connection:
+            result = connection.execute(text(query), params or {})
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def iter_table_chunks(
+        self,
+        table: str,
+        columns: Union[List[str], None] = None,
+        chunk_size: int = 10000,
+    ) -> Iterator[pd.DataFrame]:
+        """Yields the rows of a table as Pandas DataFrames of bounded size.
+
+        Args:
+            table: The name of the table to read.
+            columns: The columns to read. Defaults to all columns.
+            chunk_size: The maximum number of rows per DataFrame.
+
+        Returns:
+            An iterator over DataFrames with the given columns.
+        """
+        if columns is None:
+            columns = [
+                row[1] for row in self._execute_query(f"pragma table_info({table})")
+            ]
+        query = f"select {', '.join(columns)} FROM {table} order by rowid"
+        for rows in self._iter_query(query, chunk_size=chunk_size):
+            yield pd.DataFrame([tuple(row) for row in rows], columns=columns)
+
+    def export_table(
+        self,
+        table: str,
+        path: str,
+        columns: Union[List[str], None] = None,
+        chunk_size: int = 10000,
+    ) -> None:
+        """Exports a table to a CSV file, one chunk at a time.
+
+        Args:
+            table: The name of the table to export.
+            path: The path of the CSV file to write.
+            columns: The columns to export. Defaults to all columns.
+            chunk_size: The maximum number of rows held in memory at once.
+
+        Returns:
+            None.
+        """
+        header = True
+        with open(path, "w", newline="") as file:
+            for chunk in self.iter_table_chunks(table, columns, chunk_size):
+                chunk.to_csv(file, header=header, index=False)
+                header = False
 
     def save_data(
         self,
@@ -85,13 +509,110 @@ class Database:
         Returns:
             None.
         """
-        data.to_sql(table, con=self.engine, if_exists=if_exists, index=False)
+        if table in MANAGED_TABLES and if_exists == "replace":
+            # Keep the managed table (and its indexes) and only replace its rows
+            with self.engine.begin() as connection:
+                connection.execute(text(f"delete from {table}"))
+                data.to_sql(table, con=connection, if_exists="append", index=False)
+        else:
+            data.to_sql(table, con=self.engine, if_exists=if_exists, index=False)
+
+    def replace_image_metadata(
+        self, images: pd.DataFrame, variants: Union[pd.DataFrame, None] = None
+    ) -> None:
+        """Stores re-parsed image metadata, replacing the metadata stored for the same images.
+
+        Images already stored are updated in place, so that their download state is kept,
+        and their variants are replaced. Images whose medium changed are remapped at once
+        if the new medium has a mapping; otherwise their stale mapping is dropped, and
+        `map_mediums` maps them once the new mapping is recorded, as it is pending.
+
+        Args:
+            images: A Pandas DataFrame with the `source`, `id`, `url` and `medium` of each image.
+            variants: A Pandas DataFrame with the variants of the images, with the columns
+                of the `image_variants` table.
+
+        Returns:
+            None.
+        """
+        with self.engine.begin() as connection:
+            for image in images.to_dict(orient="records"):
+                old_mediums = connection.execute(
+                    text(
+                        "select medium FROM images where source = :source and id = :id"
+                    ),
+                    image,
+                ).fetchall()
+                updated = connection.execute(
+                    text(
+                        "update images set url = :url, medium = :medium "
+                        "where source = :source and id = :id"
+                    ),
+                    image,
+                ).rowcount
+                if updated and any(row[0] != image["medium"] for row in old_mediums):
+                    connection.execute(
+                        text("delete from mediums where source = :source and id = :id"),
+                        image,
+                    )
+                    connection.execute(
+                        text(
+                            "insert into mediums (source, id, new_medium) "
+                            "select img.source, img.id, mm.new_medium FROM images as img "
+                            "inner join medium_mappings as mm on mm.old_medium = img.medium "
+                            "where img.source = :source and img.id = :id "
+                            "on conflict (source, id) do update set new_medium = excluded.new_medium"
+                        ),
+                        image,
+                    )
+                if not updated:
+                    pd.DataFrame([image]).to_sql(
+                        "images", con=connection, if_exists="append", index=False
+                    )
+                connection.execute(
+                    text(
+                        "delete from image_variants where source = :source and id = :id"
+                    ),
+                    image,
+                )
+            if variants is not None and len(variants) > 0:
+                variants.to_sql(
+                    "image_variants", con=connection, if_exists="append", index=False
+                )
+
+    def save_data_chunks(
+        self,
+        chunks: Iterable[pd.DataFrame],
+        table: str,
+        if_exists: Literal["fail", "replace", "append"] = "append",
+    ) -> None:
+        """Saves a stream of DataFrames into the database within a single transaction.
+
+        Args:
+            chunks: The Pandas DataFrames containing the data to save.
+            table: The name of the table to save the data to.
+            if_exists: The behavior if the table already exists, as in `save_data`.
+
+        Returns:
+            None.
+        """
+        with self.engine.begin() as connection:
+            if table in MANAGED_TABLES and if_exists == "replace":
+                connection.execute(text(f"delete from {table}"))
+                if_exists = "append"
+            for chunk in chunks:
+                chunk.to_sql(table, con=connection, if_exists=if_exists, index=False)
+                if_exists = "append"
 
     def write_log(
         self, source: str, action: DBAction, status: DBActionStatus, url: str
     ) -> None:
         """Writes a log entry to the database.
 
+        Entries are buffered by the log writer; download entries also record the
+        download status of the image once flushed. Registered URL indexes are updated
+        immediately.
+
         Args:
             source: The source of the log entry.
             action: The action that was performed.
@@ -101,18 +622,75 @@ class Database:
         Returns:
             None.
         """
-        self.save_data(
-            pd.DataFrame(
-                {
-                    "source": source,
-                    "action": [action.value],
-                    "status": status.value,
-                    "url": [url],
-                    "date": [dt.datetime.now().strftime("%d/%m/%Y %H:%M:%S")],
-                }
-            ),
-            "log",
-        )
+        self.log_writer.write(source, action, status, url)
+        for url_index in self.url_indexes:
+            url_index.add(action, url)
+
+    def register_url_index(self, url_index: "ProcessedUrlIndex") -> None:
+        """Registers an in-memory URL index to be kept in sync with new log entries.
+
+        Args:
+            url_index: The URL index to update on every `write_log`.
+
+        Returns:
+            None.
+        """
+        self.url_indexes.append(url_index)
+
+    def unregister_url_index(self, url_index: "ProcessedUrlIndex") -> None:
+        """Stops keeping a URL index in sync with new log entries, e.g. once it is replaced.
+
+        Args:
+            url_index: The URL index registered with `register_url_index`.
+
+        Returns:
+            None.
+        """
+        if url_index in self.url_indexes:
+            self.url_indexes.remove(url_index)
+
+    def flush_log(self) -> None:
+        """Writes all buffered log entries to the database.
+
+        Returns:
+            None.
+        """
+        self.log_writer.flush()
+
+    def count_log(self, actions: List[DBAction]) -> int:
+        """Returns the number of log entries recorded for the given actions.
+
+        Args:
+            actions: The actions to count entries for.
+
+        Returns:
+            The number of log entries, including entries not flushed yet.
+        """
+        self.flush_log()
+        placeholders = ", ".join(f":action{i}" for i in range(len(actions)))
+        query = f"select count(*) FROM log where action in ({placeholders})"
+        params = {f"action{i}": action.value for i, action in enumerate(actions)}
+        return self._execute_query(query, params)[0][0]
+
+    def iter_log(
+        self, actions: List[DBAction], chunk_size: int = 10000
+    ) -> Iterator[Tuple[DBAction, str]]:
+        """Yields the action and URL of all log entries for the given actions.
+
+        Args:
+            actions: The actions to read entries for.
+            chunk_size: The number of rows read from the database at once.
+
+        Returns:
+            An iterator over tuples of action and URL.
+        """
+        self.flush_log()
+        placeholders = ", ".join(f":action{i}" for i in range(len(actions)))
+        query = f"select action, url FROM log where action in ({placeholders})"
+        params = {f"action{i}": action.value for i, action in enumerate(actions)}
+        for rows in self._iter_query(query, params, chunk_size):
+            for entry in rows:
+                yield DBAction(entry[0]), entry[1]
 
     def check_log(self, action: DBAction, url: str) -> bool:
         """Checks whether an entry exists in the log for the given action and URL.
@@ -124,20 +702,74 @@ class Database:
         Returns:
             True if an entry exists in the log for the given action and URL, False otherwise.
         """
-        inspector = inspect(self.engine)
-        if inspector.has_table("log"):  # Check if table already exists
-            query = (
-                "select count(*) FROM log where url = '"
-                + url.replace("'", "''")
-                + "' and action = '"
-                + action.value
-                + "'"
-            )
-            result = self._execute_query(query).fetchone()
-            if result and result[0] > 0:
-                return True
+        if self.log_writer.contains(action, url):
+            return True
+        query = "select exists(select 1 FROM log where action = :action and url = :url)"
+        result = self._execute_query(query, {"action": action.value, "url": url})
+        if result and result[0][0] > 0:
+            return True
         return False
 
+    def claim_downloads(
+        self,
+        medium: Union[str, None] = None,
+        n: int = 100,
+        after: int = 0,
+        retry_failed: bool = False,
+    ) -> List[Tuple[int, str, str, str]]:
+        """Returns the next batch of images that have not been downloaded yet.
+
+        Batches are paginated by key: pass the cursor of the last row of a batch as
+        `after` to get the following batch, so draining the queue is linear in its size.
+        If no medium is given, the batch will be selected from all images. Each source
+        and ID is returned once, even if the image was stored more than once.
+
+        Args:
+            medium: The medium to filter the images by.
+            n: The maximum number of images to return.
+            after: The cursor of the last image already claimed.
+            retry_failed: Whether to also return images whose download failed before.
+
+        Returns:
+            A list of tuples, where each tuple contains the following data:
+                * Cursor
+                * Source
+                * ID
+                * URL
+        """
+        pending = (
+            "(img.download_status is null or img.download_status = :failure)"
+            if retry_failed
+            else "img.download_status is null"
+        )
+        # Images crawled more than once are only claimed through their first row, as all
+        # rows would be downloaded to the same path
+        first = (
+            "img.rowid = (select min(dup.rowid) FROM images as dup "
+            "where dup.source = img.source and dup.id = img.id)"
+        )
+        if medium:
+            query = (
+                "select me.rowid, img.source, img.id, img.url FROM mediums as me "
+                "inner join images as img on img.source = me.source and img.id = me.id "
+                f"where me.new_medium = :medium and me.rowid > :after and {pending} "
+                f"and {first} order by me.rowid limit :n"
+            )
+        else:
+            query = (
+                "select img.rowid, img.source, img.id, img.url FROM images as img "
+                f"where {pending} and img.rowid > :after and {first} "
+                "order by img.rowid limit :n"
+            )
+        params = {
+            "medium": medium,
+            "after": after,
+            "n": n,
+            "failure": DBActionStatus.FAILURE.value,
+        }
+        result = self._execute_query(query, params)
+        return [(entry[0], entry[1], entry[2], entry[3]) for entry in result]
+
     def get_next_image_download(
         self, medium: Union[str, None] = None
     ) -> Union[Tuple[str, str, str], None]:
@@ -150,21 +782,452 @@ class Database:
         Returns:
             A tuple containing the source, ID, and URL of the next image to download, or None if there are no more images to download.
         """
-        if medium:
-            query = (
-                "select img.source,img.id,img.url FROM images as img inner join mediums as me on img.id = me.id where img.url not in (select distinct url from log where action = 'download') and me.new_medium = '"
-                + medium
-                + "'"
-            )
-        else:
-            query = "select source,id,url FROM images where url not in (select distinct url from log where action = 'download')"
-        result = self._execute_query(query).fetchone()
+        result = self.claim_downloads(medium, n=1)
         if result:
-            source, img, url = result
+            _, source, img, url = result[0]
             return source, img, url
         else:
             return None
 
+    def get_variants(
+        self, images: List[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], List[Dict[str, Any]]]:
+        """Returns the size variants recorded for the given images.
+
+        Args:
+            images: A list of tuples with the source and ID of each image.
+
+        Returns:
+            A dictionary mapping the source and ID of each image with variants to a list of
+            dictionaries with the `url`, `kind`, `mimetype`, `width` and `height` of each variant.
+        """
+        variants: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        ids_by_source: Dict[str, List[str]] = {}
+        for source, id in images:
+            ids_by_source.setdefault(source, []).append(id)
+        for source, ids in ids_by_source.items():
+            placeholders = ", ".join(f":id{i}" for i in range(len(ids)))
+            query = (
+                "select source, id, url, kind, mimetype, width, height FROM image_variants "
+                f"where source = :source and id in ({placeholders})"
+            )
+            params = {f"id{i}": id for i, id in enumerate(ids)}
+            for entry in self._execute_query(query, {"source": source, **params}):
+                variants.setdefault((entry[0], entry[1]), []).append(
+                    {
+                        "url": entry[2],
+                        "kind": entry[3],
+                        "mimetype": entry[4],
+                        "width": entry[5],
+                        "height": entry[6],
+                    }
+                )
+        return variants
+
+    def save_image_file(
+        self,
+        source: str,
+        id: str,
+        sha256: str,
+        size: int,
+        blob_path: str,
+        file_path: str,
+    ) -> int:
+        """Records the stored file of a downloaded image.
+
+        Args:
+            source: The source of the image.
+            id: The ID of the image.
+            sha256: The SHA-256 digest of the file.
+            size: The size of the file in bytes.
+            blob_path: The path of the file in the content-addressed store.
+            file_path: The path of the file in the directory of its medium.
+
+        Returns:
+            The number of rows of the image updated, 0 if the image is not recorded.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "insert or ignore into blobs (sha256, size, path) values (:sha256, :size, :blob_path)"
+                ),
+                {"sha256": sha256, "size": size, "blob_path": blob_path},
+            )
+            return connection.execute(
+                text(
+                    "update images set sha256 = :sha256, file_path = :file_path, backup_path = null "
+                    "where source = :source and id = :id"
+                ),
+                {"sha256": sha256, "file_path": file_path, "source": source, "id": id},
+            ).rowcount
+
+    def get_stored_file_paths(self) -> Set[str]:
+        """Returns the paths of the downloaded files recorded in the image store.
+
+        Returns:
+            The set of file paths, see `save_image_file`.
+        """
+        query = "select file_path FROM images where file_path is not null"
+        return {entry[0] for rows in self._iter_query(query, {}) for entry in rows}
+
+    def get_pending_backups(self) -> List[Tuple[str, str, str, str]]:
+        """Returns the stored images that have not been backed up yet.
+
+        Returns:
+            A list of tuples, where each tuple contains the following data:
+                * Source
+                * ID
+                * File path
+                * Blob path
+        """
+        query = (
+            "select img.source, img.id, img.file_path, b.path FROM images as img "
+            "inner join blobs as b on b.sha256 = img.sha256 "
+            "where img.file_path is not null and img.backup_path is null"
+        )
+        result = self._execute_query(query)
+        return [(entry[0], entry[1], entry[2], entry[3]) for entry in result]
+
+    def save_backup_paths(self, backups: List[Tuple[str, str, str]]) -> None:
+        """Records the backup paths of stored images.
+
+        Args:
+            backups: A list of tuples with the source, ID and backup path of each image.
+
+        Returns:
+            None.
+        """
+        if not backups:
+            return
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                "update images set backup_path = ? where source = ? and id = ?",
+                [(path, source, id) for source, id, path in backups],
+            )
+
+    def claim_derivations(
+        self, medium: str, n: int = 100, after: int = 0, force: bool = False
+    ) -> List[Tuple[int, str, str, str, str]]:
+        """Returns the next batch of stored images of a medium without an up-to-date derivative.
+
+        A derivative is up to date if it was made from the file currently stored for the
+        image. Batches are paginated by key, as in `claim_downloads`.
+
+        Args:
+            medium: The medium of the images.
+            n: The maximum number of images to return.
+            after: The cursor of the last image already claimed.
+            force: Whether to also return images whose derivative is up to date.
+
+        Returns:
+            A list of tuples, where each tuple contains the following data:
+                * Cursor
+                * Source
+                * ID
+                * SHA-256 digest of the stored file
+                * File path
+        """
+        pending = (
+            ""
+            if force
+            else "and (d.source_sha256 is null or d.source_sha256 != img.sha256) "
+        )
+        query = (
+            "select me.rowid, img.source, img.id, img.sha256, img.file_path FROM mediums as me "
+            "inner join images as img on img.source = me.source and img.id = me.id "
+            "left join derivatives as d on d.source = img.source and d.id = img.id "
+            "where me.new_medium = :medium and me.rowid > :after and img.file_path is not null "
+            f"{pending}order by me.rowid limit :n"
+        )
+        result = self._execute_query(query, {"medium": medium, "after": after, "n": n})
+        return [(entry[0], entry[1], entry[2], entry[3], entry[4]) for entry in result]
+
+    def save_derivatives(self, derivatives: List[Dict[str, Any]]) -> None:
+        """Records derived images, replacing earlier derivatives of the same images.
+
+        Args:
+            derivatives: A list of dictionaries with the `source`, `id`, `source_sha256`,
+                `path`, `width`, `height`, `sha256` and `thumbnail_path` of each derivative.
+
+        Returns:
+            None.
+        """
+        if not derivatives:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "insert or replace into derivatives (source, id, source_sha256, path, width, height, sha256, thumbnail_path) "
+                    "values (:source, :id, :source_sha256, :path, :width, :height, :sha256, :thumbnail_path)"
+                ),
+                derivatives,
+            )
+
+    def claim_unhashed_images(
+        self, n: int = 100, after: int = 0
+    ) -> List[Tuple[int, str, str, str]]:
+        """Returns the next batch of stored images without a perceptual hash.
+
+        Batches are paginated by key, as in `claim_downloads`.
+
+        Args:
+            n: The maximum number of images to return.
+            after: The cursor of the last image already claimed.
+
+        Returns:
+            A list of tuples, where each tuple contains the following data:
+                * Cursor
+                * Source
+                * ID
+                * File path
+        """
+        query = (
+            "select img.rowid, img.source, img.id, img.file_path FROM images as img "
+            "left join image_hashes as h on h.source = img.source and h.id = img.id "
+            "where img.file_path is not null and h.phash is null and img.rowid > :after "
+            "order by img.rowid limit :n"
+        )
+        result = self._execute_query(query, {"after": after, "n": n})
+        return [(entry[0], entry[1], entry[2], entry[3]) for entry in result]
+
+    def save_image_hashes(self, hashes: List[Dict[str, Any]]) -> None:
+        """Records perceptual hashes of images, replacing earlier hashes of the same images.
+
+        Args:
+            hashes: A list of dictionaries with the `source`, `id`, `phash`, `dhash` and
+                `cluster` of each image.
+
+        Returns:
+            None.
+        """
+        if not hashes:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "insert or replace into image_hashes (source, id, phash, dhash, cluster) "
+                    "values (:source, :id, :phash, :dhash, :cluster)"
+                ),
+                hashes,
+            )
+
+    def get_last_image_rowid(self) -> int:
+        """Returns the rowid of the last image added to the database.
+
+        Returns:
+            The largest rowid of the images table, or 0 if it is empty.
+        """
+        result = self._execute_query("select max(rowid) FROM images")
+        return result[0][0] or 0
+
+    def save_medium_mappings(self, mappings: Dict[str, str]) -> int:
+        """Records the standardized name of each source medium.
+
+        Mappings that are new or differ from the recorded ones are flagged as pending, so
+        that `map_mediums` remaps the images already mapped with their old value.
+
+        Args:
+            mappings: A dictionary mapping source medium names to standardized names.
+
+        Returns:
+            The number of new or changed mappings.
+        """
+        with self.engine.begin() as connection:
+            recorded = dict(
+                connection.exec_driver_sql(
+                    "select old_medium, new_medium FROM medium_mappings"
+                ).fetchall()
+            )
+            changed = [
+                (old_medium, new_medium)
+                for old_medium, new_medium in mappings.items()
+                if recorded.get(old_medium) != new_medium
+            ]
+            if changed:
+                connection.exec_driver_sql(
+                    "insert into medium_mappings (old_medium, new_medium, pending) values (?, ?, 1) "
+                    "on conflict (old_medium) do update set new_medium = excluded.new_medium, pending = 1",
+                    changed,
+                )
+        return len(changed)
+
+    def map_mediums(self, until: int, full: bool = False) -> int:
+        """Maps the mediums of images added or remapped since the last run, as one join.
+
+        Images up to rowid `until` that were added after the stored watermark are mapped,
+        along with earlier images whose source medium has a pending mapping. The
+        watermark then moves to `until`, within the same transaction.
+
+        Args:
+            until: The rowid of the last image whose source medium has a mapping.
+            full: Whether to remap all images, regardless of the watermark.
+
+        Returns:
+            The number of images mapped.
+        """
+        with self.engine.begin() as connection:
+            watermark = connection.execute(
+                text("select value FROM meta where key = 'mediums_watermark'")
+            ).fetchall()
+            watermark = 0 if full or not watermark else int(watermark[0][0])
+            mapped = connection.execute(
+                text(
+                    "insert into mediums (source, id, new_medium) "
+                    "select source, id, new_medium from ("
+                    "select img.rowid as position, img.source, img.id, mm.new_medium FROM images as img "
+                    "inner join medium_mappings as mm on mm.old_medium = img.medium "
+                    "where img.rowid > :watermark and img.rowid <= :until "
+                    "union all "
+                    "select img.rowid, img.source, img.id, mm.new_medium FROM medium_mappings as mm "
+                    "inner join images as img on img.medium = mm.old_medium "
+                    "where mm.pending = 1 and img.rowid <= :watermark"
+                    ") where true order by position "
+                    "on conflict (source, id) do update set new_medium = excluded.new_medium"
+                ),
+                {"watermark": watermark, "until": until},
+            ).rowcount
+            connection.execute(
+                text("update medium_mappings set pending = 0 where pending = 1")
+            )
+            connection.execute(
+                text(
+                    "insert or replace into meta (key, value) values ('mediums_watermark', :until)"
+                ),
+                {"until": str(max(until, watermark))},
+            )
+        return mapped
+
+    def get_meta(self, key: str) -> Union[str, None]:
+        """Returns a value of the key-value `meta` table.
+
+        Args:
+            key: The key of the value.
+
+        Returns:
+            The value, or None if the key is not set.
+        """
+        result = self._execute_query(
+            "select value FROM meta where key = :key", {"key": key}
+        )
+        return result[0][0] if result else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        """Sets a value of the key-value `meta` table.
+
+        Args:
+            key: The key of the value.
+            value: The value.
+
+        Returns:
+            None.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(
+                text("insert or replace into meta (key, value) values (:key, :value)"),
+                {"key": key, "value": value},
+            )
+
+    def get_feature_rows(self) -> Dict[Tuple[str, str, str], Tuple[int, str]]:
+        """Returns the feature store rows of all image crops.
+
+        Returns:
+            A dictionary mapping the source, ID and crop name of each image crop to its
+            row in the feature store and the SHA-256 digest of the image it was computed on.
+        """
+        query = "select source, id, crop, row, sha256 FROM features"
+        return {
+            (entry[0], entry[1], entry[2]): (entry[3], entry[4])
+            for rows in self._iter_query(query)
+            for entry in rows
+        }
+
+    def save_feature_rows(self, rows: List[Dict[str, Any]]) -> None:
+        """Records the feature store rows of image crops, replacing earlier rows.
+
+        Args:
+            rows: A list of dictionaries with the `source`, `id`, `crop`, `row` and
+                `sha256` of each image crop.
+
+        Returns:
+            None.
+        """
+        if not rows:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "insert or replace into features (source, id, crop, row, sha256) "
+                    "values (:source, :id, :crop, :row, :sha256)"
+                ),
+                rows,
+            )
+
+    def claim_unscored_images(
+        self, model: str, n: int = 100, after: int = 0
+    ) -> List[Tuple[int, str, str, str]]:
+        """Returns the next batch of stored images without predictions of a model.
+
+        Batches are paginated by key, as in `claim_downloads`.
+
+        Args:
+            model: The name of the model.
+            n: The maximum number of images to return.
+            after: The cursor of the last image already claimed.
+
+        Returns:
+            A list of tuples, where each tuple contains the following data:
+                * Cursor
+                * Source
+                * ID
+                * File path
+        """
+        query = (
+            "select img.rowid, img.source, img.id, img.file_path FROM images as img "
+            "where img.file_path is not null and img.rowid > :after and not exists ("
+            "select 1 FROM predictions as p where p.model = :model and p.source = img.source and p.id = img.id"
+            ") order by img.rowid limit :n"
+        )
+        result = self._execute_query(query, {"model": model, "after": after, "n": n})
+        return [(entry[0], entry[1], entry[2], entry[3]) for entry in result]
+
+    def get_scored_ids(self, model: str, source: str) -> Set[str]:
+        """Returns the IDs of the images of a source with predictions of a model.
+
+        Args:
+            model: The name of the model.
+            source: The source of the images.
+
+        Returns:
+            The set of IDs.
+        """
+        query = "select distinct id FROM predictions where model = :model and source = :source"
+        return {
+            entry[0]
+            for rows in self._iter_query(query, {"model": model, "source": source})
+            for entry in rows
+        }
+
+    def save_predictions(self, predictions: List[Dict[str, Any]]) -> None:
+        """Records predictions of images, replacing earlier ones of the same model and rank.
+
+        Args:
+            predictions: A list of dictionaries with the `source`, `id`, `model`,
+                `rank`, `label`, `probability` and `date` of each prediction.
+
+        Returns:
+            None.
+        """
+        if not predictions:
+            return
+        with self.engine.begin() as connection:
+            connection.execute(
+                text(
+                    "insert or replace into predictions (source, id, model, rank, label, probability, date) "
+                    "values (:source, :id, :model, :rank, :label, :probability, :date)"
+                ),
+                predictions,
+            )
+
     def get_medium(self, source: str, id: str) -> Union[str, None]:
         """Returns the medium for the given source and ID.
 
@@ -175,16 +1238,10 @@ class Database:
         Returns:
             The medium for the image.
         """
-        query = (
-            "select new_medium FROM mediums where source='"
-            + source
-            + "' and id='"
-            + id
-            + "'"
-        )
-        result = self._execute_query(query).fetchone()
-        if result is not None:
-            new_medium = result[0]
+        query = "select new_medium FROM mediums where source = :source and id = :id"
+        result = self._execute_query(query, {"source": source, "id": id})
+        if result:
+            new_medium = result[0][0]
             return new_medium
         else:
             return None
@@ -199,7 +1256,7 @@ class Database:
                 * Medium
         """
         query = "select source, id, medium FROM images"
-        result = self._execute_query(query).fetchall()
+        result = self._execute_query(query)
         if result:
             images_to_update: List[Tuple[str, str, str]] = [
                 (entry[0], entry[1], entry[2]) for entry in result
@@ -208,6 +1265,55 @@ class Database:
         else:
             return None
 
+    def iter_images(self, chunk_size: int = 10000) -> Iterator[Tuple[str, str, str]]:
+        """Yields all images along with their source, ID, and medium, reading them in chunks.
+
+        Args:
+            chunk_size: The number of rows read from the database at once.
+
+        Returns:
+            An iterator over tuples, where each tuple contains the following data:
+                * Source
+                * ID
+                * Medium
+        """
+        query = "select source, id, medium FROM images order by rowid"
+        for rows in self._iter_query(query, chunk_size=chunk_size):
+            for entry in rows:
+                yield entry[0], entry[1], entry[2]
+
+    def iter_all_mediums(self, chunk_size: int = 10000) -> Iterator[str]:
+        """Yields all unique mediums in the database, reading them in chunks.
+
+        Args:
+            chunk_size: The number of rows read from the database at once.
+
+        Returns:
+            An iterator over mediums.
+        """
+        query = "select distinct medium FROM images"
+        for rows in self._iter_query(query, chunk_size=chunk_size):
+            for entry in rows:
+                yield entry[0]
+
+    def iter_all_mediums_count(
+        self, chunk_size: int = 10000
+    ) -> Iterator[Tuple[str, int]]:
+        """Yields all unique mediums in the database along with their number of images.
+
+        Args:
+            chunk_size: The number of rows read from the database at once.
+
+        Returns:
+            An iterator over tuples, where each tuple contains the following data:
+                * Medium
+                * Count
+        """
+        query = "select medium, count(*) FROM images group by medium"
+        for rows in self._iter_query(query, chunk_size=chunk_size):
+            for entry in rows:
+                yield entry[0], entry[1]
+
     def get_all_mediums(self) -> Union[List[str], None]:
         """Returns a list of all unique mediums in the database.
 
@@ -215,7 +1321,7 @@ class Database:
             A list of tuples, where each tuple contains a medium.
         """
         query = "select distinct medium FROM images"
-        result = self._execute_query(query).fetchall()
+        result = self._execute_query(query)
         if result:
             mediums: List[str] = [entry[0] for entry in result]
             return mediums
@@ -232,7 +1338,7 @@ class Database:
                 * Count
         """
         query = "select distinct medium, count(*) FROM images group by medium"
-        result = self._execute_query(query).fetchall()
+        result = self._execute_query(query)
         if result:
             mediums_count: List[Tuple[str, int]] = [
                 (entry[0], entry[1]) for entry in result
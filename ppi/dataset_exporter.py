@@ -0,0 +1,284 @@
+import csv
+import datetime as dt
+import hashlib
+import io
+import json
+import os
+import tarfile
+from typing import Any, Dict, Iterator, List, Tuple, Union
+from loguru import logger
+from ppi.database import Database
+
+"""Class for exporting the cropped images as a sharded, labelled dataset"""
+
+
+DEFAULT_DATASET_CONFIG: Dict[str, Any] = {
+    "val_fraction": 0.2,
+    "seed": 1,
+    "shard_size_mb": 256,
+}
+
+# A sample: (sort key, source, ID, label, path of the image)
+Sample = Tuple[int, str, str, int, str]
+
+
+def read_shards(paths: List[str]) -> Iterator[Tuple[bytes, int]]:
+    """Reads the samples of dataset shards sequentially.
+
+    Meant to feed e.g. `tf.data.Dataset.from_generator`, so that training streams a
+    few large files instead of opening one file per image.
+
+    Args:
+        paths: The paths of the shards, as listed in the manifest.
+
+    Returns:
+        An iterator over the encoded image and the label of each sample.
+    """
+    for path in paths:
+        with tarfile.open(path, "r|") as tar:
+            image = None
+            for member in tar:
+                data = tar.extractfile(member).read()
+                if member.name.endswith(".cls"):
+                    yield image, int(data)
+                else:
+                    image = data
+
+
+class DatasetExporter:
+    """Exports the cropped images of the allowed mediums as train and validation shards.
+
+    Samples are the images in `dir.crop/<medium>/` that are mapped to an allowed medium
+    in the database, labelled by the position of their medium in `allowed_processes`.
+    The split is deterministic: each image is ranked within its class by a hash of its
+    near-duplicate cluster (see `PerceptualHashIndex`), or of its source and ID if it
+    has not been hashed, and the same number of top ranked images of every class goes
+    to the validation set. Near-duplicates share a rank, so they never straddle the
+    split. Shards are uncompressed tar files holding `<source>_<id>.<ext>` and
+    `<source>_<id>.cls` members, in hash order so that classes are interleaved.
+
+    Attributes:
+        config: The configuration data.
+        database: The database with the image mediums.
+        dataset_config: The `dataset` section of the configuration, with defaults.
+    """
+
+    def __init__(self, config: dict, database: Database) -> None:
+        """Initializes the dataset exporter.
+
+        Args:
+            config: The configuration data.
+            database: The database with the image mediums.
+        """
+        self.config = config
+        self.database = database
+        self.dataset_config = {**DEFAULT_DATASET_CONFIG, **config.get("dataset", {})}
+
+    def _rank(self, cluster: str) -> int:
+        """Returns the position of a cluster of images in the deterministic order of the dataset.
+
+        Args:
+            cluster: The near-duplicate cluster of the images.
+
+        Returns:
+            A 64-bit hash of the seed and the cluster.
+        """
+        key = f"{self.dataset_config['seed']}/{cluster}".encode()
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+    def _clusters(self) -> Dict[Tuple[str, str], str]:
+        """Returns the near-duplicate cluster of each hashed image.
+
+        Returns:
+            A dictionary mapping the source and ID of each hashed image to its cluster.
+        """
+        clusters: Dict[Tuple[str, str], str] = {}
+        for chunk in self.database.iter_table_chunks(
+            "image_hashes", ["source", "id", "cluster"]
+        ):
+            for source, id, cluster in chunk.itertuples(index=False):
+                clusters[(source, id)] = cluster
+        return clusters
+
+    def _crops(self) -> Dict[str, str]:
+        """Lists the cropped images of all allowed mediums.
+
+        Returns:
+            A dictionary mapping the file name without extension (`<source>_<id>`) of
+            each cropped image to its path.
+        """
+        crops: Dict[str, str] = {}
+        for medium in self.config["allowed_processes"]:
+            crop_dir = os.path.join(self.config["dir"]["crop"], medium)
+            if not os.path.isdir(crop_dir):
+                continue
+            with os.scandir(crop_dir) as entries:
+                for entry in entries:
+                    stem, ext = os.path.splitext(entry.name)
+                    if entry.is_file() and ext and not ext.endswith("part"):
+                        crops[stem] = entry.path
+        return crops
+
+    def _samples(self) -> Dict[int, List[Sample]]:
+        """Collects the samples of each class, in rank order.
+
+        Returns:
+            A dictionary mapping each label to its samples.
+        """
+        labels = {
+            medium: label
+            for label, medium in enumerate(self.config["allowed_processes"])
+        }
+        crops = self._crops()
+        clusters = self._clusters()
+        samples: Dict[int, List[Sample]] = {label: [] for label in labels.values()}
+        for chunk in self.database.iter_table_chunks(
+            "mediums", ["source", "id", "new_medium"]
+        ):
+            for source, id, medium in chunk.itertuples(index=False):
+                path = crops.pop(f"{source}_{id}", None)
+                if path and medium in labels:
+                    cluster = clusters.get((source, id), f"{source}_{id}")
+                    samples[labels[medium]].append(
+                        (self._rank(cluster), source, id, labels[medium], path)
+                    )
+        if crops:
+            logger.warning(
+                f"{len(crops)} cropped images have no allowed medium in the database and are not exported"
+            )
+        for class_samples in samples.values():
+            class_samples.sort()
+        return samples
+
+    def split(self) -> Tuple[List[Sample], List[Sample]]:
+        """Splits the samples into a training and a class-balanced validation set.
+
+        Each class contributes `val_fraction` of the smallest non-empty class to the
+        validation set, so validation accuracy is not dominated by the largest classes.
+
+        Returns:
+            A tuple with the training and validation samples, each in rank order.
+        """
+        samples = self._samples()
+        sizes = [
+            len(class_samples) for class_samples in samples.values() if class_samples
+        ]
+        val_per_class = (
+            int(min(sizes) * self.dataset_config["val_fraction"]) if sizes else 0
+        )
+        train: List[Sample] = []
+        val: List[Sample] = []
+        for class_samples in samples.values():
+            cut = min(val_per_class, len(class_samples))
+            # Keep the rest of the last validation cluster in the validation set
+            while 0 < cut < len(class_samples) and (
+                class_samples[cut][0] == class_samples[cut - 1][0]
+            ):
+                cut += 1
+            val.extend(class_samples[:cut])
+            train.extend(class_samples[cut:])
+        return sorted(train), sorted(val)
+
+    def _write_shards(
+        self, samples: List[Sample], split: str, output_dir: str
+    ) -> Dict[str, Any]:
+        """Writes the samples of a split into tar shards, along with an index.
+
+        The index is a CSV file with the shard, byte offset and size of every image,
+        for random access into the shards.
+
+        Args:
+            samples: The samples of the split.
+            split: The name of the split, used as prefix of the shard names.
+            output_dir: The directory to write the shards to.
+
+        Returns:
+            The manifest entry of the split.
+        """
+        shard_size = self.dataset_config["shard_size_mb"] * 1024 * 1024
+        shards: List[str] = []
+        class_counts = [0] * len(self.config["allowed_processes"])
+        tar: Union[tarfile.TarFile, None] = None
+        index_path = os.path.join(output_dir, f"{split}.index.csv")
+        with open(index_path, "w", newline="") as index_file:
+            index = csv.writer(index_file)
+            index.writerow(["shard", "name", "source", "id", "label", "offset", "size"])
+            for _, source, id, label, path in samples:
+                if tar is None or tar.offset >= shard_size:
+                    if tar is not None:
+                        tar.close()
+                    shards.append(f"{split}-{len(shards):05d}.tar")
+                    tar = tarfile.open(
+                        os.path.join(output_dir, shards[-1]),
+                        "w",
+                        format=tarfile.GNU_FORMAT,
+                    )
+                with open(path, "rb") as file:
+                    data = file.read()
+                name = f"{source}_{id}{os.path.splitext(path)[1].lower()}"
+                offset = self._add_member(tar, name, data)
+                self._add_member(tar, f"{source}_{id}.cls", str(label).encode())
+                index.writerow([shards[-1], name, source, id, label, offset, len(data)])
+                class_counts[label] += 1
+            if tar is not None:
+                tar.close()
+        for name in os.listdir(output_dir):
+            if name.startswith(f"{split}-") and name.endswith(".tar"):
+                if name not in shards:
+                    os.remove(os.path.join(output_dir, name))
+        return {
+            "shards": shards,
+            "index": os.path.basename(index_path),
+            "count": len(samples),
+            "class_counts": class_counts,
+        }
+
+    def _add_member(self, tar: tarfile.TarFile, name: str, data: bytes) -> int:
+        """Adds a file to a tar archive with fixed metadata, so exports are reproducible.
+
+        Args:
+            tar: The archive to add the file to.
+            name: The name of the file in the archive.
+            data: The contents of the file.
+
+        Returns:
+            The byte offset of the contents of the file in the archive.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = 0
+        offset = tar.offset + len(info.tobuf(tar.format, tar.encoding, tar.errors))
+        tar.addfile(info, io.BytesIO(data))
+        return offset
+
+    def export(self, output_dir: Union[str, None] = None) -> Dict[str, Any]:
+        """Exports the dataset into shards and writes its manifest.
+
+        Args:
+            output_dir: The directory to write the dataset to. Defaults to `dir.dataset`
+                in the configuration.
+
+        Returns:
+            The manifest, as written to `manifest.json` in the output directory.
+        """
+        output_dir = output_dir or self.config["dir"]["dataset"]
+        os.makedirs(output_dir, exist_ok=True)
+        train, val = self.split()
+        manifest = {
+            "labels": list(self.config["allowed_processes"]),
+            "seed": self.dataset_config["seed"],
+            "val_fraction": self.dataset_config["val_fraction"],
+            "created": dt.datetime.now().isoformat(),
+            "splits": {
+                "train": self._write_shards(train, "train", output_dir),
+                "val": self._write_shards(val, "val", output_dir),
+            },
+        }
+        manifest_path = os.path.join(output_dir, "manifest.json")
+        with open(f"{manifest_path}.part", "w") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(f"{manifest_path}.part", manifest_path)
+        logger.info(
+            f"Exported {len(train)} training and {len(val)} validation images to {output_dir}"
+        )
+        return manifest
@@ -0,0 +1,268 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from loguru import logger
+from ppi.database import Database
+from ppi.dataset_exporter import DatasetExporter, Sample
+from ppi.image_store import file_sha256
+from ppi.preprocessing import bounded_map, crop_names, crop_offsets, load_crops
+
+"""Class for caching the features of the frozen backbone over the training crops"""
+
+
+DEFAULT_FEATURES_CONFIG: Dict[str, Any] = {
+    "image_size": 1000,
+    "crop_size": 400,
+    "random_crops": 4,
+    "batch_size": 32,
+    "weights": "imagenet",
+    "threads": None,
+}
+
+# A decoded image: (source, id, sha256, crop names, crops as an array of shape (n, h, w, 3))
+DecodedImage = Tuple[str, str, str, List[str], np.ndarray]
+
+
+class FeatureStore:
+    """Stores the features of the frozen backbone for the crops of the dataset images.
+
+    The backbone is the Xception base of the notebooks, with their input scaling and
+    global average pooling, run once per crop on CPU. Features are appended as float16
+    rows to `features.f16` in `dir.features`, read back as a memory map, and the row of
+    each (source, ID, crop) is recorded in the `features` table along with the digest of
+    the image file. Crops of unchanged images are not recomputed, so training a head on
+    the stored features skips the backbone entirely.
+
+    Attributes:
+        config: The configuration data.
+        database: The database with the image mediums and feature rows.
+        features_config: The `features` section of the configuration, with defaults.
+        path: The path of the feature matrix.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        database: Database,
+        backbone: Union[keras.Model, None] = None,
+    ) -> None:
+        """Initializes the feature store.
+
+        Args:
+            config: The configuration data.
+            database: The database with the image mediums and feature rows.
+            backbone: The model computing the features. Defaults to the Xception base,
+                built on first use.
+        """
+        self.config = config
+        self.database = database
+        self.features_config = {
+            **DEFAULT_FEATURES_CONFIG,
+            **config.get("features", {}),
+        }
+        self.path = os.path.join(config["dir"]["features"], "features.f16")
+        self._backbone = backbone
+
+    @property
+    def backbone(self) -> keras.Model:
+        """The model computing the features, built on first use."""
+        if self._backbone is None:
+            threads = self.features_config["threads"]
+            if threads:
+                tf.config.threading.set_intra_op_parallelism_threads(threads)
+            crop_size = self.features_config["crop_size"]
+            inputs = keras.Input(shape=(crop_size, crop_size, 3))
+            x = keras.layers.Rescaling(scale=1 / 127.5, offset=-1)(inputs)
+            base_model = keras.applications.Xception(
+                include_top=False,
+                weights=self.features_config["weights"],
+                input_shape=(crop_size, crop_size, 3),
+                pooling="avg",
+            )
+            outputs = base_model(x, training=False)
+            self._backbone = keras.Model(inputs, outputs)
+        return self._backbone
+
+    @property
+    def dim(self) -> int:
+        """The number of features per crop."""
+        dim = self.database.get_meta("features_dim")
+        if dim is None:
+            dim = str(self.backbone.output_shape[-1])
+            self.database.set_meta("features_dim", dim)
+        return int(dim)
+
+    def _decode(
+        self,
+        item: Tuple[str, str, str, List[str]],
+        recorded: Dict[Tuple[str, str, str], Tuple[int, str]],
+    ) -> Union[DecodedImage, None]:
+        """Decodes the crops of an image that have no up-to-date features.
+
+        Args:
+            item: The source, ID, path and crop names of the image.
+            recorded: The recorded feature rows, see `Database.get_feature_rows`.
+
+        Returns:
+            The decoded crops, or None if all of them are up to date.
+        """
+        source, id, path, crops = item
+        sha256 = file_sha256(path).hexdigest()
+        missing = [
+            crop
+            for crop in crops
+            if recorded.get((source, id, crop), (None, None))[1] != sha256
+        ]
+        if not missing:
+            return None
+        offsets = dict(
+            crop_offsets(
+                source,
+                id,
+                self.features_config["image_size"],
+                self.features_config["crop_size"],
+                self.features_config["random_crops"],
+            )
+        )
+        array = load_crops(
+            path,
+            [offsets[crop] for crop in missing],
+            self.features_config["image_size"],
+            self.features_config["crop_size"],
+        )
+        return source, id, sha256, missing, array
+
+    def _append(self, features: np.ndarray) -> int:
+        """Appends rows to the feature matrix.
+
+        Args:
+            features: The features, one row per crop.
+
+        Returns:
+            The index of the first appended row.
+        """
+        row_bytes = self.dim * np.dtype(np.float16).itemsize
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as file:
+            # Rows of an interrupted write are overwritten
+            first_row = file.seek(0, os.SEEK_END) // row_bytes
+            file.seek(first_row * row_bytes)
+            file.write(features.astype(np.float16).tobytes())
+            file.truncate()
+        return first_row
+
+    def _store(
+        self, batch: List[Tuple[str, str, str, str]], crops: List[np.ndarray]
+    ) -> None:
+        """Runs the backbone over a batch of crops and stores their features.
+
+        Args:
+            batch: The source, ID, image digest and crop name of each crop.
+            crops: The crops.
+
+        Returns:
+            None.
+        """
+        with tf.device("/CPU:0"):
+            features = self.backbone.predict_on_batch(np.stack(crops))
+        first_row = self._append(np.asarray(features))
+        self.database.save_feature_rows(
+            [
+                {
+                    "source": source,
+                    "id": id,
+                    "crop": crop,
+                    "row": first_row + i,
+                    "sha256": sha256,
+                }
+                for i, (source, id, sha256, crop) in enumerate(batch)
+            ]
+        )
+
+    def extract(self, workers: Union[int, None] = None) -> int:
+        """Computes the features of the dataset crops that have no up-to-date features.
+
+        Training images get the center and random crops, validation images only the
+        center crop, following the split of `DatasetExporter`. Images are decoded in a
+        thread pool while the backbone runs.
+
+        Args:
+            workers: The number of decoding threads. Defaults to the number of CPUs.
+
+        Returns:
+            The number of crops whose features were computed.
+        """
+        workers = workers or os.cpu_count() or 1
+        train, val = DatasetExporter(self.config, self.database).split()
+        all_crops = crop_names(self.features_config["random_crops"])
+        items = [(source, id, path, all_crops) for _, source, id, _, path in train] + [
+            (source, id, path, ["center"]) for _, source, id, _, path in val
+        ]
+        recorded = self.database.get_feature_rows()
+        batch_size = self.features_config["batch_size"]
+        batch: List[Tuple[str, str, str, str]] = []
+        crops: List[np.ndarray] = []
+        computed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            decoded_images = bounded_map(
+                executor,
+                lambda item: self._decode(item, recorded),
+                items,
+                2 * workers,
+            )
+            for decoded in decoded_images:
+                if decoded is None:
+                    continue
+                source, id, sha256, names, array = decoded
+                for name, crop in zip(names, array):
+                    batch.append((source, id, sha256, name))
+                    crops.append(crop)
+                    if len(batch) == batch_size:
+                        self._store(batch, crops)
+                        computed += len(batch)
+                        batch, crops = [], []
+            if batch:
+                self._store(batch, crops)
+                computed += len(batch)
+        logger.info(f"Computed the features of {computed} crops")
+        return computed
+
+    def load(
+        self, split: str, crops: Union[List[str], None] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Loads the stored features and labels of a split of the dataset.
+
+        Args:
+            split: `train` or `val`, as split by `DatasetExporter`.
+            crops: The names of the crops to load. Defaults to all crops for `train` and
+                the center crop for `val`.
+
+        Returns:
+            A tuple with the features, one row per crop, and the labels of the crops.
+        """
+        train, val = DatasetExporter(self.config, self.database).split()
+        samples: List[Sample] = train if split == "train" else val
+        if crops is None:
+            crops = (
+                crop_names(self.features_config["random_crops"])
+                if split == "train"
+                else ["center"]
+            )
+        recorded = self.database.get_feature_rows()
+        rows: List[int] = []
+        labels: List[int] = []
+        for _, source, id, label, _ in samples:
+            for crop in crops:
+                if (source, id, crop) in recorded:
+                    rows.append(recorded[(source, id, crop)][0])
+                    labels.append(label)
+        if not rows:
+            return np.zeros((0, self.dim), np.float16), np.zeros(0, np.int64)
+        row_count = os.path.getsize(self.path) // (
+            self.dim * np.dtype(np.float16).itemsize
+        )
+        matrix = np.memmap(self.path, np.float16, "r", shape=(row_count, self.dim))
+        return np.asarray(matrix[rows]), np.asarray(labels, np.int64)
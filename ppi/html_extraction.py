@@ -0,0 +1,66 @@
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+from typing import Dict, List, Tuple
+
+"""Functions for extracting links and metadata from HTML pages in a single pass"""
+
+
+try:
+    import lxml  # noqa: F401
+
+    PARSER = "lxml"  # Faster C backend, used when installed
+except ImportError:
+    PARSER = "html.parser"
+
+# Only these elements are built into a tree; all others are skipped while parsing
+HEAD_STRAINER = SoupStrainer(["meta", "link"])
+
+
+def extract_links(html: str, href_pattern: re.Pattern) -> List[str]:
+    """Extracts the unique targets of all anchors whose `href` matches a pattern.
+
+    Args:
+        html: The text of the page.
+        href_pattern: The compiled pattern the `href` must match.
+
+    Returns:
+        A list of unique link targets, in order of appearance.
+    """
+    soup = BeautifulSoup(html, PARSER, parse_only=SoupStrainer("a", href=href_pattern))
+    return list(dict.fromkeys(anchor["href"] for anchor in soup.find_all("a")))
+
+
+def extract_head(html: str) -> Tuple[Dict[str, List[str]], List[Dict[str, str]]]:
+    """Extracts all `meta` and `link` elements of a page in a single parse.
+
+    Args:
+        html: The text of the page.
+
+    Returns:
+        A tuple containing the following data:
+            * A dictionary mapping each `meta` name to the contents of its elements
+            * A list with the attributes of each `link` element
+    """
+    meta: Dict[str, List[str]] = {}
+    links: List[Dict[str, str]] = []
+    for tag in BeautifulSoup(html, PARSER, parse_only=HEAD_STRAINER).find_all(
+        ["meta", "link"]
+    ):
+        if tag.name == "meta":
+            if tag.has_attr("name"):
+                meta.setdefault(tag["name"], []).append(tag.get("content", ""))
+        else:
+            links.append({key: _attribute(value) for key, value in tag.attrs.items()})
+    return meta, links
+
+
+def _attribute(value) -> str:
+    """Returns an attribute value as a string, joining multi-valued attributes like `rel`.
+
+    Args:
+        value: The attribute value.
+
+    Returns:
+        The attribute value as a string.
+    """
+    return " ".join(value) if isinstance(value, list) else value
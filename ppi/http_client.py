@@ -0,0 +1,174 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Union
+from urllib.parse import urlparse
+from ppi.rate_limiter import RateLimiter
+from ppi.response_cache import CacheMissError, ResponseCache
+
+"""Class for sending HTTP requests through pooled, throttled sessions"""
+
+
+try:
+    import brotli  # noqa: F401
+
+    ACCEPT_ENCODING = "gzip, deflate, br"  # requests decodes br only with brotli
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Settings used for keys missing from the `http` configuration
+DEFAULT_HTTP_CONFIG: Dict[str, Union[int, float, str]] = {
+    "connect_timeout": 10,  # Seconds to establish a connection
+    "read_timeout": 60,  # Seconds to wait for data between bytes received
+    "max_retries": 3,  # Retries on connection errors and 500/502/504 responses
+    "backoff_factor": 1.0,  # Seconds before the first retry, doubled on each retry
+    "max_throttled_retries": 5,  # Retries on 429/503 responses, paced by the rate limiter
+    "pool_maxsize": 16,  # Keep-alive connections kept per host
+    "user_agent": "ppi (https://github.com/guilhermesfc/ppi)",
+    "cache_dir": "",  # Directory of the response cache, disabled if empty
+    "cache_mode": "revalidate",  # Either revalidate or replay (offline)
+}
+
+
+class HttpClient:
+    """Sends GET requests through one keep-alive session per host.
+
+    A single instance should be shared by all crawlers and downloaders, so that
+    connections are reused and requests to the same host are throttled together.
+    Timeouts, compression, retries, rate limiting and response caching are all
+    configured here.
+
+    Attributes:
+        config: The HTTP settings, see `DEFAULT_HTTP_CONFIG`.
+        rate_limiter: The rate limiter throttling requests per host.
+        cache: The on-disk response cache, if enabled.
+    """
+
+    def __init__(
+        self, config: dict, rate_limiter: Union[RateLimiter, None] = None
+    ) -> None:
+        """Initializes the client.
+
+        Args:
+            config: The configuration data, with optional `http` and `rate_limits` sections.
+            rate_limiter: The rate limiter to use. Defaults to one built from `rate_limits`.
+        """
+        self.config = {**DEFAULT_HTTP_CONFIG, **config.get("http", {})}
+        self.rate_limiter = rate_limiter or RateLimiter(config.get("rate_limits"))
+        self.cache = (
+            ResponseCache(self.config["cache_dir"], self.config["cache_mode"])
+            if self.config["cache_dir"]
+            else None
+        )
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def _session(self, url: str) -> requests.Session:
+        """Returns the session of the host of a URL, creating it if needed.
+
+        Args:
+            url: The URL to be requested.
+
+        Returns:
+            The session of the host.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                retry = Retry(
+                    total=self.config["max_retries"],
+                    backoff_factor=self.config["backoff_factor"],
+                    status_forcelist=(500, 502, 504),
+                    allowed_methods=("GET",),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.config["pool_maxsize"],
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(
+                    {
+                        "Accept-Encoding": ACCEPT_ENCODING,
+                        "User-Agent": self.config["user_agent"],
+                    }
+                )
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def get(
+        self,
+        url: str,
+        headers: Union[Dict[str, str], None] = None,
+        stream: bool = False,
+        cache: bool = False,
+    ) -> requests.Response:
+        """Sends a GET request once the rate limiter allows it, retrying throttled requests.
+
+        Args:
+            url: The URL to request.
+            headers: Additional request headers.
+            stream: Whether to stream the body instead of reading it at once.
+            cache: Whether to use the response cache, if enabled. Ignored when streaming.
+
+        Returns:
+            The last response received, or the cached response.
+
+        Raises:
+            CacheMissError: If the cache is in replay mode and the URL is not cached.
+        """
+        if not cache or stream or self.cache is None:
+            return self._get(url, headers, stream)
+        entry = self.cache.lookup(url)
+        if self.cache.mode == "replay":
+            if entry is None:
+                raise CacheMissError(f"{url} is not in the response cache")
+            return self.cache.load(url, entry)
+        if entry is not None:
+            headers = {**(headers or {}), **self.cache.conditional_headers(entry)}
+        response = self._get(url, headers, stream)
+        if response.status_code == 304 and entry is not None:
+            self.cache.refresh(url, entry, response)
+            return self.cache.load(url, entry)
+        if response.status_code == 200:
+            self.cache.store(url, response)
+        return response
+
+    def _get(
+        self, url: str, headers: Union[Dict[str, str], None], stream: bool
+    ) -> requests.Response:
+        """Sends a GET request once the rate limiter allows it, retrying throttled requests.
+
+        Args:
+            url: The URL to request.
+            headers: Additional request headers.
+            stream: Whether to stream the body instead of reading it at once.
+
+        Returns:
+            The last response received.
+        """
+        session = self._session(url)
+        timeout = (self.config["connect_timeout"], self.config["read_timeout"])
+        max_retries = self.config["max_throttled_retries"]
+        for attempt in range(max_retries + 1):
+            self.rate_limiter.acquire(url)
+            response = session.get(url, headers=headers, stream=stream, timeout=timeout)
+            if not self.rate_limiter.update(url, response) or attempt == max_retries:
+                return response
+            response.close()
+        return response
+
+    def close(self) -> None:
+        """Closes all sessions and their connections.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
@@ -0,0 +1,258 @@
+import hashlib
+import math
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Tuple, Union
+import numpy as np
+from loguru import logger
+from PIL import Image, ImageOps
+from ppi.database import Database
+
+"""Class for deriving resized training images from downloaded images"""
+
+
+# File extension and Pillow format of the supported output formats
+FORMATS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+DEFAULT_DERIVE_CONFIG: Dict[str, Any] = {
+    "size": 1000,
+    "thumbnail_size": 256,
+    "format": "JPEG",
+    "quality": 90,
+}
+
+# Modes of images with more than 8 bits per channel, as decoded from e.g. 16-bit TIFFs
+HIGH_BIT_DEPTH_MODES = ("I;16", "I;16L", "I;16B", "I;16N", "I", "F")
+
+
+def largest_frame(image: Image.Image) -> None:
+    """Seeks a multi-page image to its largest frame.
+
+    TIFFs from archives often hold a full resolution scan along with reduced pages.
+
+    Args:
+        image: The opened image.
+
+    Returns:
+        None.
+    """
+    sizes = []
+    for index in range(getattr(image, "n_frames", 1)):
+        image.seek(index)
+        sizes.append((image.size[0] * image.size[1], -index))
+    image.seek(-max(sizes)[1])
+
+
+def to_rgb(image: Image.Image) -> Image.Image:
+    """Converts an image of any mode to 8-bit RGB.
+
+    High bit depth grayscale images are scaled down to 8 bits rather than clipped.
+
+    Args:
+        image: The decoded image.
+
+    Returns:
+        The RGB image.
+    """
+    if image.mode in HIGH_BIT_DEPTH_MODES:
+        array = np.asarray(image, dtype=np.float64)
+        peak = array.max() if array.size else 0
+        if peak > 255:
+            scale = 65535 if peak <= 65535 else peak
+            array = array * (255 / scale)
+        image = Image.fromarray(np.clip(array, 0, 255).round().astype(np.uint8), "L")
+    return image.convert("RGB")
+
+
+def _save(image: Image.Image, path: str, image_format: str, quality: int) -> str:
+    """Saves an image atomically.
+
+    Args:
+        image: The image to save.
+        path: The path to save the image to.
+        image_format: The Pillow format to save the image in.
+        quality: The encoding quality.
+
+    Returns:
+        The SHA-256 digest of the saved file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.part"
+    with open(tmp_path, "wb") as file:
+        image.save(file, format=image_format, quality=quality)
+    with open(tmp_path, "rb") as file:
+        sha256 = hashlib.sha256(file.read()).hexdigest()
+    os.replace(tmp_path, path)
+    return sha256
+
+
+def derive_image(
+    file_path: str,
+    path: str,
+    thumbnail_path: str,
+    size: int,
+    thumbnail_size: int,
+    image_format: str,
+    quality: int,
+) -> Dict[str, Any]:
+    """Decodes an image once and writes its resized version and thumbnail.
+
+    The shorter side of the resized image is `size` pixels; smaller images are not
+    upscaled. Runs in worker processes, so it only takes and returns plain values.
+
+    Args:
+        file_path: The path of the downloaded image.
+        path: The path to write the resized image to.
+        thumbnail_path: The path to write the thumbnail to.
+        size: The length of the shorter side of the resized image.
+        thumbnail_size: The length of the longer side of the thumbnail.
+        image_format: The Pillow format of the output files.
+        quality: The encoding quality of the output files.
+
+    Returns:
+        A dictionary with the `width`, `height` and `sha256` of the resized image.
+    """
+    with Image.open(file_path) as image:
+        largest_frame(image)
+        scale = min(1.0, size / min(image.size))
+        # Lets the JPEG decoder skip detail that would be discarded by the resize
+        image.draft(
+            "RGB", (math.ceil(image.size[0] * scale), math.ceil(image.size[1] * scale))
+        )
+        image = ImageOps.exif_transpose(to_rgb(image))
+    scale = size / min(image.size)
+    if scale < 1:
+        image = image.resize(
+            (round(image.size[0] * scale), round(image.size[1] * scale)),
+            Image.Resampling.LANCZOS,
+        )
+    width, height = image.size
+    sha256 = _save(image, path, image_format, quality)
+    image.thumbnail((thumbnail_size, thumbnail_size))
+    _save(image, thumbnail_path, image_format, quality)
+    return {"width": width, "height": height, "sha256": sha256}
+
+
+class ImageDeriver:
+    """Derives resized training images and thumbnails from downloaded images.
+
+    Decoding and resizing are CPU bound, so they run in a process pool. Images whose
+    derivative was made from the file currently stored for them are skipped.
+
+    Attributes:
+        config: The configuration data.
+        database: The database with the downloaded images.
+        derive_config: The `derive` section of the configuration, with defaults.
+    """
+
+    def __init__(self, config: dict, database: Database) -> None:
+        """Initializes the image deriver.
+
+        Args:
+            config: The configuration data.
+            database: The database with the downloaded images.
+        """
+        self.config = config
+        self.database = database
+        self.derive_config = {**DEFAULT_DERIVE_CONFIG, **config.get("derive", {})}
+        self.derive_config["format"] = self.derive_config["format"].upper()
+
+    def _paths(self, medium: str, source: str, id: str) -> Tuple[str, str]:
+        """Returns the paths of the resized image and thumbnail of an image.
+
+        Args:
+            medium: The medium of the image.
+            source: The source of the image.
+            id: The ID of the image.
+
+        Returns:
+            A tuple with the path of the resized image and of the thumbnail.
+        """
+        name = f"{source}_{id}{FORMATS[self.derive_config['format']]}"
+        return (
+            os.path.join(self.config["dir"]["crop"], medium, name),
+            os.path.join(self.config["dir"]["thumbnail"], medium, name),
+        )
+
+    def _derive_medium(
+        self,
+        executor: ProcessPoolExecutor,
+        medium: str,
+        batch_size: int,
+        force: bool,
+    ) -> int:
+        """Derives the pending images of a medium.
+
+        Args:
+            executor: The process pool deriving the images.
+            medium: The medium of the images.
+            batch_size: The number of images claimed and recorded at once.
+            force: Whether to derive images whose derivative is up to date.
+
+        Returns:
+            The number of images derived.
+        """
+        derived = 0
+        cursor = 0
+        while True:
+            batch = self.database.claim_derivations(medium, batch_size, cursor, force)
+            if not batch:
+                return derived
+            cursor = batch[-1][0]
+            futures: Dict[Future, Dict[str, Any]] = {}
+            for _, source, id, sha256, file_path in batch:
+                path, thumbnail_path = self._paths(medium, source, id)
+                future = executor.submit(
+                    derive_image,
+                    file_path,
+                    path,
+                    thumbnail_path,
+                    self.derive_config["size"],
+                    self.derive_config["thumbnail_size"],
+                    self.derive_config["format"],
+                    self.derive_config["quality"],
+                )
+                futures[future] = {
+                    "source": source,
+                    "id": id,
+                    "source_sha256": sha256,
+                    "path": path,
+                    "thumbnail_path": thumbnail_path,
+                }
+            derivatives: List[Dict[str, Any]] = []
+            for future in as_completed(futures):
+                derivative = futures[future]
+                try:
+                    derivatives.append({**derivative, **future.result()})
+                except Exception as e:
+                    logger.error(
+                        f"An exception {str(e)} of type {type(e).__name__} occurred while deriving image {derivative['source']}_{derivative['id']}."
+                    )
+            self.database.save_derivatives(derivatives)
+            derived += len(derivatives)
+
+    def derive_images(
+        self,
+        batch_size: int = 100,
+        workers: Union[int, None] = None,
+        force: bool = False,
+    ) -> int:
+        """Derives resized images and thumbnails for all downloaded images of the allowed mediums.
+
+        Args:
+            batch_size: The number of images claimed and recorded at once.
+            workers: The number of worker processes. Defaults to `derive.workers` in the
+                configuration, or the number of CPUs.
+            force: Whether to derive images whose derivative is up to date.
+
+        Returns:
+            The number of images derived.
+        """
+        workers = workers or self.derive_config.get("workers") or os.cpu_count()
+        derived = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for medium in self.config["allowed_processes"]:
+                logger.info(f"Deriving images for medium {medium}")
+                derived += self._derive_medium(executor, medium, batch_size, force)
+        logger.info(f"Derived {derived} images")
+        return derived
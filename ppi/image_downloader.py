@@ -1,87 +1,535 @@
-import requests
+import contextlib
+import hashlib
+import io
+import json
+import mimetypes
 import os
-import shutil
+import re
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, List, Tuple, Union
+from urllib.parse import urlparse
+import requests
 from ppi.database import Database, DBAction, DBActionStatus
+from ppi.http_client import HttpClient
+from ppi.image_store import ImageStore, file_sha256
+from ppi.perceptual_hash import PerceptualHashIndex, file_hashes
 from loguru import logger
 
 """Class for downloading images into disk"""
 
 
+# Extensions preferred over the ones `mimetypes` returns first
+EXTENSIONS = {"image/jpeg": ".jpg", "image/tiff": ".tif"}
+
+# Longer side, in pixels, of the preview hashed to detect duplicates before downloading
+PREVIEW_SIZE = 128
+
+
+class DuplicateImageError(Exception):
+    """Raised when an image is a near-duplicate of an image already in the index."""
+
+
 class ImageDownloader:
     """Downloads images from a database with urls to disk.
 
     Attributes:
         config: The configuration for the image downloader.
         database: The database to download images from.
+        http_client: The HTTP client shared by crawlers and downloaders.
+        image_store: The content-addressed store holding the downloaded files.
+        hash_index: The perceptual hashes of the downloaded images.
     """
 
-    def __init__(self, config: dict, database: Database) -> None:
+    def __init__(
+        self,
+        config: dict,
+        database: Database,
+        http_client: Union[HttpClient, None] = None,
+    ) -> None:
         self.config = config
         self.database = database
+        self.http_client = http_client or HttpClient(config)
+        self.image_store = ImageStore(config, database)
+        self.hash_index = PerceptualHashIndex(config, database)
+        self._host_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_semaphores_lock = threading.Lock()
+
+    def _extension(self, url: str, content_type: Union[str, None]) -> str:
+        """Returns the file extension for a downloaded image.
+
+        Only image mimetypes of the `Content-Type` are trusted, otherwise the extension
+        of the URL is used.
+
+        Args:
+            url: The URL of the image.
+            content_type: The `Content-Type` header of the response.
 
-    def _download_url(self, url: str, path: str) -> None:
+        Returns:
+            The extension, including the leading dot.
+        """
+        mimetype = (content_type or "").split(";")[0].strip().lower()
+        if mimetype in EXTENSIONS:
+            return EXTENSIONS[mimetype]
+        if mimetype.startswith("image/"):
+            ext = mimetypes.guess_extension(mimetype)
+            if ext:
+                return ext
+        # Generic types like application/octet-stream say nothing about the image
+        return "." + urlparse(url).path.split(".")[-1]
+
+    def _download_url(self, url: str, path: str) -> Tuple[str, str]:
         """Downloads an image from the given URL to the given path.
 
+        The body is streamed in chunks to a `.part` file, which is renamed into place only
+        once its size matches `Content-Length`. An existing `.part` file from an interrupted
+        download is resumed with an HTTP `Range` request, and deleted to start over if it
+        is larger than the image. The URL, ETag and Last-Modified of the partial download
+        are kept in a `.part.json` file next to it: a `.part` file downloaded from another
+        URL is deleted, and resumes send `If-Range` so that the server returns the whole
+        image if it changed. The file extension is taken from the `Content-Type` of the
+        response, see `_extension`. The SHA-256 digest of the file is computed while it
+        is received.
+
         Args:
             url: The URL of the image to download.
+            path: The path to save the image to, without extension.
+
+        Returns:
+            A tuple with the path and the SHA-256 digest of the downloaded file.
+
+        Raises:
+            requests.HTTPError: If the server did not return the image.
+            IOError: If the transfer ended before the whole image was received, or
+                more than the whole image was received.
+        """
+        part_path = f"{path}.part"
+        source = self._part_source(part_path)
+        if source.get("url") != url:  # Missing, or a partial download of another URL
+            self._remove_part(part_path)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = None
+        if offset:
+            headers = {"Range": f"bytes={offset}-"}
+            validator = source.get("etag") or source.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+        with self.http_client.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 416:  # Stale .part file, start over
+                self._remove_part(part_path)
+                return self._download_url(url, path)
+            response.raise_for_status()
+            content_range = re.match(
+                r"bytes ([0-9]+)-[0-9]*/([0-9]+)?",
+                response.headers.get("Content-Range", ""),
+            )
+            if response.status_code == 206 and content_range:
+                total = content_range.group(2)
+                if total is not None and offset >= int(total):
+                    # The .part file is as large as the image or larger, start over
+                    response.close()
+                    self._remove_part(part_path)
+                    return self._download_url(url, path)
+                if int(content_range.group(1)) != offset:
+                    raise IOError(
+                        f"Unexpected range {content_range.group(0)} for {url}"
+                    )
+                mode = "ab"
+                sha256 = file_sha256(part_path)
+            else:
+                offset, mode = 0, "wb"
+                sha256 = hashlib.sha256()
+                self._save_part_source(part_path, url, response)
+            expected_size = None
+            if "Content-Length" in response.headers and (
+                "Content-Encoding" not in response.headers
+            ):
+                expected_size = offset + int(response.headers["Content-Length"])
+            chunk_size = self.config.get("download", {}).get("chunk_size", 1048576)
+            with open(part_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    file.write(chunk)
+                    sha256.update(chunk)
+            content_type = response.headers.get("Content-Type")
+        size = os.path.getsize(part_path)
+        if expected_size is not None and size > expected_size:
+            self._remove_part(part_path)  # Cannot be resumed, start over next time
+            raise IOError(f"Received {size} of {expected_size} bytes for {url}")
+        if expected_size is not None and size != expected_size:
+            raise IOError(
+                f"Received {size} of {expected_size} bytes for {url}, will resume later"
+            )
+        file_path = path + self._extension(url, content_type)
+        os.replace(part_path, file_path)
+        self._remove_part(part_path)
+        return file_path, sha256.hexdigest()
+
+    @staticmethod
+    def _part_source(part_path: str) -> Dict[str, str]:
+        """Reads where a partial download came from.
+
+        Args:
+            part_path: The path of the `.part` file.
+
+        Returns:
+            The `url`, `etag` and `last_modified` of the partial download, or an empty
+            dictionary if they were not recorded.
+        """
+        try:
+            with open(f"{part_path}.json") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_part_source(
+        part_path: str, url: str, response: requests.Response
+    ) -> None:
+        """Records where a partial download comes from, before its body is written.
+
+        Args:
+            part_path: The path of the `.part` file.
+            url: The URL being downloaded.
+            response: The response whose body is written to the `.part` file.
+
+        Returns:
+            None.
+        """
+        etag = response.headers.get("ETag")
+        source = {
+            "url": url,
+            # Weak ETags cannot be used in If-Range
+            "etag": etag if etag and not etag.startswith("W/") else None,
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        with open(f"{part_path}.json", "w") as file:
+            json.dump(source, file)
+
+    @staticmethod
+    def _remove_part(part_path: str) -> None:
+        """Deletes a partial download, if any, and its source.
+
+        Args:
+            part_path: The path of the `.part` file.
+
+        Returns:
+            None.
+        """
+        for file_path in [part_path, f"{part_path}.json"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file_path)
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        """Returns the semaphore limiting concurrent downloads from the host of a URL.
+
+        Args:
+            url: The URL to be downloaded.
+
+        Returns:
+            The semaphore of the host.
+        """
+        host = urlparse(url).netloc
+        with self._host_semaphores_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.config.get("download", {}).get("max_connections_per_host", 4)
+                )
+            return self._host_semaphores[host]
+
+    def _preview_url(self, variants: List[Dict[str, Any]]) -> Union[str, None]:
+        """Selects a small rendering of an image to hash before downloading it.
+
+        Args:
+            variants: The variants of the image, see `Database.get_variants`.
+
+        Returns:
+            The URL of the smallest variant of known size that can still be hashed, or of
+            a `PREVIEW_SIZE` rendering of an IIIF image service, or None if there is none.
+        """
+        sized = [
+            variant
+            for variant in variants
+            if variant["kind"] == "file"
+            and variant["width"]
+            and variant["height"]
+            and min(variant["width"], variant["height"]) >= 32
+        ]
+        if sized:
+            return min(sized, key=lambda variant: variant["width"] * variant["height"])[
+                "url"
+            ]
+        for variant in variants:
+            if variant["kind"] == "iiif":
+                return f"{variant['url']}/full/!{PREVIEW_SIZE},{PREVIEW_SIZE}/0/default.jpg"
+        return None
+
+    def _preview_hashes(
+        self, source: str, id: str, variants: List[Dict[str, Any]]
+    ) -> Union[Tuple[int, int], None]:
+        """Hashes a preview of an image, and checks it against the images already indexed.
+
+        Args:
+            source: The source of the image.
+            id: The ID of the image.
+            variants: The variants of the image, see `Database.get_variants`.
+
+        Returns:
+            A tuple with the pHash and dHash of the preview, or None if no preview could
+            be hashed.
+
+        Raises:
+            DuplicateImageError: If the image is a near-duplicate of an indexed image.
+        """
+        preview_url = self._preview_url(variants)
+        if not preview_url:
+            return None
+        try:
+            with self._host_semaphore(preview_url):
+                response = self.http_client.get(preview_url)
+            response.raise_for_status()
+            hashes = file_hashes(io.BytesIO(response.content))
+        except Exception as e:
+            logger.warning(
+                f"An exception {str(e)} of type {type(e).__name__} occurred while hashing preview {preview_url}."
+            )
+            return None
+        match = self.hash_index.find(*hashes, source, id)
+        if match:
+            self.hash_index.add(source, id, *hashes)
+            raise DuplicateImageError(
+                f"{source}_{id} is a near-duplicate of {match[0]}_{match[1]}"
+            )
+        return hashes
+
+    def _download(
+        self,
+        source: str,
+        id: str,
+        url: str,
+        variants: List[Dict[str, Any]],
+        path: str,
+    ) -> Tuple[str, str, int, str]:
+        """Downloads the selected variant of an image, within the limit of its host.
+
+        Unless `download.skip_duplicates` is false, a preview of the image is hashed first
+        and the download is skipped if it is a near-duplicate of an indexed image. The
+        downloaded file is moved into the image store and linked back to its path, and
+        its perceptual hashes are added to the index.
+
+        Args:
+            source: The source of the image.
+            id: The ID of the image.
+            url: The URL of the image as stored in the database.
+            variants: The variants of the image, see `Database.get_variants`.
             path: The path to save the image to.
+
+        Returns:
+            A tuple with the path, SHA-256 digest, size and path in the store of the file.
+
+        Raises:
+            DuplicateImageError: If the image is a near-duplicate of an indexed image.
         """
+        hashes = None
+        if self.config.get("download", {}).get("skip_duplicates", True):
+            hashes = self._preview_hashes(source, id, variants)
+        download_url = self._select_url(url, variants)
+        with self._host_semaphore(download_url):
+            logger.info(f"Downloading: {download_url}")
+            file_path, sha256 = self._download_url(url=download_url, path=path)
+        blob_path = self.image_store.add(file_path, sha256)
         try:
-            response = requests.get(url)
-            ext = url.split(".")[-1]
-            with open(f"{path}.{ext}", "wb") as file:
-                file.write(response.content)
+            self.hash_index.add(source, id, *(hashes or file_hashes(file_path)))
         except Exception as e:
-            logger.error(
-                f"An exception {str(e)} of type {type(e).__name__} occurred while downloading image {url}."
+            logger.warning(
+                f"An exception {str(e)} of type {type(e).__name__} occurred while hashing image {file_path}."
             )
+        return file_path, sha256, os.path.getsize(blob_path), blob_path
 
-    def download_images(self, max_number_downloads: int = 250) -> None:
-        """Downloads all images in the database to disk.
+    def _iiif_url(self, service_url: str, target_resolution: int) -> str:
+        """Returns the URL of the smallest rendering of an IIIF image that meets the target resolution.
 
         Args:
+            service_url: The base URL of the IIIF image service of the image.
+            target_resolution: The minimum size of the shorter side of the image.
+
+        Returns:
+            The URL of the rendering.
+        """
+        response = self.http_client.get(f"{service_url}/info.json", cache=True)
+        response.raise_for_status()
+        info = response.json()
+        width, height = info["width"], info["height"]
+        if min(width, height) <= target_resolution:
+            size = "max" if "image/3" in str(info.get("@context")) else "full"
+        elif width <= height:
+            size = f"{target_resolution},"
+        else:
+            size = f",{target_resolution}"
+        return f"{service_url}/full/{size}/0/default.jpg"
+
+    def _select_url(self, url: str, variants: List[Dict[str, Any]]) -> str:
+        """Selects the smallest variant of an image that meets the target resolution.
+
+        The target resolution is the minimum size of the shorter side of the image, set
+        by `download.target_resolution` in the configuration. Variants of known size are
+        preferred, then renderings of an IIIF image service; the original URL is used when
+        no variant qualifies or no target is set.
+
+        Args:
+            url: The URL of the image as stored in the database, usually the master file.
+            variants: The variants of the image, see `Database.get_variants`.
+
+        Returns:
+            The URL to download.
+        """
+        target_resolution = self.config.get("download", {}).get("target_resolution")
+        if not target_resolution:
+            return url
+        sized = [
+            variant
+            for variant in variants
+            if variant["kind"] == "file"
+            and variant["width"]
+            and variant["height"]
+            and min(variant["width"], variant["height"]) >= target_resolution
+        ]
+        if sized:
+            return min(sized, key=lambda variant: variant["width"] * variant["height"])[
+                "url"
+            ]
+        for variant in variants:
+            if variant["kind"] == "iiif":
+                try:
+                    return self._iiif_url(variant["url"], target_resolution)
+                except Exception as e:
+                    logger.warning(
+                        f"An exception {str(e)} of type {type(e).__name__} occurred while reading IIIF service {variant['url']}."
+                    )
+        return url
+
+    def _download_medium(
+        self,
+        executor: ThreadPoolExecutor,
+        workers: int,
+        medium: str,
+        max_number_downloads: int,
+        batch_size: int,
+        retry_failed: bool,
+    ) -> int:
+        """Downloads the pending images of a medium concurrently.
+
+        Images are claimed from the download queue in batches, and only as many downloads
+        are in flight as can still count towards `max_number_downloads`. Outcomes are
+        logged from the calling thread as downloads complete.
+
+        Args:
+            executor: The thread pool running the downloads.
+            workers: The number of threads of the pool.
+            medium: The medium of the images to download.
             max_number_downloads: The maximum number of images to download.
+            batch_size: The number of images claimed from the download queue at once.
+            retry_failed: Whether to retry images whose download failed before.
+
+        Returns:
+            The number of images downloaded.
         """
-        for medium in self.config["allowed_processes"]:
-            logger.info(f"Downloading images for medium {medium}")
-            download_dir = os.path.join(self.config["dir"]["download"], medium)
-            os.makedirs(download_dir, exist_ok=True)
-            result = self.database.get_next_image_download(medium)
-            i = 0
-            while result:
-                source, id, url = result
-                if i <= max_number_downloads:
-                    file_path = os.path.join(download_dir, f"{source}_{id}")
-                    logger.info(f"Downloading: {url}")
-                    try:
-                        self._download_url(url=url, path=file_path)
-                        self.database.write_log(
-                            "", DBAction.DOWNLOAD, DBActionStatus.SUCCESS, url
-                        )
-                        i += 1
-                    except Exception as e:
-                        logger.error(
-                            f"An exception {str(e)} of type {type(e).__name__} occurred while downloading image {url}."
-                        )
-                        self.database.write_log(
-                            "", DBAction.DOWNLOAD, DBActionStatus.SUCCESS, url
+        download_dir = os.path.join(self.config["dir"]["download"], medium)
+        os.makedirs(download_dir, exist_ok=True)
+        pending: Deque[Tuple[str, str, str, List[Dict[str, Any]]]] = deque()
+        in_flight: Dict[Future, Tuple[str, str, str]] = {}
+        cursor = 0
+        exhausted = False
+        downloaded = 0
+        while True:
+            if not pending and not exhausted:
+                batch = self.database.claim_downloads(
+                    medium, batch_size, cursor, retry_failed
+                )
+                if batch:
+                    cursor = batch[-1][0]
+                    variants = self.database.get_variants(
+                        [(source, id) for _, source, id, _ in batch]
+                    )
+                    for _, source, id, url in batch:
+                        pending.append(
+                            (source, id, url, variants.get((source, id), []))
                         )
-                    result = self.database.get_next_image_download(medium)
                 else:
+                    exhausted = True
+            while (
+                pending
+                and len(in_flight) < workers
+                and downloaded + len(in_flight) < max_number_downloads
+            ):
+                source, id, url, image_variants = pending.popleft()
+                file_path = os.path.join(download_dir, f"{source}_{id}")
+                future = executor.submit(
+                    self._download, source, id, url, image_variants, file_path
+                )
+                in_flight[future] = (source, id, url)
+            if not in_flight:
+                if pending or exhausted or downloaded >= max_number_downloads:
                     break
-            logger.info(
-                "No more images to download"
-                if i < max_number_downloads
-                else "Maximum number of images downloaded"
-            )
+                continue
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, id, url = in_flight.pop(future)
+                try:
+                    file_path, sha256, size, blob_path = future.result()
+                    self.database.save_image_file(
+                        source, id, sha256, size, blob_path, file_path
+                    )
+                    status = DBActionStatus.SUCCESS
+                    downloaded += 1
+                except DuplicateImageError as e:
+                    logger.info(f"Skipping download: {str(e)}")
+                    status = DBActionStatus.DUPLICATE
+                except Exception as e:
+                    logger.error(
+                        f"An exception {str(e)} of type {type(e).__name__} occurred while downloading image {url}."
+                    )
+                    status = DBActionStatus.FAILURE
+                self.database.write_log("", DBAction.DOWNLOAD, status, url)
+        return downloaded
+
+    def download_images(
+        self,
+        max_number_downloads: int = 250,
+        batch_size: int = 100,
+        workers: Union[int, None] = None,
+        retry_failed: bool = False,
+    ) -> None:
+        """Downloads all images in the database to disk, and backs up the new ones.
+
+        Args:
+            max_number_downloads: The maximum number of images to download per medium.
+            batch_size: The number of images claimed from the download queue at once.
+            workers: The number of concurrent downloads. Defaults to `download.workers`
+                in the configuration, or 1.
+            retry_failed: Whether to retry images whose download failed before, resuming
+                interrupted transfers.
+        """
+        if workers is None:
+            workers = self.config.get("download", {}).get("workers", 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for medium in self.config["allowed_processes"]:
+                logger.info(f"Downloading images for medium {medium}")
+                downloaded = self._download_medium(
+                    executor,
+                    workers,
+                    medium,
+                    max_number_downloads,
+                    batch_size,
+                    retry_failed,
+                )
+                self.hash_index.flush()
+                logger.info(
+                    "No more images to download"
+                    if downloaded < max_number_downloads
+                    else "Maximum number of images downloaded"
+                )
+        self.database.flush_log()
         logger.info("Backing up images")
-        backup_dir = os.path.join(self.config["dir"]["backup"])
-        os.makedirs(backup_dir, exist_ok=True)
-        for medium in self.config["allowed_processes"]:
-            download_dir = os.path.join(self.config["dir"]["download"], medium)
-            for file in os.listdir(download_dir):
-                source_file_path = os.path.join(download_dir, file)
-                destination_file_path = os.path.join(self.config["dir"]["backup"], file)
-                if not os.path.exists(destination_file_path):
-                    shutil.copy(source_file_path, destination_file_path)
-        logger.info("Back up completed")
+        backed_up = self.image_store.backup()
+        logger.info(f"Back up completed, {backed_up} new images")
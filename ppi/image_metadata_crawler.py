@@ -1,30 +1,51 @@
-import requests
-from bs4 import BeautifulSoup
 from abc import ABC, abstractmethod
-import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 import pandas as pd
 import re
+import json
+from urllib.parse import urlparse
 from ppi.database import Database
-from typing import List
+from typing import Any, Callable, Dict, List, Set, Tuple, Union
 from ppi.database import DBAction, DBActionStatus
-
+from ppi.html_extraction import extract_head, extract_links
+from ppi.processed_url_index import ProcessedUrlIndex
+from ppi.http_client import HttpClient
 
 """Classes for crawling the web for image metadata"""
 
 
+# Mimetypes given to the TIFF masters linked from item pages
+TIFF_MIMETYPES = ["image/tif", "image/tiff"]
+
+# Image metadata, optionally along with the size variants of the image
+ImgMetadata = Union[pd.DataFrame, Tuple[pd.DataFrame, pd.DataFrame]]
+
+
 class ImageMetadataCrawler(ABC):
     """An abstract class for crawling image metadata from the web.
 
+    Subclasses supply the parsing logic in `_parse_img_metadata`, and can override
+    `_parse_links_img_url`; fetching, deduplication and logging are shared by the
+    sequential and the asynchronous crawl modes.
+
     Attributes:
         config: The configuration data.
         database: The database to store the extracted image metadata in.
         regex_for_image_links: A regular expression to match image URLs.
         medium: The medium of the images to crawl.
+        url_index: The in-memory index of processed pages and images.
+        reparse: Whether the current crawl processes logged pages and images again.
+        http_client: The HTTP client shared by crawlers and downloaders.
     """
 
     def __init__(
-        self, config: dict, database: Database, regex_for_image_links: str
+        self,
+        config: dict,
+        database: Database,
+        regex_for_image_links: str,
+        http_client: Union[HttpClient, None] = None,
     ) -> None:
         """Extracts image metadata from the given URL.
 
@@ -41,15 +62,52 @@ class ImageMetadataCrawler(ABC):
         self.config = config
         self.database = database
         self.regex_for_image_links: str = regex_for_image_links
+        self._image_links_pattern = re.compile(regex_for_image_links)
         self.medium = None
+        self.url_index: Union[ProcessedUrlIndex, None] = None
+        self.reparse = False
+        self.http_client = http_client or HttpClient(config)
+
+    def _fetch(self, url: str) -> str:
+        """Fetches a page, through the response cache if enabled.
+
+        Args:
+            url: The URL of the page.
+
+        Returns:
+            The text of the page.
+        """
+        response = self.http_client.get(url, cache=True)
+        return response.text
 
     @abstractmethod
-    def _get_img_metadata(self, url: str) -> pd.DataFrame:
+    def _parse_img_metadata(self, url: str, html: str) -> ImgMetadata:
         """
-        Receives a image URL and returns data frame with corresponding data.
+        Receives a image URL and its page and returns data frame with corresponding data.
+        Crawlers that know the size variants of the image return them as a second data
+        frame with the `source`, `id`, `url`, `kind`, `mimetype`, `width` and `height` of
+        each variant.
         """
         pass
 
+    def _get_img_metadata(self, url: str) -> ImgMetadata:
+        """
+        Receives a image URL and returns data frame with corresponding data.
+        """
+        return self._parse_img_metadata(url, self._fetch(url))
+
+    def _parse_links_img_url(self, html: str) -> List[str]:
+        """
+        Receives a search page and returns all associated image URLs.
+
+        Args:
+            html: The text of the search page.
+
+        Returns:
+            A list of image URLs.
+        """
+        return extract_links(html, self._image_links_pattern)
+
     def _get_links_img_url(self, url: str) -> List[str]:
         """
         Receives a search URL and returns all associated image URLs.
@@ -60,15 +118,111 @@ class ImageMetadataCrawler(ABC):
         Returns:
             A list of image URLs.
         """
-        response = requests.get(url)
-        link_elements = BeautifulSoup(response.text, "html.parser").findAll(
-            "a", attrs={"href": re.compile(self.regex_for_image_links)}
+        return self._parse_links_img_url(self._fetch(url))
+
+    def _start_crawl(
+        self, prefix_url_search: str, reparse: Union[bool, None] = None
+    ) -> None:
+        """Sets the medium of the crawl and loads the processed URL index.
+
+        Args:
+            prefix_url_search: The base URL for searching images.
+            reparse: Whether to process the pages and images logged by earlier crawls
+                again. Defaults to `crawler.reparse` in the configuration, or False.
+
+        Returns:
+            None
+        """
+        for medium in self.config["allowed_processes"]:
+            if medium in prefix_url_search.upper():  # Search for Medium in link
+                self.medium = medium
+        if reparse is None:
+            reparse = self.config.get("crawler", {}).get("reparse", False)
+        self.reparse = reparse
+        if self.url_index is None or reparse or self.url_index.ignore_log:
+            if self.url_index is not None:
+                self.database.unregister_url_index(self.url_index)
+            # When re-parsing, only the URLs processed by this crawl are skipped
+            self.url_index = ProcessedUrlIndex(
+                self.database,
+                [DBAction.PAGE_PROCESS, DBAction.IMAGE_PROCESS],
+                ignore_log=reparse,
+            )
+
+    def _save_img_metadata(
+        self, link: str, get_img_metadata: Callable[[], ImgMetadata]
+    ) -> bool:
+        """
+        Stores the metadata of an image in the database and logs the outcome.
+
+        When re-parsing, the metadata stored for the image before is replaced.
+
+        Args:
+            link: The image URL.
+            get_img_metadata: A function returning the image metadata, and optionally its variants.
+
+        Returns:
+            True if the metadata was stored, False otherwise.
+        """
+        try:
+            img_metadata = get_img_metadata()
+            variants = None
+            if isinstance(img_metadata, tuple):
+                img_metadata, variants = img_metadata
+            if self.reparse:
+                self.database.replace_image_metadata(img_metadata, variants)
+            else:
+                if variants is not None and len(variants) > 0:
+                    self.database.save_data(variants, "image_variants")
+                self.database.save_data(img_metadata, "images")
+            self.database.write_log(
+                self.__class__.__name__,
+                DBAction.IMAGE_PROCESS,
+                DBActionStatus.SUCCESS,
+                link,
+            )
+            logger.info(f"Added image metadata: {link}")
+            return True
+        except Exception as e:
+            logger.error(
+                f"An exception of type {type(e).__name__} occurred: {str(e)} while getting image metadata {link}."
+            )
+            # Keep error info to try later
+            self.database.write_log(
+                self.__class__.__name__,
+                DBAction.IMAGE_PROCESS,
+                DBActionStatus.FAILURE,
+                link,
+            )
+            return False
+
+    def _save_page(self, url: str, results: List[bool]) -> None:
+        """
+        Logs a processed search page along with the outcome of its images.
+
+        Args:
+            url: The search URL.
+            results: Whether the metadata of each new image on the page was stored.
+
+        Returns:
+            None
+        """
+        logger.info(f"{str(results.count(True))} entries added to DB")
+        logger.info(f"Failed to insert data for {str(results.count(False))} images")
+        self.database.write_log(
+            self.__class__.__name__,
+            DBAction.PAGE_PROCESS,
+            DBActionStatus.SUCCESS,
+            url,
         )
-        links = [link_element["href"] for link_element in link_elements]
-        return list(set(links))
+        self.database.flush_log()
 
     def save_pages_img_url_metadata(
-        self, prefix_url_search: str, first_page: int, last_page: int
+        self,
+        prefix_url_search: str,
+        first_page: int,
+        last_page: int,
+        reparse: Union[bool, None] = None,
     ) -> None:
         """
         Scans a range of search URLs for image URLs, retrieves image metadata, and stores it in the database.
@@ -77,59 +231,130 @@ class ImageMetadataCrawler(ABC):
             prefix_url_search: The base URL for searching images.
             first_page: The first page number to start scanning from.
             last_page: The last page number to scan up to.
+            reparse: Whether to process the pages and images logged by earlier crawls
+                again, e.g. to re-parse a crawl from the response cache in `replay` mode.
+                Defaults to `crawler.reparse` in the configuration, or False.
 
         Returns:
             None
         """
-        for medium in self.config["allowed_processes"]:
-            if medium in prefix_url_search.upper():  # Search for Medium in link
-                self.medium = medium
+        self._start_crawl(prefix_url_search, reparse)
         for i in range(first_page, last_page + 1):
             url = prefix_url_search + str(i)
-            if not self.database.check_log(DBAction.PAGE_PROCESS, url):
+            if not self.url_index.contains(DBAction.PAGE_PROCESS, url):
                 logger.info("Processing page " + url)
                 links = self._get_links_img_url(url)
-                num_successes = 0
-                num_errors = 0
+                results = []
                 for link in links:
-                    if not self.database.check_log(DBAction.IMAGE_PROCESS, link):
-                        try:
-                            self.database.save_data(
-                                self._get_img_metadata(link), "images"
-                            )
-                            self.database.write_log(
-                                self.__class__.__name__,
-                                DBAction.IMAGE_PROCESS,
-                                DBActionStatus.SUCCESS,
-                                link,
-                            )
-                            logger.info(f"Added image metadata: {link}")
-                            num_successes += 1
-                        except Exception as e:
-                            logger.error(
-                                f"An exception of type {type(e).__name__} occurred: {str(e)} while getting image metadata {link}."
+                    if not self.url_index.contains(DBAction.IMAGE_PROCESS, link):
+                        results.append(
+                            self._save_img_metadata(
+                                link, lambda: self._get_img_metadata(link)
                             )
-                            # Keep error info to try later
-                            self.database.write_log(
-                                self.__class__.__name__,
-                                DBAction.IMAGE_PROCESS,
-                                DBActionStatus.FAILURE,
-                                link,
-                            )
-                            num_errors += 1
+                        )
                     else:
                         logger.info(f"Image {link} already processed")
-                logger.info(f"{str(num_successes)} entries added to DB")
-                logger.info(
-                    f"Failed to insert data for {str(num_errors)} images")
-                self.database.write_log(
-                    self.__class__.__name__,
-                    DBAction.PAGE_PROCESS,
-                    DBActionStatus.SUCCESS,
-                    url,
-                )
+                self._save_page(url, results)
             else:
                 logger.warning("Page " + url + " already processed")
+        logger.info(f"Processed URL index: {self.url_index.stats()}")
+
+    async def save_pages_img_url_metadata_async(
+        self,
+        prefix_url_search: str,
+        first_page: int,
+        last_page: int,
+        concurrency_per_host: Union[int, None] = None,
+        reparse: Union[bool, None] = None,
+    ) -> None:
+        """
+        Scans a range of search URLs like `save_pages_img_url_metadata`, fetching search and image pages concurrently.
+
+        Pages are fetched in worker threads, with at most `concurrency_per_host` requests
+        in flight per host. Parsing, deduplication and logging run on the event loop, so
+        results go through the same checks and log as the sequential mode.
+
+        Args:
+            prefix_url_search: The base URL for searching images.
+            first_page: The first page number to start scanning from.
+            last_page: The last page number to scan up to.
+            concurrency_per_host: The maximum number of concurrent requests per host.
+                Defaults to `crawler.concurrency_per_host` in the configuration, or 4.
+            reparse: Whether to process the pages and images logged by earlier crawls
+                again, e.g. to re-parse a crawl from the response cache in `replay` mode.
+                Defaults to `crawler.reparse` in the configuration, or False.
+
+        Returns:
+            None
+        """
+        self._start_crawl(prefix_url_search, reparse)
+        crawler_config = self.config.get("crawler", {})
+        if concurrency_per_host is None:
+            concurrency_per_host = crawler_config.get("concurrency_per_host", 4)
+        loop = asyncio.get_running_loop()
+        semaphores: Dict[str, asyncio.Semaphore] = {}
+        links_in_progress: Set[str] = set()
+
+        with ThreadPoolExecutor(
+            max_workers=crawler_config.get("max_workers", 16)
+        ) as executor:
+
+            async def fetch(url: str) -> str:
+                host = urlparse(url).netloc
+                if host not in semaphores:
+                    semaphores[host] = asyncio.Semaphore(concurrency_per_host)
+                async with semaphores[host]:
+                    return await loop.run_in_executor(executor, self._fetch, url)
+
+            async def save_img_metadata(link: str) -> bool:
+                try:
+                    html = await fetch(link)
+                except Exception as e:
+                    error = e
+
+                    def get_img_metadata() -> ImgMetadata:
+                        raise error
+
+                else:
+
+                    def get_img_metadata() -> ImgMetadata:
+                        return self._parse_img_metadata(link, html)
+
+                return self._save_img_metadata(link, get_img_metadata)
+
+            async def save_page(url: str) -> None:
+                if self.url_index.contains(DBAction.PAGE_PROCESS, url):
+                    logger.warning("Page " + url + " already processed")
+                    return
+                logger.info("Processing page " + url)
+                try:
+                    links = self._parse_links_img_url(await fetch(url))
+                except Exception as e:
+                    logger.error(
+                        f"An exception of type {type(e).__name__} occurred: {str(e)} while getting page {url}."
+                    )
+                    return
+                new_links = []
+                for link in links:
+                    if self.url_index.contains(DBAction.IMAGE_PROCESS, link) or (
+                        link in links_in_progress
+                    ):
+                        logger.info(f"Image {link} already processed")
+                    else:
+                        links_in_progress.add(link)
+                        new_links.append(link)
+                results = await asyncio.gather(
+                    *(save_img_metadata(link) for link in new_links)
+                )
+                self._save_page(url, list(results))
+
+            await asyncio.gather(
+                *(
+                    save_page(prefix_url_search + str(i))
+                    for i in range(first_page, last_page + 1)
+                )
+            )
+        logger.info(f"Processed URL index: {self.url_index.stats()}")
 
 
 class LibraryOfCongressCrawler(ImageMetadataCrawler):
@@ -147,24 +372,30 @@ class LibraryOfCongressCrawler(ImageMetadataCrawler):
         config: dict,
         database: Database,
         regex_for_image_links: str = "^https://www.loc.gov/pictures/item/",
+        http_client: Union[HttpClient, None] = None,
     ) -> None:
         """Initializes the image metadata crawler.
         Args:
             config: The configuration data.
             database: The database to store the extracted image metadata in.
             regex_for_image_links: The regular expression used to identify image urls.
+            http_client: The HTTP client shared by crawlers and downloaders.
         """
         super().__init__(
             config=config,
             database=database,
             regex_for_image_links=regex_for_image_links,
+            http_client=http_client,
         )
 
-    def _get_img_metadata(self, url: str) -> pd.DataFrame:
-        """Extracts image metadata from the given URL.
+    def _parse_img_metadata(
+        self, url: str, html: str
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Extracts image metadata from the page of the given URL.
 
         Args:
             url: The URL of the image to extract metadata from.
+            html: The text of the image page.
 
         Returns:
             A Pandas DataFrame containing the following image metadata:
@@ -172,21 +403,13 @@ class LibraryOfCongressCrawler(ImageMetadataCrawler):
             * `id`: The ID of the image.
             * `url`: The URL of the image.
             * `medium`: The medium of the image.
+            And a Pandas DataFrame with the image files linked from the page, see `_variants_df`.
         """
-        time.sleep(1)  # For avoiding rate limits
-        response = requests.get(url)
-        soup_mediums = BeautifulSoup(response.text, "html.parser").find_all(
-            lambda tag: tag.name == "meta"
-            and tag.has_attr("name")
-            and tag["name"] in ["dc.format"]
-        )
-        medium = ",".join([tag["name"] for tag in soup_mediums])
-        soup_for_links = BeautifulSoup(response.text, "html.parser").find_all(
-            lambda tag: tag.name == "link"
-            and tag.has_attr("type")
-            and tag["type"] == "image/tif"
-        )
-        link = soup_for_links[0]["href"]
+        meta, links = extract_head(html)
+        medium = ",".join(meta.get("dc.format", []))
+        link = [link for link in links if link.get("type") == "image/tif"][0]["href"]
+        # Stored like the JSON mode does, so both modes agree and requests can fetch it
+        link = "https:" + link if link.startswith("//") else link
         # Get id from URL
         id_match = re.compile(r"/([0-9]+)").search(url)
         if id_match:
@@ -194,6 +417,24 @@ class LibraryOfCongressCrawler(ImageMetadataCrawler):
         else:
             logger.error("Could not find ID in URL {url}")
             raise ValueError
+        variants = [
+            (tag["href"], tag["type"], None, None)
+            for tag in links
+            if tag.get("type", "").startswith("image/") and tag.get("href")
+        ]
+        return self._img_metadata_df(id, link, medium), self._variants_df(id, variants)
+
+    def _img_metadata_df(self, id: str, link: str, medium: str) -> pd.DataFrame:
+        """Builds the image metadata stored in the database.
+
+        Args:
+            id: The ID of the image.
+            link: The URL of the image file.
+            medium: The medium given by the source.
+
+        Returns:
+            A Pandas DataFrame with the `source`, `id`, `url` and `medium` of the image.
+        """
         df = pd.DataFrame(
             [
                 {
@@ -205,13 +446,271 @@ class LibraryOfCongressCrawler(ImageMetadataCrawler):
             ]
         )
         if self.medium:
-            df[
-                "medium"
-            ] = (
+            df["medium"] = (
                 self.medium
             )  # We got the medium from the page link and this has priority
         return df
 
+    def _variants_df(
+        self,
+        id: str,
+        variants: List[Tuple[str, str, Union[int, None], Union[int, None]]],
+    ) -> pd.DataFrame:
+        """Builds the size variants of an image stored in the database.
+
+        Links into the IIIF image service of loc.gov are recorded once, as the service
+        base URL with kind `iiif`, since the service renders any size on request. Item
+        pages only link to files in the storage of tile.loc.gov, whose sizes are unknown,
+        so the IIIF services of these files are recorded instead, the one of the TIFF
+        master first, see `_iiif_service_url`.
+
+        Args:
+            id: The ID of the image.
+            variants: A list of tuples with the URL, mimetype, width and height of each
+                image file, where the size may be unknown.
+
+        Returns:
+            A Pandas DataFrame with the `source`, `id`, `url`, `kind`, `mimetype`, `width`
+            and `height` of each variant.
+        """
+        rows: Dict[str, Dict[str, Any]] = {}
+        for url, mimetype, width, height in variants:
+            url = "https:" + url if url.startswith("//") else url
+            iiif_match = re.compile(r"^(.*/image-services/iiif/[^/]+)/").search(url)
+            if iiif_match:
+                url, kind, mimetype, width, height = (
+                    iiif_match.group(1),
+                    "iiif",
+                    "image/jpeg",
+                    None,
+                    None,
+                )
+            else:
+                kind = "file"
+            rows.setdefault(
+                url,
+                {
+                    "source": self.__class__.__name__,
+                    "id": id,
+                    "url": url,
+                    "kind": kind,
+                    "mimetype": mimetype,
+                    "width": width,
+                    "height": height,
+                },
+            )
+        if not any(row["kind"] == "iiif" for row in rows.values()):
+            files = sorted(
+                rows.values(), key=lambda row: row["mimetype"] not in TIFF_MIMETYPES
+            )
+            for service in [self._iiif_service_url(row["url"]) for row in files]:
+                if service:
+                    rows.setdefault(
+                        service,
+                        {
+                            "source": self.__class__.__name__,
+                            "id": id,
+                            "url": service,
+                            "kind": "iiif",
+                            "mimetype": "image/jpeg",
+                            "width": None,
+                            "height": None,
+                        },
+                    )
+        return pd.DataFrame(
+            list(rows.values()),
+            columns=["source", "id", "url", "kind", "mimetype", "width", "height"],
+        )
+
+    @staticmethod
+    def _iiif_service_url(url: str) -> Union[str, None]:
+        """Returns the IIIF image service of a file in the storage of tile.loc.gov.
+
+        Services are named after the path of the file in the `service` storage, e.g.
+        `.../storage-services/service/pnp/cwpb/04300/04302v.jpg` is served by
+        `.../image-services/iiif/service:pnp:cwpb:04300:04302v`. Masters are looked up
+        under the same path in the `service` storage. A service that does not exist is
+        skipped by the downloader when its `info.json` cannot be read.
+
+        Args:
+            url: The URL of the image file.
+
+        Returns:
+            The base URL of the IIIF image service, or None if the file is not in the
+            storage of tile.loc.gov.
+        """
+        storage_match = re.compile(
+            r"^https?://tile\.loc\.gov/storage-services/(?:service|master)/"
+            r"(.+)\.(?:jpe?g|tiff?)$"
+        ).search(url)
+        if not storage_match:
+            return None
+        return (
+            "https://tile.loc.gov/image-services/iiif/service:"
+            + storage_match.group(1).replace("/", ":")
+        )
+
+    @staticmethod
+    def _json_result_id(result: Dict[str, Any]) -> str:
+        """Returns the ID of an item of a JSON search result.
+
+        Args:
+            result: The item, as returned by loc.gov with `fo=json`.
+
+        Returns:
+            The numeric ID of the item.
+        """
+        if result.get("pk"):
+            return str(result["pk"])
+        for key in ["id", "url"]:
+            id_match = re.compile(r"/([0-9]+)/?$").search(str(result.get(key, "")))
+            if id_match:
+                return id_match.group(1)
+        raise ValueError(f"Could not find ID in result {result.get('id')}")
+
+    @staticmethod
+    def _json_image_link(result: Dict[str, Any]) -> str:
+        """Returns the URL of the image file of an item of a JSON search result.
+
+        The TIFF master is used when the result links to one, as in the HTML mode,
+        otherwise the largest JPEG derivative.
+
+        Args:
+            result: The item, as returned by loc.gov with `fo=json`.
+
+        Returns:
+            The URL of the image file.
+        """
+        urls = re.findall(r'"((?:https?:)?//[^"]+)"', json.dumps(result))
+        tiffs = [url for url in urls if re.search(r"\.tiff?$", url)]
+        if tiffs:
+            link = tiffs[0]
+        elif result.get("image_url"):
+            # Derivatives are listed as ...jpg#h=<height>&w=<width>
+            link = max(
+                result["image_url"],
+                key=lambda url: int((re.findall(r"[#&]w=([0-9]+)", url) or [0])[0]),
+            ).split("#")[0]
+        elif isinstance(result.get("image"), dict) and result["image"].get("full"):
+            link = result["image"]["full"]
+        else:
+            raise ValueError(f"Could not find an image in result {result.get('id')}")
+        return "https:" + link if link.startswith("//") else link
+
+    @staticmethod
+    def _json_medium(result: Dict[str, Any]) -> str:
+        """Returns the medium of an item of a JSON search result.
+
+        Args:
+            result: The item, as returned by loc.gov with `fo=json`.
+
+        Returns:
+            The medium given by the source, joined with commas if there are several.
+        """
+        item = result.get("item") if isinstance(result.get("item"), dict) else {}
+        for value in [result.get("medium"), item.get("medium"), item.get("format")]:
+            if value:
+                return ",".join(value) if isinstance(value, list) else str(value)
+        return ""
+
+    def _parse_json_result(
+        self, result: Dict[str, Any]
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Extracts image metadata from an item of a JSON search result.
+
+        Args:
+            result: The item, as returned by loc.gov with `fo=json`.
+
+        Returns:
+            A Pandas DataFrame with the `source`, `id`, `url` and `medium` of the image,
+            and a Pandas DataFrame with its size variants, see `_variants_df`.
+        """
+        id = self._json_result_id(result)
+        variants = []
+        for url in re.findall(r'"((?:https?:)?//[^"]+)"', json.dumps(result)):
+            size = dict(re.findall(r"[#&]([hw])=([0-9]+)", url))
+            path = url.split("#")[0]
+            if "image-services/iiif/" in path:
+                variants.append((path, "image/jpeg", None, None))
+            elif re.search(r"\.tiff?$", path):
+                variants.append((path, "image/tiff", None, None))
+            elif re.search(r"\.jpe?g$", path):
+                variants.append(
+                    (
+                        path,
+                        "image/jpeg",
+                        int(size["w"]) if "w" in size else None,
+                        int(size["h"]) if "h" in size else None,
+                    )
+                )
+        return (
+            self._img_metadata_df(
+                id, self._json_image_link(result), self._json_medium(result)
+            ),
+            self._variants_df(id, variants),
+        )
+
+    def save_pages_json_metadata(
+        self,
+        prefix_url_search: str,
+        first_page: int,
+        last_page: int,
+        page_size: int = 100,
+        reparse: Union[bool, None] = None,
+    ) -> None:
+        """
+        Scans a range of search URLs in JSON mode, storing the metadata of all images of a page from a single response.
+
+        The search is requested with `fo=json`, which returns the format and image
+        resources of every item, so no item page is fetched. Items are logged under their
+        HTML item URL, so both modes skip the images processed by the other.
+
+        Args:
+            prefix_url_search: The base URL for searching images, ending with the page parameter.
+            first_page: The first page number to start scanning from.
+            last_page: The last page number to scan up to.
+            page_size: The number of results per page.
+            reparse: Whether to process the pages and images logged by earlier crawls
+                again, e.g. to re-parse a crawl from the response cache in `replay` mode.
+                Defaults to `crawler.reparse` in the configuration, or False.
+
+        Returns:
+            None
+        """
+        self._start_crawl(prefix_url_search, reparse)
+        for i in range(first_page, last_page + 1):
+            url = f"{prefix_url_search}{i}&fo=json&c={page_size}"
+            if self.url_index.contains(DBAction.PAGE_PROCESS, url):
+                logger.warning("Page " + url + " already processed")
+                continue
+            logger.info("Processing page " + url)
+            results = self.http_client.get(url, cache=True).json().get("results", [])
+            if not results:
+                logger.info("No more results")
+                break
+            saved = []
+            for result in results:
+                try:
+                    link = (
+                        "https://www.loc.gov/pictures/item/"
+                        + self._json_result_id(result)
+                        + "/"
+                    )
+                except ValueError as e:
+                    logger.error(str(e))
+                    saved.append(False)
+                    continue
+                if not self.url_index.contains(DBAction.IMAGE_PROCESS, link):
+                    saved.append(
+                        self._save_img_metadata(
+                            link, lambda: self._parse_json_result(result)
+                        )
+                    )
+                else:
+                    logger.info(f"Image {link} already processed")
+            self._save_page(url, saved)
+        logger.info(f"Processed URL index: {self.url_index.stats()}")
+
 
 class GettyCrawler(ImageMetadataCrawler):
     def __init__(
@@ -219,17 +718,20 @@ class GettyCrawler(ImageMetadataCrawler):
         config: dict,
         database: Database,
         regex_for_image_links: str = r"^https://www\.getty\.edu/art/collection/objects/",
+        http_client: Union[HttpClient, None] = None,
     ) -> None:
         """Initializes the image metadata crawler.
         Args:
             config: The configuration data.
             database: The database to store the extracted image metadata in.
             regex_for_image_links: The regular expression used to identify image urls.
+            http_client: The HTTP client shared by crawlers and downloaders.
         """
         super().__init__(
             config=config,
             database=database,
             regex_for_image_links=regex_for_image_links,
+            http_client=http_client,
         )
 
         # example page URL - "https://www.getty.edu/art/collection/objects/161707/james-earle-mcclees-julian-vannerson-aaron-harlan-american-about-1859/").
@@ -241,17 +743,20 @@ class CornellCrawler(ImageMetadataCrawler):
         config: dict,
         database: Database,
         regex_for_image_links: str = r"^https://www\.getty\.edu/art/collection/objects/",
+        http_client: Union[HttpClient, None] = None,
     ) -> None:
         """Initializes the image metadata crawler.
         Args:
             config: The configuration data.
             database: The database to store the extracted image metadata in.
             regex_for_image_links: The regular expression used to identify image urls.
+            http_client: The HTTP client shared by crawlers and downloaders.
         """
         super().__init__(
             config=config,
             database=database,
             regex_for_image_links=regex_for_image_links,
+            http_client=http_client,
         )
 
         # example page URL - "https://digital.library.cornell.edu/catalog/ss:544643").
@@ -263,17 +768,20 @@ class EastmanCrawler(ImageMetadataCrawler):
         config: dict,
         database: Database,
         regex_for_image_links: str = r"^/objects/",
+        http_client: Union[HttpClient, None] = None,
     ) -> None:
         """Initializes the image metadata crawler.
         Args:
             config: The configuration data.
             database: The database to store the extracted image metadata in.
             regex_for_image_links: The regular expression used to identify image urls.
+            http_client: The HTTP client shared by crawlers and downloaders.
         """
         super().__init__(
             config=config,
             database=database,
             regex_for_image_links=regex_for_image_links,
+            http_client=http_client,
         )
 
         # example page URL - "view-source:https://collections.eastman.org/objects/194800/bt-babbitts-soap?ctx=924fc8d2-6506-4bad-aa82-41d905fdef2c&idx=56").
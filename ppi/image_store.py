@@ -0,0 +1,183 @@
+import hashlib
+import os
+import shutil
+import uuid
+from typing import Any, List, Tuple
+from loguru import logger
+from ppi.database import Database
+
+"""Class for storing downloaded images by content"""
+
+
+def file_sha256(path: str, chunk_size: int = 1048576) -> Any:
+    """Returns a SHA-256 hash object fed with the contents of a file.
+
+    Args:
+        path: The path of the file.
+        chunk_size: The number of bytes read at once.
+
+    Returns:
+        The hash object, which can be updated with further data.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256
+
+
+class ImageStore:
+    """Stores each distinct image file once, under the SHA-256 digest of its contents.
+
+    The files in the medium and backup directories are hardlinks to the stored files,
+    so identical images served under different names, and their backups, take no extra
+    disk space. Where hardlinks are not possible (e.g. across file systems) files are
+    copied instead.
+
+    Attributes:
+        config: The configuration data.
+        database: The database recording stored files and their backups.
+        directory: The root directory of the store.
+    """
+
+    def __init__(self, config: dict, database: Database) -> None:
+        """Initializes the image store.
+
+        Args:
+            config: The configuration data.
+            database: The database recording stored files and their backups.
+        """
+        self.config = config
+        self.database = database
+        self.directory = config["dir"].get(
+            "store", os.path.join(config["dir"]["download"], ".store")
+        )
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        """Returns the path of a stored file.
+
+        Args:
+            sha256: The SHA-256 digest of the file.
+            ext: The extension of the file, including the leading dot.
+
+        Returns:
+            The path of the file in the store.
+        """
+        return os.path.join(self.directory, sha256[:2], sha256 + ext)
+
+    def link(self, source_path: str, destination_path: str) -> None:
+        """Links a file to a new path, replacing any file already there.
+
+        Args:
+            source_path: The path of the existing file.
+            destination_path: The path to link the file to.
+
+        Returns:
+            None.
+        """
+        os.makedirs(os.path.dirname(destination_path) or ".", exist_ok=True)
+        # Unique, so that concurrent links to the same path do not clash
+        tmp_path = f"{destination_path}.{uuid.uuid4().hex}.link"
+        try:
+            try:
+                os.link(source_path, tmp_path)
+            except OSError:
+                shutil.copy2(source_path, tmp_path)
+            os.replace(tmp_path, destination_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+
+    def add(self, file_path: str, sha256: str) -> str:
+        """Moves a file into the store and links it back to its original path.
+
+        If the store already holds a file with the same contents, the new file is
+        discarded in favour of it.
+
+        Args:
+            file_path: The path of the file.
+            sha256: The SHA-256 digest of the file.
+
+        Returns:
+            The path of the file in the store.
+        """
+        blob_path = self.blob_path(sha256, os.path.splitext(file_path)[1])
+        if os.path.exists(blob_path):
+            logger.debug(f"{file_path} is already stored as {blob_path}")
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            shutil.move(file_path, blob_path)
+        self.link(blob_path, file_path)
+        return blob_path
+
+    def import_downloads(self) -> int:
+        """Adds the downloaded files that are not in the store yet, e.g. from before it existed.
+
+        Files of the medium directories are named `{source}_{id}` after their image by
+        `ImageDownloader`, and are recorded for that image as if they had just been
+        downloaded, so they are backed up by the next `backup`.
+
+        Returns:
+            The number of files recorded for their image.
+        """
+        download_dir = self.config["dir"]["download"]
+        stored = self.database.get_stored_file_paths()
+        added = 0
+        for medium in self.config["allowed_processes"]:
+            medium_dir = os.path.join(download_dir, medium)
+            if not os.path.isdir(medium_dir):
+                continue
+            for name in sorted(os.listdir(medium_dir)):
+                file_path = os.path.join(medium_dir, name)
+                stem, ext = os.path.splitext(name)
+                if (
+                    file_path in stored
+                    or ext in [".part", ".link", ".json"]  # Partial downloads and links
+                    or "_" not in stem
+                    or not os.path.isfile(file_path)
+                ):
+                    continue
+                source, id = stem.split("_", 1)
+                try:
+                    sha256 = file_sha256(file_path).hexdigest()
+                    blob_path = self.add(file_path, sha256)
+                    if self.database.save_image_file(
+                        source,
+                        id,
+                        sha256,
+                        os.path.getsize(blob_path),
+                        blob_path,
+                        file_path,
+                    ):
+                        added += 1
+                    else:
+                        logger.warning(f"No image recorded for {file_path}")
+                except OSError as e:
+                    logger.error(
+                        f"An exception {str(e)} of type {type(e).__name__} occurred while importing {file_path}."
+                    )
+        return added
+
+    def backup(self) -> int:
+        """Backs up the stored images that have not been backed up yet.
+
+        Only images recorded in the database without a backup are visited, so each run
+        costs as much as the number of images downloaded since the last one.
+
+        Returns:
+            The number of images backed up.
+        """
+        backup_dir = self.config["dir"]["backup"]
+        os.makedirs(backup_dir, exist_ok=True)
+        backups: List[Tuple[str, str, str]] = []
+        for source, id, file_path, blob_path in self.database.get_pending_backups():
+            backup_path = os.path.join(backup_dir, os.path.basename(file_path))
+            try:
+                self.link(blob_path, backup_path)
+                backups.append((source, id, backup_path))
+            except OSError as e:
+                logger.error(
+                    f"An exception {str(e)} of type {type(e).__name__} occurred while backing up {blob_path}."
+                )
+        self.database.save_backup_paths(backups)
+        return len(backups)
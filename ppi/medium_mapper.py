@@ -1,7 +1,8 @@
-import re
+from typing import Any, Dict
 import pandas as pd
 from loguru import logger
 from ppi.database import Database
+from ppi.medium_rules import MediumRuleEngine
 
 """Class for standardizing mediums (photographic processes) names"""
 
@@ -12,6 +13,7 @@ class MediumMapper:
     Attributes:
         config: The configuration data.
         database: The database with the image mediums.
+        rules: The rules proposing standardized medium names.
         proposal_mappings: A Pandas DataFrame containing the original medium mappings.
     """
 
@@ -24,11 +26,14 @@ class MediumMapper:
         """
         self.config = config
         self.database = database
+        self.rules = MediumRuleEngine(config["medium_rules"])
         self.proposal_mappings = self._get_proposal_mappings()
         self.show_stats()
 
     def _propose_mapping(self, old_medium: str) -> str:
-        """Defines rules for standardizing source mediums names.
+        """Proposes a standardized name for a source medium name.
+
+        The rules are defined in the `medium_rules` section of the configuration.
 
         Args:
             old_medium: The old medium name.
@@ -37,63 +42,20 @@ class MediumMapper:
             The standardized medium name.
 
         """
-        medium = re.sub(r"[^a-zA-Z\s]", " ", old_medium).upper().strip()
-        medium = re.sub(r"\s{2,}", " ", medium)
-        # RULES (ADJUST CODE ACCORDING TO YOUR CASE):
-        # -------------------------------------------
-        # REMOVE
-        pattern = r"ALETHETYPE|ARTOTYPE|INKJET|CHRYSOTYPE|PANNOTYPE|CHROMOGENIC|OPALTYPE|LITHOGRAPH"
-        if re.search(pattern, medium):
-            return "REMOVE"
-        # ALBUMEN_PRINT
-        if medium in ["ALBUMEN PRINT", "ALBUMEN SILVER PRINT"] or re.search(
-            r"ALBUMEN SILVER PRINT PRINTED", medium
-        ):
-            return "ALBUMEN_PRINT"
-        # AMBROTYPE
-        elif medium in ["AMBROTYPE", "TINTYPE"]:
-            return "AMBROTYPE_TINTYPE_FERROTYPE"
-        # CARBON_PRINT
-        elif medium in ["CARBON PRINT", "CARBON"]:
-            return "CARBON_PRINT"
-        # CYANOTYPE
-        elif medium in ["CYANOTYPE", "CYANOTYPES"]:
-            return "CYANOTYPE"
-        # DAGUERREOTYPE
-        elif medium == "DAGUERREOTYPE":
-            return "DAGUERREOTYPE"
-        # DOP
-        elif medium in [
-            "BROMIDE PRINT",
-            "SILVER BROMIDE PRINT",
-            "GELATIN SILVER BROMIDE PRINTS",
-            "GELATIN SILVER BROMIDE PRINT",
-            "CHLOROBROMIDE PRINT",
-            "GELATIN SILVER PRINT ON CHLORO BROMIDE PRINTING OUT PAPER",
-        ]:
-            return "DOP"
-        elif medium in ["GELATIN SILVER PRINT"]:
-            return "DOP"
-        # PLATINOTYPE_PALLADIOTYPE
-        elif medium in ["PLATINUM PRINT", "PLATINOTYPE", "PLATINUM"]:
-            return "PLATINOTYPE_PALLADIOTYPE"
-        # POP
-        elif medium in [
-            "GELATINO CHLORIDE OR GELATIN CHLORIDE PRINTING OUT PRINT",
-            "GELATIN SILVER CHLORIDE PRINT",
-            "GELATIN SILVER CHLORIDE PRINTING OUT PAPER PRINT",
-            "GELATIN SILVER PRINTING OUT PAPER PRINT",
-            "COLLODION PRINT",
-            "COLLODION SILVER PRINT",
-            "COLLODION SILVER OR GELATIN SILVER PRINT",
-            "COLLODION PRINTING-OUT PAPER PRINT",
-            "POP",
-        ]:
-            return "POP"
-        # SALTED_PAPER_PRINT
-        elif medium in ["SALTED PAPER PRINT", "SALT PRINT"]:
-            return "SALTED_PAPER_PRINT"
-        return "UNDEFINED"  # default case
+        return self.rules.propose(old_medium)
+
+    def explain_mapping(self, old_medium: str) -> Dict[str, Any]:
+        """Shows which rule proposes the standardized name of a source medium name.
+
+        Args:
+            old_medium: The old medium name.
+
+        Returns:
+            The explanation, see `MediumRuleEngine.explain`.
+        """
+        explanation = self.rules.explain(old_medium)
+        logger.info(explanation)
+        return explanation
 
     def _get_proposal_mappings(self) -> pd.DataFrame:
         """Creates a Pandas DataFrame containing the proposed medium mappings.
@@ -102,17 +64,13 @@ class MediumMapper:
             A Pandas DataFrame containing the proposed medium mappings.
 
         """
-        all_mediums = self.database.get_all_mediums()
-        if all_mediums:
-            old_medium = pd.DataFrame(all_mediums)
-            new_medium = pd.DataFrame(
-                [self._propose_mapping(item) for item in all_mediums]
-            )
-            df = pd.concat([old_medium, new_medium], axis=1)
-            df.columns = pd.Index(["old_medium", "new_medium"])
-            return df
-        else:
-            return pd.DataFrame(columns=["old_medium", "new_medium"])
+        old_mediums = list(self.database.iter_all_mediums())
+        return pd.DataFrame(
+            {
+                "old_medium": old_mediums,
+                "new_medium": self.rules.propose_many(old_mediums),
+            }
+        )
 
     def show_stats(self) -> None:
         """Prints statistics about the current medium mappings.
@@ -121,7 +79,7 @@ class MediumMapper:
             None.
         """
         db_counts = pd.DataFrame(
-            self.database.get_all_mediums_count(), columns=["old_medium", "count"]
+            self.database.iter_all_mediums_count(), columns=["old_medium", "count"]
         )
         join = pd.merge(db_counts, self.proposal_mappings, on="old_medium", how="left")
         result = join.groupby(["new_medium"])["count"].sum().reset_index()
@@ -149,44 +107,28 @@ class MediumMapper:
         else:
             logger.info("No undefined medium descriptions.")
 
-    def _map(self, old_medium) -> str:
-        """Maps an old medium name to a standardized medium name.
-
-        Args:
-            old_medium: The old medium name.
+    def update_mediums(self, full: bool = False) -> None:
+        """Updates the medium names in the database.
 
-        Returns:
-            The standardized medium name.
-        """
-        try:
-            res = self.proposal_mappings[
-                self.proposal_mappings["old_medium"] == old_medium
-            ]["new_medium"].item()
-            return res
-        except Exception as e:
-            logger.error(
-                f"An exception of type {type(e).__name__} occurred: {str(e)} while handling medium {old_medium}."
-            )
-            raise TypeError("Could not find '" + old_medium + "' in mappings")
+        Only images added since the last update, and images whose source medium is now
+        mapped differently, are remapped. The mapping runs in SQLite as a join with the
+        `medium_mappings` table instead of row by row.
 
-    def update_mediums(self) -> None:
-        """Updates the medium names in the database.
+        Args:
+            full: Whether to remap all images.
 
         Returns:
             None.
         """
-        df = pd.DataFrame(columns=["source", "id", "new_medium"])
-        images_to_update = self.database.get_images_to_update()
-        if images_to_update:
-            for image_metadata in images_to_update:
-                source, id, medium = image_metadata
-                new_medium = self._map(medium)
-                new_row_df = pd.DataFrame.from_dict(
-                    {
-                        "source": [source],
-                        "id": [id],
-                        "new_medium": [new_medium],
-                    }
+        until = self.database.get_last_image_rowid()
+        self.proposal_mappings = self._get_proposal_mappings()
+        changed = self.database.save_medium_mappings(
+            dict(
+                zip(
+                    self.proposal_mappings["old_medium"],
+                    self.proposal_mappings["new_medium"],
                 )
-                df = pd.concat([df, new_row_df], ignore_index=True)
-            self.database.save_data(data=df, table="mediums", if_exists="replace")
+            )
+        )
+        mapped = self.database.map_mediums(until, full)
+        logger.info(f"{changed} medium mappings changed, {mapped} images mapped")
@@ -0,0 +1,172 @@
+import re
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+"""Class for proposing standardized medium names from configurable rules"""
+
+
+class MediumRuleEngine:
+    """Maps source medium descriptions to standardized medium names with ordered rules.
+
+    Descriptions are normalized (letters only, upper case, single spaces) and single
+    words are replaced by their synonyms. Rules are then tried in order, and the first
+    one matching gives the medium. A rule matches if the normalized description is one
+    of its `exact` descriptions, or if its `regex` is found in it. The exact descriptions
+    of all rules are compiled into one dictionary, and the regexes into one alternation
+    whose branches keep the rule order, so a description is matched with one lookup and
+    one regex match whatever the number of rules.
+
+    The rules are given as a dictionary, e.g. the `medium_rules` section of the
+    configuration:
+
+        synonyms: {CYANOTYPES: CYANOTYPE}
+        rules:
+          - {medium: REMOVE, regex: "INKJET|LITHOGRAPH"}
+          - {medium: CYANOTYPE, exact: [CYANOTYPE]}
+        default: UNDEFINED
+
+    Attributes:
+        rules: The ordered rules, each a dictionary with a `medium` and optional `exact`
+            and `regex` entries.
+        default: The medium of descriptions no rule matches.
+    """
+
+    def __init__(self, rules: Dict[str, Any], cache_size: int = 65536) -> None:
+        """Compiles the rules.
+
+        Args:
+            rules: The synonyms, ordered rules and default medium.
+            cache_size: The maximum number of descriptions whose medium is memoized.
+        """
+        self.rules: List[Dict[str, Any]] = list(rules["rules"])
+        self.default: str = rules.get("default", "UNDEFINED")
+        self._synonyms: Dict[str, str] = {
+            self.normalize(word): self.normalize(synonym)
+            for word, synonym in (rules.get("synonyms") or {}).items()
+        }
+        self._synonyms_pattern = (
+            re.compile(
+                r"\b(?:"
+                + "|".join(
+                    re.escape(word)
+                    for word in sorted(self._synonyms, key=len, reverse=True)
+                )
+                + r")\b"
+            )
+            if self._synonyms
+            else None
+        )
+        self._exact: Dict[str, int] = {}
+        branches: List[str] = []
+        for index, rule in enumerate(self.rules):
+            for description in rule.get("exact") or []:
+                self._exact.setdefault(self._canonical(description), index)
+            if rule.get("regex"):
+                # The first branch whose lookahead finds the rule's regex wins
+                branches.append(f"(?=.*?(?:{rule['regex']}))(?P<rule{index}>)")
+        self._regex = (
+            re.compile(r"^(?:" + "|".join(branches) + ")", re.DOTALL)
+            if branches
+            else None
+        )
+        self._propose_cached = lru_cache(maxsize=cache_size)(self._propose)
+
+    @staticmethod
+    def normalize(description: str) -> str:
+        """Normalizes a medium description: letters only, upper case and single spaces.
+
+        Args:
+            description: The medium description.
+
+        Returns:
+            The normalized description.
+        """
+        description = re.sub(r"[^a-zA-Z\s]", " ", description).upper().strip()
+        return re.sub(r"\s{2,}", " ", description)
+
+    def _canonical(self, description: str) -> str:
+        """Returns a description normalized, with synonyms replaced."""
+        description = self.normalize(description)
+        if self._synonyms_pattern:
+            description = self._synonyms_pattern.sub(
+                lambda match: self._synonyms[match.group(0)], description
+            )
+        return description
+
+    def _match(self, description: str) -> Tuple[Union[int, None], str]:
+        """Finds the first rule matching a canonical description.
+
+        Args:
+            description: The normalized description, with synonyms replaced.
+
+        Returns:
+            A tuple with the index of the rule, or None if no rule matches, and the kind
+            of match: `exact`, `regex` or `default`.
+        """
+        exact_index = self._exact.get(description)
+        match = self._regex.match(description) if self._regex else None
+        regex_index = int(match.lastgroup[len("rule") :]) if match else None
+        if exact_index is not None and (
+            regex_index is None or exact_index < regex_index
+        ):
+            return exact_index, "exact"
+        if regex_index is not None:
+            return regex_index, "regex"
+        return None, "default"
+
+    def _propose(self, description: str) -> str:
+        """Returns the standardized medium of a description, see `propose`."""
+        index, _ = self._match(self._canonical(description))
+        return self.default if index is None else self.rules[index]["medium"]
+
+    def propose(self, description: str) -> str:
+        """Returns the standardized medium of a description.
+
+        Results are memoized in a bounded LRU cache.
+
+        Args:
+            description: The medium description.
+
+        Returns:
+            The standardized medium.
+        """
+        return self._propose_cached(description)
+
+    def propose_many(self, descriptions: Iterable[str]) -> List[str]:
+        """Returns the standardized medium of each of the given descriptions.
+
+        Each distinct description is matched once.
+
+        Args:
+            descriptions: The medium descriptions.
+
+        Returns:
+            The standardized mediums, in the order of the descriptions.
+        """
+        descriptions = list(descriptions)
+        mediums = {
+            description: self.propose(description)
+            for description in dict.fromkeys(descriptions)
+        }
+        return [mediums[description] for description in descriptions]
+
+    def explain(self, description: str) -> Dict[str, Any]:
+        """Explains which rule gives the standardized medium of a description.
+
+        Args:
+            description: The medium description.
+
+        Returns:
+            A dictionary with the `description`, its `canonical` form, the proposed
+            `medium`, the index of the matching `rule` (None for the default) and the
+            kind of `match`: `exact`, `regex` or `default`.
+        """
+        canonical = self._canonical(description)
+        index, kind = self._match(canonical)
+        return {
+            "description": description,
+            "canonical": canonical,
+            "medium": self.default if index is None else self.rules[index]["medium"],
+            "rule": index,
+            "match": kind,
+        }
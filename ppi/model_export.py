@@ -0,0 +1,504 @@
+import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterator, List, Tuple, Union
+import numpy as np
+from loguru import logger
+from ppi.classify import load_keras_model, model_predictor
+from ppi.database import Database
+from ppi.dataset_exporter import DatasetExporter
+from ppi.preprocessing import bounded_map, load_model_input
+
+"""Class for exporting quantized, sharded variants of the TensorFlow.js models"""
+
+
+DEFAULT_MODEL_EXPORT_CONFIG: Dict[str, Any] = {
+    "variants": ["float32", "float16", "uint8"],
+    "shard_size_kb": 1024,
+    "max_accuracy_loss": 0.01,
+    "bandwidths_mbps": [5, 20, 100],
+    "connections": 6,
+    "rtt_ms": 50,
+    "latency_runs": 20,
+    "batch_size": 16,
+    "image_size": 1000,
+    "crop_size": 400,
+}
+
+# Bytes per element of the TensorFlow.js weight dtypes, and of the quantized dtypes
+DTYPE_SIZES = {
+    "float32": 4,
+    "int32": 4,
+    "bool": 1,
+    "uint8": 1,
+    "uint16": 2,
+    "float16": 2,
+}
+
+# A weight of a TensorFlow.js model: its manifest entry and its (dequantized) values
+Weight = Tuple[Dict[str, Any], np.ndarray]
+
+
+def quantize(values: np.ndarray, dtype: str) -> Tuple[np.ndarray, Dict[str, Any]]:
+    """Quantizes float32 weights as the TensorFlow.js converter does.
+
+    `float16` halves the precision. `uint8` and `uint16` map the range of the weights
+    linearly onto the integers, with the range nudged so that zero stays exact; the
+    browser restores `value = quantized * scale + min` when loading the model.
+
+    Args:
+        values: The float32 weights.
+        dtype: `float16`, `uint8` or `uint16`.
+
+    Returns:
+        A tuple with the quantized weights and the `quantization` entry of their
+        manifest.
+    """
+    if dtype == "float16":
+        return values.astype(np.float16), {"dtype": "float16"}
+    if dtype not in ("uint8", "uint16"):
+        raise ValueError(f"Unsupported quantization dtype {dtype}")
+    quant_max = np.iinfo(dtype).max
+    min_value, max_value = float(values.min()), float(values.max())
+    if min_value == max_value:
+        scale, nudged_min = 1.0, min_value
+    else:
+        scale = (max_value - min_value) / quant_max
+        zero_point = min(max(round(-min_value / scale), 0), quant_max)
+        nudged_min = -zero_point * scale
+    quantized = np.round(
+        (np.clip(values, nudged_min, nudged_min + quant_max * scale) - nudged_min)
+        / scale
+    ).astype(dtype)
+    return quantized, {"dtype": dtype, "min": nudged_min, "scale": scale}
+
+
+def dequantize(values: np.ndarray, quantization: Dict[str, Any]) -> np.ndarray:
+    """Restores float32 weights from quantized ones, as the browser does when loading.
+
+    Args:
+        values: The quantized weights.
+        quantization: The `quantization` entry of their manifest.
+
+    Returns:
+        The float32 weights.
+    """
+    if quantization["dtype"] == "float16":
+        return values.astype(np.float32)
+    return (
+        values.astype(np.float32) * quantization["scale"] + quantization["min"]
+    ).astype(np.float32)
+
+
+def read_tfjs_model(model_dir: str) -> Tuple[Dict[str, Any], List[Weight]]:
+    """Reads a TensorFlow.js model and its weights, dequantizing quantized weights.
+
+    Args:
+        model_dir: The directory of `model.json` and its weight shards.
+
+    Returns:
+        A tuple with the contents of `model.json` and the weights, in manifest order.
+    """
+    with open(os.path.join(model_dir, "model.json")) as file:
+        model_json = json.load(file)
+    weights: List[Weight] = []
+    for group in model_json["weightsManifest"]:
+        data = bytearray()
+        for path in group["paths"]:
+            with open(os.path.join(model_dir, path), "rb") as file:
+                data += file.read()
+        offset = 0
+        for spec in group["weights"]:
+            quantization = spec.get("quantization")
+            dtype = quantization["dtype"] if quantization else spec["dtype"]
+            if dtype not in DTYPE_SIZES:
+                raise ValueError(f"Unsupported weight dtype {dtype} of {spec['name']}")
+            count = math.prod(spec["shape"])
+            values = np.frombuffer(
+                data, np.dtype(dtype).newbyteorder("<"), count, offset
+            ).reshape(spec["shape"])
+            offset += count * DTYPE_SIZES[dtype]
+            if quantization:
+                values = dequantize(values, quantization)
+            spec = {key: value for key, value in spec.items() if key != "quantization"}
+            weights.append((spec, values))
+    return model_json, weights
+
+
+def write_tfjs_model(
+    model_json: Dict[str, Any],
+    weights: List[Weight],
+    output_dir: str,
+    dtype: str,
+    shard_size: int,
+) -> Dict[str, Any]:
+    """Writes a TensorFlow.js model with its float32 weights quantized and sharded.
+
+    The weights are concatenated and cut into shards of `shard_size` bytes, which the
+    browser fetches in parallel, as the TensorFlow.js converter does.
+
+    Args:
+        model_json: The contents of `model.json`, whose weights manifest is replaced.
+        weights: The weights, see `read_tfjs_model`.
+        output_dir: The directory to write `model.json` and the shards to.
+        dtype: `float32` to keep the weights, or the dtype to quantize them to.
+        shard_size: The maximum size of a shard, in bytes.
+
+    Returns:
+        A dictionary with the total `bytes` and the number of `shards` of the weights.
+    """
+    specs: List[Dict[str, Any]] = []
+    buffers: List[bytes] = []
+    for spec, values in weights:
+        spec = dict(spec)
+        if dtype != "float32" and spec["dtype"] == "float32":
+            values, spec["quantization"] = quantize(values, dtype)
+        buffers.append(values.astype(values.dtype.newbyteorder("<")).tobytes())
+        specs.append(spec)
+    data = b"".join(buffers)
+    shard_count = max(1, math.ceil(len(data) / shard_size))
+    paths = [f"group1-shard{i + 1}of{shard_count}.bin" for i in range(shard_count)]
+    os.makedirs(output_dir, exist_ok=True)
+    for name in os.listdir(output_dir):
+        if name.endswith(".bin") and name not in paths:
+            os.remove(os.path.join(output_dir, name))
+    for i, path in enumerate(paths):
+        with open(os.path.join(output_dir, path), "wb") as file:
+            file.write(data[i * shard_size : (i + 1) * shard_size])
+    model_json = {**model_json, "weightsManifest": [{"paths": paths, "weights": specs}]}
+    with open(os.path.join(output_dir, "model.json"), "w") as file:
+        json.dump(model_json, file)
+    return {"bytes": len(data), "shards": shard_count}
+
+
+class ModelExporter:
+    """Exports quantized, sharded variants of a TensorFlow.js model and reports their cost.
+
+    Each variant of `model_export.variants` is written to its own directory as a
+    drop-in replacement of the model directories of the web apps: `float32` keeps the
+    weights, `float16` halves them, and `uint8` (or `uint16`) quantizes each weight
+    tensor linearly over its range, which the browser undoes when loading the model.
+
+    The accuracy of each variant is measured on the validation split of
+    `DatasetExporter` by quantizing the weights of the saved Keras model the web model
+    was converted from in the same way, since the graph of the web model cannot run in
+    Python. Load times are estimated from the size and number of shards of each variant,
+    and inference latency is measured on single crops, as the web apps predict.
+
+    Attributes:
+        config: The configuration data.
+        database: The database with the image mediums.
+        export_config: The `model_export` section of the configuration, with defaults.
+    """
+
+    def __init__(self, config: dict, database: Database) -> None:
+        """Initializes the model exporter.
+
+        Args:
+            config: The configuration data.
+            database: The database with the image mediums.
+        """
+        self.config = config
+        self.database = database
+        self.export_config = {
+            **DEFAULT_MODEL_EXPORT_CONFIG,
+            **config.get("model_export", {}),
+        }
+
+    def export(self, tfjs_dir: str, output_dir: str) -> Dict[str, Dict[str, Any]]:
+        """Writes the variants of a TensorFlow.js model.
+
+        Files other than the model and its shards, e.g. `class_names.txt`, are copied
+        along.
+
+        Args:
+            tfjs_dir: The directory of the TensorFlow.js model.
+            output_dir: The directory to write each variant to, in a subdirectory named
+                after it.
+
+        Returns:
+            A dictionary mapping each variant to its `path`, `bytes` and `shards`.
+        """
+        model_json, weights = read_tfjs_model(tfjs_dir)
+        extra_files = [
+            name
+            for name in os.listdir(tfjs_dir)
+            if name != "model.json" and not name.endswith(".bin")
+        ]
+        variants: Dict[str, Dict[str, Any]] = {}
+        for variant in self.export_config["variants"]:
+            variant_dir = os.path.join(output_dir, variant)
+            variants[variant] = {
+                "path": variant_dir,
+                **write_tfjs_model(
+                    model_json,
+                    weights,
+                    variant_dir,
+                    variant,
+                    self.export_config["shard_size_kb"] * 1024,
+                ),
+            }
+            for name in extra_files:
+                shutil.copy(os.path.join(tfjs_dir, name), variant_dir)
+            logger.info(
+                f"Exported the {variant} variant ({variants[variant]['bytes'] / 2**20:.1f} MiB in {variants[variant]['shards']} shards) to {variant_dir}"
+            )
+        return variants
+
+    def _load_variant(self, model_path: str, variant: str) -> Any:
+        """Loads the saved model with its float32 weights quantized and restored.
+
+        Args:
+            model_path: The path of the saved model.
+            variant: The dtype the weights are quantized to, or `float32`.
+
+        Returns:
+            The function computing the probabilities of a batch, see `model_predictor`.
+        """
+        model = load_keras_model(model_path)
+        if variant != "float32":
+            for weight in model.weights:
+                values = np.asarray(weight.numpy())
+                if values.dtype == np.float32 and values.size:
+                    weight.assign(dequantize(*quantize(values, variant)))
+        return model_predictor(model)
+
+    def _iter_validation_batches(
+        self, labels: List[str], limit: Union[int, None] = None
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yields the center crops of the validation images, in batches.
+
+        Args:
+            labels: The mediums of the model outputs, in order. Images of other mediums
+                are skipped.
+            limit: The maximum number of images.
+
+        Returns:
+            An iterator over tuples with a batch of crops and the index of the medium of
+            each crop in `labels`.
+        """
+        _, val = DatasetExporter(self.config, self.database).split()
+        mediums = self.config["allowed_processes"]
+        targets = {
+            (source, id): labels.index(mediums[label])
+            for _, source, id, label, _ in val
+            if mediums[label] in labels
+        }
+        items = [
+            (source, id, path)
+            for _, source, id, _, path in val
+            if (source, id) in targets
+        ][:limit]
+        load = partial(
+            load_model_input,
+            image_size=self.export_config["image_size"],
+            crop_size=self.export_config["crop_size"],
+        )
+        batch_size = self.export_config["batch_size"]
+        crops: List[np.ndarray] = []
+        batch_labels: List[int] = []
+        workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for source, id, image_crops, error in bounded_map(
+                executor, load, items, batch_size + 2 * workers
+            ):
+                if error is not None:
+                    logger.error(f"Could not preprocess image {source}_{id}: {error}")
+                    continue
+                crops.append(image_crops[0])
+                batch_labels.append(targets[(source, id)])
+                if len(crops) == batch_size:
+                    yield np.stack(crops), np.asarray(batch_labels)
+                    crops, batch_labels = [], []
+        if crops:
+            yield np.stack(crops), np.asarray(batch_labels)
+
+    def evaluate(
+        self,
+        model_path: str,
+        labels: Union[List[str], None] = None,
+        limit: Union[int, None] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """Measures the validation accuracy and inference latency of each variant.
+
+        Args:
+            model_path: The path of the saved model the web model was converted from.
+            labels: The mediums of the model outputs, in order. Defaults to the sorted
+                `allowed_processes`, see `ImageClassifier`.
+            limit: The maximum number of validation images.
+
+        Returns:
+            A dictionary mapping each variant to the number of `validation_images`, its
+            `accuracy` and its top-1 `agreement` with float32 on them (None without
+            validation images), and its median and 95th percentile latency on a single
+            crop, `latency_ms` and `latency_p95_ms`.
+        """
+        labels = labels or sorted(self.config["allowed_processes"])
+        variants = self.export_config["variants"]
+        predictors = {
+            variant: self._load_variant(model_path, variant) for variant in variants
+        }
+        correct = dict.fromkeys(variants, 0)
+        agreeing = dict.fromkeys(variants, 0)
+        count = 0
+        for crops, targets in self._iter_validation_batches(labels, limit):
+            predicted = {
+                variant: predict(crops).argmax(axis=1)
+                for variant, predict in predictors.items()
+            }
+            for variant in variants:
+                correct[variant] += int((predicted[variant] == targets).sum())
+                if "float32" in predicted:
+                    agreeing[variant] += int(
+                        (predicted[variant] == predicted["float32"]).sum()
+                    )
+            count += len(targets)
+        if not count:
+            logger.warning(
+                "No validation images to measure the accuracy of the variants on"
+            )
+        crop_size = self.export_config["crop_size"]
+        crop = np.random.default_rng(0).uniform(0, 255, (1, crop_size, crop_size, 3))
+        crop = crop.astype(np.float32)
+        results: Dict[str, Dict[str, Any]] = {}
+        for variant, predict in predictors.items():
+            predict(crop)
+            latencies = []
+            for _ in range(self.export_config["latency_runs"]):
+                start = time.perf_counter()
+                predict(crop)
+                latencies.append(1000 * (time.perf_counter() - start))
+            results[variant] = {
+                "validation_images": count,
+                "accuracy": correct[variant] / count if count else None,
+                "agreement": (
+                    agreeing[variant] / count
+                    if count and "float32" in variants
+                    else None
+                ),
+                "latency_ms": float(np.median(latencies)),
+                "latency_p95_ms": float(np.percentile(latencies, 95)),
+            }
+        return results
+
+    def _load_times(self, variant_dir: str, size: int, shards: int) -> Dict[str, Any]:
+        """Estimates the time the browser takes to load a variant.
+
+        Shards are fetched over `connections` parallel connections, each round costing a
+        round trip, and the transfer is bound by the bandwidth. Decoding is measured as
+        the time Python takes to read and dequantize the weights.
+
+        Args:
+            variant_dir: The directory of the variant.
+            size: The size of the weights, in bytes.
+            shards: The number of shards.
+
+        Returns:
+            A dictionary with the `decode_ms` and the estimated `load_s` at each of
+            `bandwidths_mbps`.
+        """
+        start = time.perf_counter()
+        read_tfjs_model(variant_dir)
+        decode_ms = 1000 * (time.perf_counter() - start)
+        size += os.path.getsize(os.path.join(variant_dir, "model.json"))
+        rounds = 1 + math.ceil(shards / self.export_config["connections"])
+        return {
+            "decode_ms": decode_ms,
+            "load_s": {
+                str(bandwidth): rounds * self.export_config["rtt_ms"] / 1000
+                + size * 8 / (bandwidth * 1e6)
+                + decode_ms / 1000
+                for bandwidth in self.export_config["bandwidths_mbps"]
+            },
+        }
+
+    def run(
+        self,
+        tfjs_dir: str,
+        model_path: Union[str, None] = None,
+        output_dir: Union[str, None] = None,
+        labels: Union[List[str], None] = None,
+        limit: Union[int, None] = None,
+    ) -> Dict[str, Any]:
+        """Exports the variants of a model, benchmarks them and writes a report.
+
+        The report recommends the smallest variant whose accuracy is at most
+        `max_accuracy_loss` below that of float32.
+
+        Args:
+            tfjs_dir: The directory of the TensorFlow.js model, e.g. `docs/multiclass/model`.
+            model_path: The path of the saved model it was converted from. Without it,
+                accuracy and latency are not measured.
+            output_dir: The directory to write the variants and the report to. Defaults
+                to `dir.model_export` in the configuration, in a subdirectory named after
+                the TensorFlow.js model.
+            labels: The mediums of the model outputs, see `evaluate`.
+            limit: The maximum number of validation images.
+
+        Returns:
+            The report, as written to `report.json` in the output directory.
+        """
+        output_dir = output_dir or os.path.join(
+            self.config["dir"]["model_export"],
+            os.path.basename(os.path.dirname(os.path.abspath(tfjs_dir))),
+        )
+        variants = self.export(tfjs_dir, output_dir)
+        evaluation = self.evaluate(model_path, labels, limit) if model_path else {}
+        for variant, entry in variants.items():
+            entry.update(
+                self._load_times(entry["path"], entry["bytes"], entry["shards"])
+            )
+            entry.update(evaluation.get(variant, {}))
+        recommended = None
+        baseline = variants.get("float32", {}).get("accuracy")
+        if baseline is not None:
+            within = [
+                variant
+                for variant, entry in variants.items()
+                if baseline - entry["accuracy"]
+                <= self.export_config["max_accuracy_loss"]
+            ]
+            recommended = min(within, key=lambda variant: variants[variant]["bytes"])
+        report = {
+            "model": tfjs_dir,
+            "source_model": model_path,
+            "validation_images": max(
+                [entry["validation_images"] for entry in evaluation.values()] or [0]
+            ),
+            "max_accuracy_loss": self.export_config["max_accuracy_loss"],
+            "recommended": recommended,
+            "variants": variants,
+        }
+        with open(os.path.join(output_dir, "report.json"), "w") as file:
+            json.dump(report, file, indent=1)
+        with open(os.path.join(output_dir, "report.md"), "w") as file:
+            file.write(self._markdown(report))
+        logger.info(f"Model export report:\n{self._markdown(report)}")
+        return report
+
+    def _markdown(self, report: Dict[str, Any]) -> str:
+        """Formats a report as a Markdown table, one row per variant."""
+        bandwidths = [str(b) for b in self.export_config["bandwidths_mbps"]]
+        header = ["variant", "MiB", "shards", "accuracy", "agreement", "latency ms"] + [
+            f"load s @{b} Mbit/s" for b in bandwidths
+        ]
+        lines = ["| " + " | ".join(header) + " |", "|" + " --- |" * len(header)]
+        for variant, entry in report["variants"].items():
+            accuracy = entry.get("accuracy")
+            agreement = entry.get("agreement")
+            latency = entry.get("latency_ms")
+            row = [
+                variant
+                + (" (recommended)" if variant == report["recommended"] else ""),
+                f"{entry['bytes'] / 2**20:.1f}",
+                str(entry["shards"]),
+                "-" if accuracy is None else f"{accuracy:.2%}",
+                "-" if agreement is None else f"{agreement:.2%}",
+                "-" if latency is None else f"{latency:.0f}",
+            ] + [f"{entry['load_s'][b]:.1f}" for b in bandwidths]
+            lines.append("| " + " | ".join(row) + " |")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,337 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple, Union
+import numpy as np
+from loguru import logger
+from PIL import Image
+from ppi.database import Database
+from ppi.image_deriver import largest_frame, to_rgb
+
+"""Classes for finding near-duplicate images through perceptual hashes"""
+
+
+# Side of the grayscale image the pHash DCT is computed on, and of the kept low frequencies
+PHASH_SIZE = 32
+PHASH_BITS = 8
+
+# Orthonormal DCT-II matrix, so that the 2D DCT of X is DCT @ X @ DCT.T
+_n = np.arange(PHASH_SIZE)
+DCT = np.sqrt(2 / PHASH_SIZE) * np.cos(
+    np.pi * (2 * _n[None, :] + 1) * _n[:, None] / (2 * PHASH_SIZE)
+)
+DCT[0] /= np.sqrt(2)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    """Packs a boolean array into an unsigned integer, first element as the highest bit."""
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def phash(image: Image.Image) -> int:
+    """Returns the 64-bit DCT perceptual hash of an image.
+
+    Each bit tells whether one of the lowest 8x8 frequencies of the downscaled grayscale
+    image is above their median, which survives rescaling, recompression and small
+    tonal changes.
+
+    Args:
+        image: The image, in any mode.
+
+    Returns:
+        The hash, as an unsigned integer.
+    """
+    gray = (
+        to_rgb(image)
+        .convert("L")
+        .resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.LANCZOS)
+    )
+    coefficients = (DCT @ np.asarray(gray, dtype=np.float64) @ DCT.T)[
+        :PHASH_BITS, :PHASH_BITS
+    ]
+    return _bits_to_int(coefficients > np.median(coefficients.flatten()[1:]))
+
+
+def dhash(image: Image.Image) -> int:
+    """Returns the 64-bit difference hash of an image.
+
+    Each bit tells whether a pixel of the downscaled grayscale image is brighter than
+    its right neighbour.
+
+    Args:
+        image: The image, in any mode.
+
+    Returns:
+        The hash, as an unsigned integer.
+    """
+    gray = np.asarray(
+        to_rgb(image).convert("L").resize((9, 8), Image.Resampling.LANCZOS),
+        dtype=np.int16,
+    )
+    return _bits_to_int(gray[:, 1:] > gray[:, :-1])
+
+
+def file_hashes(path: str) -> Tuple[int, int]:
+    """Returns the perceptual hashes of an image file.
+
+    Args:
+        path: The path of the image, or a binary file object.
+
+    Returns:
+        A tuple with the pHash and dHash of the image.
+    """
+    with Image.open(path) as image:
+        largest_frame(image)
+        # The hashes only need a thumbnail, which JPEGs decode much faster
+        image.draft("RGB", (4 * PHASH_SIZE, 4 * PHASH_SIZE))
+        image.load()
+        return phash(image), dhash(image)
+
+
+def hamming(a: int, b: int) -> int:
+    """Returns the number of differing bits of two hashes."""
+    return (a ^ b).bit_count()
+
+
+def to_signed(value: int) -> int:
+    """Converts an unsigned 64-bit hash to the signed integer SQLite stores."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def to_unsigned(value: int) -> int:
+    """Converts a signed 64-bit integer read from SQLite back to an unsigned hash."""
+    return value + (1 << 64) if value < 0 else value
+
+
+class BKTree:
+    """A Burkhard-Keller tree of hashes, for queries within a Hamming distance.
+
+    Each node keeps its children by their distance to it, so by the triangle inequality
+    a query only descends into children whose distance is within the radius of the
+    distance between the query and the node.
+
+    Attributes:
+        size: The number of keys in the tree.
+    """
+
+    def __init__(self) -> None:
+        """Initializes an empty tree."""
+        # A node is a list of [hash, keys, {distance: child node}]
+        self._root: Union[List[Any], None] = None
+        self.size = 0
+
+    def add(self, value: int, key: Any) -> None:
+        """Adds a key with the given hash.
+
+        Args:
+            value: The hash.
+            key: The key returned by queries matching the hash.
+
+        Returns:
+            None.
+        """
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [key], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [key], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, Any]]:
+        """Returns the keys whose hash is within the given distance of a hash.
+
+        Args:
+            value: The hash to search for.
+            radius: The maximum Hamming distance.
+
+        Returns:
+            A list of tuples with the distance and key of each match, nearest first.
+        """
+        matches: List[Tuple[int, Any]] = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                matches.extend((distance, key) for key in node[1])
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+class PerceptualHashIndex:
+    """An index of the perceptual hashes of images, grouping near-duplicates into clusters.
+
+    Two images are near-duplicates if both their pHash and dHash are within
+    `dedup.max_distance` bits. A new image joins the cluster of its nearest
+    near-duplicate, or starts a cluster named `<source>_<id>` after itself. The index is
+    loaded from the database once and kept in memory; new hashes are buffered until
+    `flush` is called. It is safe to use from several threads.
+
+    Attributes:
+        config: The configuration data.
+        database: The database holding the hashes.
+        max_distance: The maximum Hamming distance between hashes of near-duplicates.
+    """
+
+    def __init__(self, config: dict, database: Database) -> None:
+        """Initializes the index with the hashes recorded in the database.
+
+        Args:
+            config: The configuration data.
+            database: The database holding the hashes.
+        """
+        self.config = config
+        self.database = database
+        self.max_distance = config.get("dedup", {}).get("max_distance", 8)
+        self._tree = BKTree()
+        self._hashes: Dict[Tuple[str, str], Tuple[int, int, str]] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._lock = threading.RLock()
+        for chunk in database.iter_table_chunks(
+            "image_hashes", ["source", "id", "phash", "dhash", "cluster"]
+        ):
+            for source, id, phash_value, dhash_value, cluster in chunk.itertuples(
+                index=False
+            ):
+                self._insert(
+                    source,
+                    id,
+                    to_unsigned(int(phash_value)),
+                    to_unsigned(int(dhash_value)),
+                    cluster,
+                )
+        logger.info(f"Loaded {self._tree.size} perceptual hashes")
+
+    def _insert(
+        self, source: str, id: str, phash_value: int, dhash_value: int, cluster: str
+    ) -> None:
+        """Adds the hashes of an image to the in-memory index."""
+        self._hashes[(source, id)] = (phash_value, dhash_value, cluster)
+        self._tree.add(phash_value, (source, id))
+
+    def contains(self, source: str, id: str) -> bool:
+        """Checks whether an image has been hashed.
+
+        Args:
+            source: The source of the image.
+            id: The ID of the image.
+
+        Returns:
+            True if the image is in the index, False otherwise.
+        """
+        with self._lock:
+            return (source, id) in self._hashes
+
+    def find(
+        self, phash_value: int, dhash_value: int, source: str = "", id: str = ""
+    ) -> Union[Tuple[str, str, str], None]:
+        """Returns the nearest near-duplicate of an image, other than the image itself.
+
+        Args:
+            phash_value: The pHash of the image.
+            dhash_value: The dHash of the image.
+            source: The source of the image.
+            id: The ID of the image.
+
+        Returns:
+            A tuple with the source, ID and cluster of the nearest near-duplicate, or
+            None if there is none.
+        """
+        with self._lock:
+            for _, key in self._tree.search(phash_value, self.max_distance):
+                if key == (source, id):
+                    continue
+                _, match_dhash, cluster = self._hashes[key]
+                if hamming(dhash_value, match_dhash) <= self.max_distance:
+                    return key[0], key[1], cluster
+        return None
+
+    def add(self, source: str, id: str, phash_value: int, dhash_value: int) -> str:
+        """Adds the hashes of an image, assigning it to a cluster.
+
+        Args:
+            source: The source of the image.
+            id: The ID of the image.
+            phash_value: The pHash of the image.
+            dhash_value: The dHash of the image.
+
+        Returns:
+            The cluster of the image.
+        """
+        with self._lock:
+            if (source, id) in self._hashes:
+                return self._hashes[(source, id)][2]
+            match = self.find(phash_value, dhash_value, source, id)
+            cluster = match[2] if match else f"{source}_{id}"
+            self._insert(source, id, phash_value, dhash_value, cluster)
+            self._pending.append(
+                {
+                    "source": source,
+                    "id": id,
+                    "phash": to_signed(phash_value),
+                    "dhash": to_signed(dhash_value),
+                    "cluster": cluster,
+                }
+            )
+            return cluster
+
+    def flush(self) -> None:
+        """Writes the buffered hashes to the database.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        self.database.save_image_hashes(pending)
+
+    def index_stored_images(
+        self, batch_size: int = 100, workers: Union[int, None] = None
+    ) -> int:
+        """Hashes the stored images that are not in the index yet.
+
+        Pillow releases the GIL while decoding and resizing, so a thread pool is enough
+        to hash on several cores.
+
+        Args:
+            batch_size: The number of images claimed and recorded at once.
+            workers: The number of threads. Defaults to `download.workers` in the
+                configuration, or 1.
+
+        Returns:
+            The number of images hashed.
+        """
+        workers = workers or self.config.get("download", {}).get("workers", 1)
+        hashed = 0
+        cursor = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                batch = self.database.claim_unhashed_images(batch_size, cursor)
+                if not batch:
+                    break
+                cursor = batch[-1][0]
+                futures = [
+                    (source, id, executor.submit(file_hashes, file_path))
+                    for _, source, id, file_path in batch
+                ]
+                for source, id, future in futures:
+                    try:
+                        self.add(source, id, *future.result())
+                        hashed += 1
+                    except Exception as e:
+                        logger.error(
+                            f"An exception {str(e)} of type {type(e).__name__} occurred while hashing image {source}_{id}."
+                        )
+                self.flush()
+        logger.info(f"Hashed {hashed} images")
+        return hashed
@@ -0,0 +1,278 @@
+import math
+import random
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+from PIL import Image
+from ppi.image_deriver import largest_frame, to_rgb
+
+"""Functions for preparing model inputs the way the training notebooks do"""
+
+
+def crop_names(random_crops: int) -> List[str]:
+    """Returns the names of the crops of an image, see `crop_offsets`."""
+    return ["center"] + [f"random{k}" for k in range(random_crops)]
+
+
+def crop_offsets(
+    source: str, id: str, image_size: int, crop_size: int, random_crops: int
+) -> List[Tuple[str, Tuple[int, int]]]:
+    """Returns the crops of an image features are computed for.
+
+    The `center` crop is the one the notebooks validate on, and the `random<k>` crops
+    stand in for the random crops they train on. Random crops are seeded by the image, so
+    they are the same on every run.
+
+    Args:
+        source: The source of the image.
+        id: The ID of the image.
+        image_size: The side of the square the image is resized to.
+        crop_size: The side of the crops.
+        random_crops: The number of random crops.
+
+    Returns:
+        A list of tuples with the name and the (x, y) offset of each crop.
+    """
+    center = (image_size - crop_size) // 2
+    rng = random.Random(f"{source}/{id}")
+    offsets = [(center, center)] + [
+        (rng.randint(0, image_size - crop_size), rng.randint(0, image_size - crop_size))
+        for _ in range(random_crops)
+    ]
+    return list(zip(crop_names(random_crops), offsets))
+
+
+def _bilinear_coordinates(
+    in_size: int, out_size: int, start: int, length: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the source pixels and weights of a range of pixels of a bilinear resize.
+
+    Uses half-pixel centers without antialiasing, as `tf.image.resize` does.
+
+    Args:
+        in_size: The size of the input along the axis.
+        out_size: The size of the resized output along the axis.
+        start: The first output pixel.
+        length: The number of output pixels.
+
+    Returns:
+        A tuple with the lower and upper source pixels and the weight of the upper one.
+    """
+    position = (np.arange(start, start + length) + 0.5) * (in_size / out_size) - 0.5
+    position = np.clip(position, 0, in_size - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, in_size - 1)
+    return lower, upper, (position - lower).astype(np.float32)
+
+
+def resized_crop(
+    array: np.ndarray,
+    image_size: Union[int, Tuple[int, int]],
+    offset: Tuple[int, int],
+    crop_size: int,
+) -> np.ndarray:
+    """Cuts a crop out of a bilinearly resized image, computing only the crop.
+
+    Equivalent to `tf.image.resize(array, (height, width))` followed by the crop,
+    without TensorFlow and without resizing the rest of the image.
+
+    Args:
+        array: The image, of shape (height, width, channels).
+        image_size: The side of the square the image is resized to, or the (width,
+            height) it is resized to.
+        offset: The (x, y) offset of the crop in the resized image.
+        crop_size: The side of the crop.
+
+    Returns:
+        The float32 crop, of shape (crop_size, crop_size, channels).
+    """
+    width, height = (
+        (image_size, image_size) if isinstance(image_size, int) else image_size
+    )
+    top, bottom, y_weight = _bilinear_coordinates(
+        array.shape[0], height, offset[1], crop_size
+    )
+    left, right, x_weight = _bilinear_coordinates(
+        array.shape[1], width, offset[0], crop_size
+    )
+    # Interpolate the rows of the source patch under the crop, then its columns
+    y0, x0 = top[0], left[0]
+    patch = array[y0 : bottom[-1] + 1, x0 : right[-1] + 1].astype(np.float32)
+    y_weight = y_weight[:, None, None]
+    rows = patch[top - y0] * (1 - y_weight) + patch[bottom - y0] * y_weight
+    x_weight = x_weight[None, :, None]
+    return rows[:, left - x0] * (1 - x_weight) + rows[:, right - x0] * x_weight
+
+
+def tile_offsets(width: int, height: int, tile_size: int) -> List[Tuple[int, int]]:
+    """Returns the offsets of a grid of tiles covering an image, center tile first.
+
+    Each axis gets the fewest evenly spaced tiles that leave no gap, so neighbouring
+    tiles overlap by less than a tile.
+
+    Args:
+        width: The width of the image.
+        height: The height of the image.
+        tile_size: The side of the tiles.
+
+    Returns:
+        A list with the (x, y) offset of the center tile, followed by the offsets of
+        the other tiles of the grid, row by row.
+    """
+    xs = np.linspace(0, width - tile_size, math.ceil(width / tile_size)).round()
+    ys = np.linspace(0, height - tile_size, math.ceil(height / tile_size)).round()
+    center = ((width - tile_size) // 2, (height - tile_size) // 2)
+    grid = [(int(x), int(y)) for y in ys for x in xs]
+    return [center] + [offset for offset in grid if offset != center]
+
+
+def load_array(path: str) -> np.ndarray:
+    """Decodes the largest frame of an image into a uint8 RGB array.
+
+    Args:
+        path: The path of the image.
+
+    Returns:
+        The image, of shape (height, width, 3).
+    """
+    with Image.open(path) as image:
+        largest_frame(image)
+        return np.asarray(to_rgb(image))
+
+
+def load_square(path: str) -> np.ndarray:
+    """Decodes an image and crops it to a centered square.
+
+    This is what `image_dataset_from_directory(..., crop_to_aspect_ratio=True)` does
+    before resizing to its square `image_size`.
+
+    Args:
+        path: The path of the image.
+
+    Returns:
+        The uint8 RGB square, of shape (side, side, 3).
+    """
+    array = load_array(path)
+    height, width = array.shape[:2]
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    return array[top : top + side, left : left + side]
+
+
+def load_crops(
+    path: str, offsets: List[Tuple[int, int]], image_size: int, crop_size: int
+) -> np.ndarray:
+    """Decodes an image and cuts the given crops, as the training notebooks do.
+
+    The image is cropped to a centered square and resized bilinearly to `image_size`,
+    as `image_dataset_from_directory(..., crop_to_aspect_ratio=True)` does.
+
+    Args:
+        path: The path of the image.
+        offsets: The (x, y) offsets of the crops.
+        image_size: The side of the square the image is resized to.
+        crop_size: The side of the crops.
+
+    Returns:
+        An array of shape (crops, crop_size, crop_size, 3) with the crops.
+    """
+    square = load_square(path)
+    return np.stack(
+        [resized_crop(square, image_size, offset, crop_size) for offset in offsets]
+    )
+
+
+def load_tiles(path: str, image_size: int, tile_size: int) -> np.ndarray:
+    """Decodes an image and cuts it into a grid of tiles, see `tile_offsets`.
+
+    The whole image is resized bilinearly so that its shorter side is `image_size`, the
+    scale the notebooks crop at. The center tile is cut from the centered square as in
+    `load_crops`, so it is exactly the crop the notebooks predict on.
+
+    Args:
+        path: The path of the image.
+        image_size: The shorter side of the resized image.
+        tile_size: The side of the tiles.
+
+    Returns:
+        An array of shape (tiles, tile_size, tile_size, 3) with the center tile first.
+    """
+    array = load_array(path)
+    height, width = array.shape[:2]
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    center = (image_size - tile_size) // 2
+    tiles = [
+        resized_crop(
+            array[top : top + side, left : left + side],
+            image_size,
+            (center, center),
+            tile_size,
+        )
+    ]
+    size = (
+        max(image_size, round(width * image_size / side)),
+        max(image_size, round(height * image_size / side)),
+    )
+    for offset in tile_offsets(*size, tile_size)[1:]:
+        tiles.append(resized_crop(array, size, offset, tile_size))
+    return np.stack(tiles)
+
+
+def load_model_input(
+    item: Tuple[str, str, str], image_size: int, crop_size: int, tiles: bool = False
+) -> Tuple[str, str, Union[np.ndarray, None], Union[str, None]]:
+    """Decodes an image into the crops a model predicts on.
+
+    Without tiles, this is the center crop the notebooks validate and predict on. Meant
+    to run in a worker process, so errors are returned instead of raised and one
+    unreadable file does not stop a run.
+
+    Args:
+        item: The source, ID and path of the image.
+        image_size: The side of the square the image is resized to.
+        crop_size: The side of the crops.
+        tiles: Whether to cut the image into a grid of tiles, see `load_tiles`.
+
+    Returns:
+        A tuple with the source and ID of the image, the crops of shape
+        (crops, crop_size, crop_size, 3) with the center crop first or None, and the
+        error message or None.
+    """
+    source, id, path = item
+    center = (image_size - crop_size) // 2
+    try:
+        if tiles:
+            return source, id, load_tiles(path, image_size, crop_size), None
+        crops = load_crops(path, [(center, center)], image_size, crop_size)
+        return source, id, crops, None
+    except Exception as e:
+        return source, id, None, f"{type(e).__name__}: {str(e)}"
+
+
+def bounded_map(
+    executor: Executor, function: Callable, items: Iterable, window: int
+) -> Iterator[Any]:
+    """Maps a function over items in an executor, keeping at most `window` results pending.
+
+    Unlike `Executor.map`, items are submitted as results are consumed, so memory use is
+    bounded when results are large.
+
+    Args:
+        executor: The thread or process pool.
+        function: The function to apply to each item. It must be picklable for a
+            process pool.
+        items: The items.
+        window: The maximum number of submitted items whose result was not consumed yet.
+
+    Returns:
+        An iterator over the results, in the order of the items.
+    """
+    pending: Deque[Future] = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
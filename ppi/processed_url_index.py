@@ -0,0 +1,230 @@
+import hashlib
+import math
+import sys
+from typing import Dict, List, Set, Union
+from loguru import logger
+from ppi.database import Database, DBAction
+
+"""Class for answering crawler deduplication checks from memory"""
+
+
+class BloomFilter:
+    """A Bloom filter over byte strings, backed by a bit array.
+
+    Attributes:
+        num_bits: The number of bits in the filter.
+        num_hashes: The number of bit positions set for each entry.
+        num_entries: The number of entries added to the filter.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float) -> None:
+        """Initializes an empty filter sized for the given capacity.
+
+        Args:
+            capacity: The expected number of entries.
+            false_positive_rate: The target false positive rate at full capacity.
+        """
+        capacity = max(capacity, 1)
+        self.num_bits = max(
+            8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.num_entries = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: bytes) -> List[int]:
+        """Returns the bit positions of a key, using double hashing.
+
+        Args:
+            key: The key to hash.
+
+        Returns:
+            A list of bit positions.
+        """
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key: bytes) -> None:
+        """Adds a key to the filter.
+
+        Args:
+            key: The key to add.
+
+        Returns:
+            None.
+        """
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.num_entries += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    @property
+    def memory_bytes(self) -> int:
+        """The number of bytes used by the bit array."""
+        return sys.getsizeof(self._bits)
+
+    @property
+    def false_positive_rate(self) -> float:
+        """The expected false positive rate for the current number of entries."""
+        return (
+            1 - math.exp(-self.num_hashes * self.num_entries / self.num_bits)
+        ) ** self.num_hashes
+
+
+class ProcessedUrlIndex:
+    """An in-memory index of the URLs recorded in the log, used for deduplication.
+
+    The index is loaded once from the log and registered with the database, so that
+    new log entries are added as they are written. Logs of up to `max_exact_entries`
+    entries are held as a set of 64-bit hashes, which answers every check from memory.
+    Larger logs are held in a Bloom filter: URLs it rejects are new for certain, and
+    only the URLs it accepts are confirmed against SQLite.
+
+    Attributes:
+        database: The database with the log.
+        actions: The actions indexed.
+        ignore_log: Whether the entries logged before the index was created were left out.
+        exact: Whether the index holds a set of hashes rather than a Bloom filter.
+        num_lookups: The number of checks answered.
+        num_database_checks: The number of checks that had to be confirmed in SQLite.
+        num_false_positives: The number of confirmations that found no log entry.
+    """
+
+    def __init__(
+        self,
+        database: Database,
+        actions: List[DBAction],
+        max_exact_entries: int = 1_000_000,
+        false_positive_rate: float = 0.001,
+        ignore_log: bool = False,
+    ) -> None:
+        """Loads the index from the log and registers it with the database.
+
+        Args:
+            database: The database with the log.
+            actions: The actions to index.
+            max_exact_entries: The largest log held as a set of hashes.
+            false_positive_rate: The target false positive rate of the Bloom filter.
+            ignore_log: Whether to start empty, indexing only the entries written from
+                now on, e.g. to re-parse pages processed before.
+        """
+        self.database = database
+        self.actions = actions
+        self.ignore_log = ignore_log
+        self.num_lookups = 0
+        self.num_database_checks = 0
+        self.num_false_positives = 0
+        num_entries = 0 if ignore_log else database.count_log(actions)
+        self.exact = num_entries <= max_exact_entries
+        self._keys: Union[Set[int], BloomFilter]
+        if self.exact:
+            self._keys = set()
+        else:
+            # Leave room for the entries written during the crawl
+            self._keys = BloomFilter(2 * num_entries, false_positive_rate)
+        if not ignore_log:
+            for action, url in database.iter_log(actions):
+                self.add(action, url)
+        database.register_url_index(self)
+        logger.info(f"Loaded processed URL index: {self.stats()}")
+
+    @staticmethod
+    def _key(action: DBAction, url: str) -> bytes:
+        """Returns the key of a log entry.
+
+        Args:
+            action: The action of the entry.
+            url: The URL of the entry.
+
+        Returns:
+            The key as bytes.
+        """
+        return f"{action.value}\t{url}".encode()
+
+    def add(self, action: DBAction, url: str) -> None:
+        """Adds a log entry to the index.
+
+        Args:
+            action: The action of the entry.
+            url: The URL of the entry.
+
+        Returns:
+            None.
+        """
+        if action not in self.actions:
+            return
+        key = self._key(action, url)
+        if isinstance(self._keys, BloomFilter):
+            self._keys.add(key)
+        else:
+            digest = hashlib.blake2b(key, digest_size=8).digest()
+            self._keys.add(int.from_bytes(digest, "little"))
+
+    def contains(self, action: DBAction, url: str) -> bool:
+        """Checks whether an entry exists in the log for the given action and URL.
+
+        Args:
+            action: The action to check for.
+            url: The URL to check for.
+
+        Returns:
+            True if an entry exists in the log for the given action and URL, False otherwise.
+        """
+        self.num_lookups += 1
+        key = self._key(action, url)
+        if isinstance(self._keys, BloomFilter):
+            if key not in self._keys:
+                return False
+            self.num_database_checks += 1
+            if self.database.check_log(action, url):
+                return True
+            self.num_false_positives += 1
+            return False
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return int.from_bytes(digest, "little") in self._keys
+
+    @property
+    def memory_bytes(self) -> int:
+        """The approximate number of bytes used by the index."""
+        if isinstance(self._keys, BloomFilter):
+            return self._keys.memory_bytes
+        return sys.getsizeof(self._keys) + sum(sys.getsizeof(key) for key in self._keys)
+
+    @property
+    def false_positive_rate(self) -> float:
+        """The expected rate of URLs wrongly reported as present by the in-memory structure.
+
+        For the Bloom filter, false positives are caught by the confirmation in SQLite.
+        For the set of hashes, this is the probability of a 64-bit hash collision.
+        """
+        if isinstance(self._keys, BloomFilter):
+            return self._keys.false_positive_rate
+        return len(self._keys) / 2**64
+
+    def stats(self) -> Dict[str, Union[int, float, str]]:
+        """Returns statistics about the index.
+
+        Returns:
+            A dictionary with the representation, size, memory use, false positive rate
+            and lookup counters of the index.
+        """
+        return {
+            "representation": "set" if self.exact else "bloom",
+            "entries": (
+                len(self._keys)
+                if isinstance(self._keys, set)
+                else self._keys.num_entries
+            ),
+            "memory_bytes": self.memory_bytes,
+            "false_positive_rate": self.false_positive_rate,
+            "lookups": self.num_lookups,
+            "database_checks": self.num_database_checks,
+            "false_positives": self.num_false_positives,
+        }
@@ -0,0 +1,214 @@
+import email.utils
+import threading
+import time
+import requests
+from typing import Dict, Union
+from urllib.parse import urlparse
+from loguru import logger
+
+"""Classes for throttling requests per host"""
+
+
+# Settings used for hosts (and setting keys) missing from the `rate_limits` configuration
+DEFAULT_LIMITS: Dict[str, float] = {
+    "rate": 1.0,  # Requests per second
+    "burst": 1,  # Requests that can be made at once after an idle period
+    "min_rate": 0.05,  # Lowest rate reached when backing off
+    "max_rate": 4.0,  # Highest rate reached when ramping up
+    "backoff_factor": 0.5,  # Rate multiplier applied on 429/503 responses
+    "ramp_up": 0.05,  # Rate increase per healthy response
+    "backoff_delay": 1.0,  # Pause after the first 429/503 response, doubled on each repeat
+    "max_backoff_delay": 300.0,  # Longest pause after a 429/503 response
+}
+
+# Statuses telling the client to slow down
+THROTTLING_STATUSES = (429, 503)
+
+
+class TokenBucket:
+    """A token bucket with an adaptive rate, for throttling requests to one host.
+
+    The rate is decreased multiplicatively and requests are paused when the host
+    throttles, and the rate is increased additively while responses are healthy.
+
+    Attributes:
+        rate: The current number of tokens added per second.
+        burst: The maximum number of tokens held.
+        limits: The settings of the bucket, see `DEFAULT_LIMITS`.
+    """
+
+    def __init__(self, limits: Dict[str, float]) -> None:
+        """Initializes a full bucket.
+
+        Args:
+            limits: The settings of the bucket, see `DEFAULT_LIMITS`.
+        """
+        self.limits = limits
+        self.rate = limits["rate"]
+        self.burst = limits["burst"]
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._num_throttled = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """Adds the tokens accumulated since the last update.
+
+        Args:
+            now: The current monotonic time.
+
+        Returns:
+            None.
+        """
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """Blocks until a token is available and takes it.
+
+        Returns:
+            None.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self) -> None:
+        """Ramps the rate up after a healthy response.
+
+        Returns:
+            None.
+        """
+        with self._lock:
+            self._num_throttled = 0
+            self.rate = min(self.limits["max_rate"], self.rate + self.limits["ramp_up"])
+
+    def on_throttled(self, retry_after: Union[float, None] = None) -> float:
+        """Backs off after the host asked to slow down.
+
+        Args:
+            retry_after: The number of seconds the host asked to wait, if given.
+
+        Returns:
+            The number of seconds requests are paused for.
+        """
+        with self._lock:
+            self.rate = max(
+                self.limits["min_rate"], self.rate * self.limits["backoff_factor"]
+            )
+            delay = min(
+                self.limits["max_backoff_delay"],
+                self.limits["backoff_delay"] * 2**self._num_throttled,
+            )
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self._num_throttled += 1
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            return delay
+
+
+class RateLimiter:
+    """Throttles requests with one token bucket per host.
+
+    A single instance should be shared by all crawlers and downloaders (through
+    `HttpClient`), so that requests to the same host are throttled together.
+
+    Attributes:
+        config: The rate limit configuration, with `default` settings and per-host
+            settings under `hosts`.
+    """
+
+    def __init__(self, config: Union[dict, None] = None) -> None:
+        """Initializes the rate limiter.
+
+        Args:
+            config: The `rate_limits` section of the configuration.
+        """
+        self.config = config or {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, url: str) -> TokenBucket:
+        """Returns the token bucket of the host of a URL, creating it if needed.
+
+        Args:
+            url: The URL to be requested.
+
+        Returns:
+            The token bucket of the host.
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                limits = {
+                    **DEFAULT_LIMITS,
+                    **self.config.get("default", {}),
+                    **self.config.get("hosts", {}).get(host, {}),
+                }
+                self._buckets[host] = TokenBucket(limits)
+            return self._buckets[host]
+
+    def acquire(self, url: str) -> None:
+        """Blocks until a request to the host of the URL is allowed.
+
+        Args:
+            url: The URL to be requested.
+
+        Returns:
+            None.
+        """
+        self._bucket(url).acquire()
+
+    def update(self, url: str, response: requests.Response) -> bool:
+        """Adapts the rate of the host of the URL to a response.
+
+        Args:
+            url: The URL that was requested.
+            response: The response received.
+
+        Returns:
+            True if the host asked to slow down, False otherwise.
+        """
+        bucket = self._bucket(url)
+        if response.status_code in THROTTLING_STATUSES:
+            delay = bucket.on_throttled(
+                _parse_retry_after(response.headers.get("Retry-After"))
+            )
+            logger.warning(
+                f"Throttled by {urlparse(url).netloc} with status {response.status_code}, pausing for {delay:.1f}s at {bucket.rate:.2f} requests/s"
+            )
+            return True
+        bucket.on_success()
+        return False
+
+
+def _parse_retry_after(value: Union[str, None]) -> Union[float, None]:
+    """Parses a `Retry-After` header given in seconds or as an HTTP date.
+
+    Args:
+        value: The value of the header.
+
+    Returns:
+        The number of seconds to wait, or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
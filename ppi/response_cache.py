@@ -0,0 +1,213 @@
+import datetime as dt
+import hashlib
+import json
+import os
+import uuid
+import requests
+from requests.structures import CaseInsensitiveDict
+from typing import Dict, Union
+from loguru import logger
+
+"""Class for caching HTTP responses on disk"""
+
+
+CACHE_MODES = ("revalidate", "replay")
+
+# Headers describing the transfer rather than the (decoded) body that is cached
+TRANSFER_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a URL is not in the cache."""
+
+
+class ResponseCache:
+    """A content-addressed cache of HTTP responses on disk.
+
+    Bodies are stored once per distinct content under `bodies/`, named by their sha256.
+    Each URL has an entry under `entries/` with its headers, ETag, Last-Modified and
+    the hash of its body. In `revalidate` mode cached responses are revalidated with
+    `If-None-Match`/`If-Modified-Since`, and in `replay` mode they are served without
+    any network access.
+
+    Attributes:
+        directory: The directory holding the cache.
+        mode: The cache mode, either `revalidate` or `replay`.
+    """
+
+    def __init__(self, directory: str, mode: str = "revalidate") -> None:
+        """Initializes the cache.
+
+        Args:
+            directory: The directory holding the cache.
+            mode: The cache mode, either `revalidate` or `replay`.
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(
+                f"Unknown cache mode {mode}, expected one of {CACHE_MODES}"
+            )
+        self.directory = directory
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, url: str) -> str:
+        """Returns the path of the entry of a URL.
+
+        Args:
+            url: The URL.
+
+        Returns:
+            The path of the entry.
+        """
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, "entries", digest[:2], f"{digest}.json")
+
+    def _body_path(self, body_sha256: str) -> str:
+        """Returns the path of a body.
+
+        Args:
+            body_sha256: The sha256 of the body.
+
+        Returns:
+            The path of the body.
+        """
+        return os.path.join(self.directory, "bodies", body_sha256[:2], body_sha256)
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        """Writes a file atomically.
+
+        Args:
+            path: The path of the file.
+            data: The content of the file.
+
+        Returns:
+            None.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique, so that threads writing the same file do not clash
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+
+    def lookup(self, url: str) -> Union[Dict, None]:
+        """Returns the cache entry of a URL.
+
+        Args:
+            url: The URL.
+
+        Returns:
+            The cache entry, or None if the URL is not cached.
+        """
+        path = self._entry_path(url)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            entry = json.load(file)
+        if not os.path.exists(self._body_path(entry["body_sha256"])):
+            return None
+        return entry
+
+    def conditional_headers(self, entry: Dict) -> Dict[str, str]:
+        """Returns the headers for revalidating a cache entry.
+
+        Args:
+            entry: The cache entry.
+
+        Returns:
+            The `If-None-Match` and `If-Modified-Since` headers available for the entry.
+        """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def load(self, url: str, entry: Dict) -> requests.Response:
+        """Builds a response from a cache entry.
+
+        Args:
+            url: The URL of the entry.
+            entry: The cache entry.
+
+        Returns:
+            The cached response.
+        """
+        with open(self._body_path(entry["body_sha256"]), "rb") as file:
+            body = file.read()
+        response = requests.Response()
+        response.status_code = entry["status_code"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.url = url
+        response.encoding = entry["encoding"]
+        response._content = body
+        return response
+
+    def store(self, url: str, response: requests.Response) -> None:
+        """Stores a response in the cache.
+
+        Args:
+            url: The URL that was requested.
+            response: The response, with its body already read.
+
+        Returns:
+            None.
+        """
+        body_sha256 = hashlib.sha256(response.content).hexdigest()
+        body_path = self._body_path(body_sha256)
+        if not os.path.exists(body_path):
+            self._write(body_path, response.content)
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key.lower() not in TRANSFER_HEADERS
+        }
+        self._save_entry(
+            url,
+            {
+                "url": url,
+                "status_code": response.status_code,
+                "headers": headers,
+                "encoding": response.encoding,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "body_sha256": body_sha256,
+                "fetched_at": dt.datetime.now().isoformat(),
+            },
+        )
+
+    def refresh(self, url: str, entry: Dict, response: requests.Response) -> None:
+        """Updates a cache entry after a `304 Not Modified` response.
+
+        Args:
+            url: The URL that was requested.
+            entry: The cache entry.
+            response: The `304 Not Modified` response.
+
+        Returns:
+            None.
+        """
+        for header, key in [("ETag", "etag"), ("Last-Modified", "last_modified")]:
+            if response.headers.get(header):
+                entry[key] = response.headers[header]
+        entry["fetched_at"] = dt.datetime.now().isoformat()
+        self._save_entry(url, entry)
+
+    def _save_entry(self, url: str, entry: Dict) -> None:
+        """Writes the entry of a URL.
+
+        Args:
+            url: The URL.
+            entry: The cache entry.
+
+        Returns:
+            None.
+        """
+        self._write(self._entry_path(url), json.dumps(entry).encode())
+        logger.debug(f"Cached response for {url}")
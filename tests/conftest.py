@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+import pytest
+from ppi.database import Database
+
+"""Fixtures shared by the tests"""
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture
+def config(tmp_path) -> dict:
+    """A configuration writing to a temporary directory, without throttling or caching."""
+    return {
+        "db_name": str(tmp_path / "ppi.db"),
+        "http": {"cache_dir": "", "max_retries": 0},
+        "rate_limits": {"default": {"rate": 1000.0, "burst": 1000}},
+        "crawler": {"concurrency_per_host": 4, "max_workers": 16},
+        "download": {"target_resolution": 1000, "skip_duplicates": False},
+        "dir": {
+            "download": str(tmp_path / "IMAGES" / "DOWNLOAD"),
+            "store": str(tmp_path / "IMAGES" / "STORE"),
+            "backup": str(tmp_path / "IMAGES" / "BACKUP"),
+        },
+        "allowed_processes": ["CYANOTYPE", "SALTED_PAPER_PRINT"],
+    }
+
+
+@pytest.fixture
+def database(config) -> Database:
+    """An empty database with the current schema."""
+    database = Database(db_name=config["db_name"])
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def read_fixture():
+    """Returns a function reading the text of a file under `tests/fixtures`."""
+
+    def read(*path: str) -> str:
+        with open(os.path.join(FIXTURES_DIR, *path), encoding="utf-8") as file:
+            return file.read()
+
+    return read
+
+
+class FakeSite:
+    """Pages served by `http_server`, and statistics of the requests received.
+
+    Attributes:
+        pages: The content type and body served for each path, including the query.
+        etags: The ETag of each path that supports revalidation with `If-None-Match`.
+        errors: Error statuses sent for each path, in order, before its page is served.
+        delay: The number of seconds each response is delayed by.
+        requests: The paths requested, in order.
+        not_modified: The number of `304 Not Modified` responses sent.
+        max_in_flight: The most requests handled at once for each `Host` header.
+    """
+
+    def __init__(self) -> None:
+        self.pages: Dict[str, Tuple[str, bytes]] = {}
+        self.etags: Dict[str, str] = {}
+        self.errors: Dict[str, List[int]] = {}
+        self.delay = 0.0
+        self.requests: List[str] = []
+        self.not_modified = 0
+        self.max_in_flight: Dict[str, int] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_page(self, path: str, body: str, content_type: str = "text/html") -> None:
+        self.pages[path] = (content_type, body.encode("utf-8"))
+
+    def handle(self, handler: BaseHTTPRequestHandler) -> None:
+        host = handler.headers.get("Host", "")
+        with self._lock:
+            self.requests.append(handler.path)
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            self.max_in_flight[host] = max(
+                self.max_in_flight.get(host, 0), self._in_flight[host]
+            )
+        try:
+            time.sleep(self.delay)
+            if handler.path not in self.pages:
+                handler.send_error(404)
+                return
+            with self._lock:
+                errors = self.errors.get(handler.path)
+                status = errors.pop(0) if errors else None
+            if status is not None:
+                handler.send_response(status)
+                handler.send_header("Retry-After", "0")
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+                return
+            etag = self.etags.get(handler.path)
+            if etag is not None and handler.headers.get("If-None-Match") == etag:
+                with self._lock:
+                    self.not_modified += 1
+                handler.send_response(304)
+                handler.send_header("ETag", etag)
+                handler.end_headers()
+                return
+            content_type, body = self.pages[handler.path]
+            handler.send_response(200)
+            handler.send_header("Content-Type", content_type)
+            if etag is not None:
+                handler.send_header("ETag", etag)
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        finally:
+            with self._lock:
+                self._in_flight[host] -= 1
+
+
+@pytest.fixture
+def http_server():
+    """A local HTTP server, as a tuple of its base URL on `localhost` and its `FakeSite`."""
+    site = FakeSite()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            site.handle(self)
+
+        def log_message(self, format: str, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}", site
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from ppi.classify import ImageClassifier, aggregate
+from ppi.preprocessing import tile_offsets
+
+"""Tests of the tiled classification of images"""
+
+
+TILES = np.array([[0.9, 0.1], [0.5, 0.5], [0.2, 0.8]])
+
+
+def test_aggregate():
+    assert aggregate(TILES, "mean") == pytest.approx([8 / 15, 7 / 15])
+    assert aggregate(TILES, "max") == pytest.approx([0.9 / 1.7, 0.8 / 1.7])
+    # The uniform tile has no weight, and the most confident tile the most
+    entropy = aggregate(TILES, "entropy")
+    assert entropy.sum() == pytest.approx(1)
+    assert entropy[0] > aggregate(TILES[[0, 2]], "mean")[0]
+    uniform = np.full((2, 2), 0.5)
+    assert aggregate(uniform, "entropy") == pytest.approx([0.5, 0.5])
+    with pytest.raises(ValueError):
+        aggregate(TILES, "median")
+
+
+def test_tile_offsets_cover_the_image_center_first():
+    offsets = tile_offsets(1500, 1000, 400)
+    assert offsets[0] == (550, 300)
+    assert len(offsets) == 4 * 3 + 1
+    assert {x for x, _ in offsets} >= {0, 1100}
+    assert {y for _, y in offsets} >= {0, 600}
+
+
+def predict(batch: np.ndarray) -> np.ndarray:
+    """Scores the first class with the brightness of the crops."""
+    brightness = batch.mean(axis=(1, 2, 3)) / 255
+    return np.stack([brightness, 1 - brightness], axis=1)
+
+
+def tiles(center: int, others: list) -> np.ndarray:
+    return np.stack(
+        [np.full((4, 4, 3), value, np.float32) for value in [center] + others]
+    )
+
+
+def predictions(database) -> dict:
+    with database.engine.connect() as connection:
+        return {
+            (id, rank): (label, round(probability, 3))
+            for id, rank, label, probability in connection.exec_driver_sql(
+                "select id, rank, label, probability FROM predictions"
+            )
+        }
+
+
+def test_only_uncertain_images_are_scored_on_all_tiles(config, database):
+    config["classify"] = {"tiles": "mean", "tile_threshold": 0.9, "top_k": 1}
+    classifier = ImageClassifier(
+        config, database, "model.keras", labels=["BRIGHT", "DARK"], predict=predict
+    )
+    assert classifier.model_name == "model.keras:tiles-mean"
+    scored = classifier._score(
+        [("test", "confident"), ("test", "uncertain")],
+        [tiles(255, [0, 0]), tiles(102, [0, 0, 0])],
+    )
+    assert scored == 2 + 3
+    assert predictions(database) == {
+        ("confident", 1): ("BRIGHT", 1.0),
+        ("uncertain", 1): ("DARK", 0.9),
+    }
+
+
+def test_unknown_tile_aggregation(config, database):
+    config["classify"] = {"tiles": "median"}
+    with pytest.raises(ValueError):
+        ImageClassifier(config, database, "model.keras", predict=predict)
@@ -0,0 +1,322 @@
+import gc
+import time
+import weakref
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from ppi.database import (
+    DEFAULT_PRAGMAS,
+    SCHEMA_VERSION,
+    Database,
+    DBAction,
+    DBActionStatus,
+    LogWriter,
+)
+
+"""Tests of the Database queries"""
+
+
+def save_images(database, rows) -> None:
+    database.save_data(
+        pd.DataFrame(rows, columns=["source", "id", "url", "medium"]), "images"
+    )
+
+
+def test_claim_downloads_returns_duplicate_images_once(database):
+    save_images(
+        database,
+        [
+            ("LibraryOfCongressCrawler", "1", "https://example.org/1.tif", "CYANOTYPE"),
+            ("LibraryOfCongressCrawler", "2", "https://example.org/2.tif", "CYANOTYPE"),
+            ("LibraryOfCongressCrawler", "1", "https://example.org/1.tif", "CYANOTYPE"),
+        ],
+    )
+    database.save_data(
+        pd.DataFrame(
+            [
+                ("LibraryOfCongressCrawler", "1", "CYANOTYPE"),
+                ("LibraryOfCongressCrawler", "2", "CYANOTYPE"),
+            ],
+            columns=["source", "id", "new_medium"],
+        ),
+        "mediums",
+    )
+    for medium in ["CYANOTYPE", None]:
+        claimed = database.claim_downloads(medium, n=10)
+        assert [(source, id) for _, source, id, _ in claimed] == [
+            ("LibraryOfCongressCrawler", "1"),
+            ("LibraryOfCongressCrawler", "2"),
+        ]
+
+
+def test_claim_downloads_paginates_past_duplicates(database):
+    save_images(
+        database,
+        [
+            ("LibraryOfCongressCrawler", "1", "https://example.org/1.tif", "CYANOTYPE"),
+            ("LibraryOfCongressCrawler", "2", "https://example.org/2.tif", "CYANOTYPE"),
+            ("LibraryOfCongressCrawler", "1", "https://example.org/1.tif", "CYANOTYPE"),
+            ("LibraryOfCongressCrawler", "3", "https://example.org/3.tif", "CYANOTYPE"),
+        ],
+    )
+    claimed, cursor = [], 0
+    while True:
+        batch = database.claim_downloads(n=1, after=cursor)
+        if not batch:
+            break
+        cursor = batch[-1][0]
+        claimed.extend(id for _, _, id, _ in batch)
+    assert claimed == ["1", "2", "3"]
+
+
+def logged_urls(database) -> list:
+    with database.engine.connect() as connection:
+        return [
+            row[0]
+            for row in connection.exec_driver_sql("select url FROM log order by rowid")
+        ]
+
+
+def test_log_is_flushed_by_timer_without_further_writes(config):
+    database = Database(db_name=config["db_name"], log_flush_interval=0.1)
+    try:
+        database.write_log(
+            "test",
+            DBAction.PAGE_PROCESS,
+            DBActionStatus.SUCCESS,
+            "https://example.org/1",
+        )
+        assert logged_urls(database) == []
+        deadline = time.monotonic() + 5
+        while not logged_urls(database) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert logged_urls(database) == ["https://example.org/1"]
+        assert not database.log_writer.contains(
+            DBAction.PAGE_PROCESS, "https://example.org/1"
+        )
+    finally:
+        database.close()
+
+
+def test_log_is_flushed_on_close(config):
+    database = Database(db_name=config["db_name"], log_flush_interval=60)
+    database.write_log(
+        "test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, "https://example.org/1"
+    )
+    database.close()
+    assert logged_urls(database) == ["https://example.org/1"]
+
+
+def test_log_writer_flushes_when_garbage_collected(config, database):
+    log_writer = LogWriter(database.engine, flush_interval=60)
+    log_writer.write(
+        "test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, "https://example.org/1"
+    )
+    del log_writer
+    gc.collect()
+    assert logged_urls(database) == ["https://example.org/1"]
+
+
+def test_abandoned_database_is_not_kept_alive_at_exit(config, database):
+    abandoned = Database(db_name=config["db_name"], log_flush_interval=60)
+    abandoned.write_log(
+        "test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, "https://example.org/1"
+    )
+    log_writer = weakref.ref(abandoned.log_writer)
+    del abandoned
+    gc.collect()
+    assert log_writer() is None
+    assert logged_urls(database) == ["https://example.org/1"]
+
+
+def image_df(id: str, medium: str) -> pd.DataFrame:
+    return pd.DataFrame(
+        [("LibraryOfCongressCrawler", id, f"https://example.org/{id}.tif", medium)],
+        columns=["source", "id", "url", "medium"],
+    )
+
+
+def test_replace_image_metadata_remaps_changed_mediums(database):
+    database.save_data(image_df("1", "Cyanotype"), "images")
+    database.save_data(image_df("2", "Cyanotype"), "images")
+    database.save_medium_mappings(
+        {"Cyanotype": "CYANOTYPE", "Salt print": "SALTED_PAPER_PRINT"}
+    )
+    assert database.map_mediums(database.get_last_image_rowid()) == 2
+
+    database.replace_image_metadata(image_df("1", "Salt print"))
+    assert database.get_medium("LibraryOfCongressCrawler", "1") == "SALTED_PAPER_PRINT"
+    assert database.get_medium("LibraryOfCongressCrawler", "2") == "CYANOTYPE"
+
+    # A medium without a mapping yet is mapped by the next incremental run
+    database.replace_image_metadata(image_df("2", "Albumen print"))
+    assert database.get_medium("LibraryOfCongressCrawler", "2") is None
+    database.save_medium_mappings({"Albumen print": "ALBUMEN_PRINT"})
+    assert database.map_mediums(database.get_last_image_rowid()) == 1
+    assert database.get_medium("LibraryOfCongressCrawler", "2") == "ALBUMEN_PRINT"
+    assert database.get_medium("LibraryOfCongressCrawler", "1") == "SALTED_PAPER_PRINT"
+
+
+def test_migrates_tables_created_by_earlier_versions(config):
+    engine = create_engine("sqlite:///" + config["db_name"])
+    pd.DataFrame(
+        [("test", "download", "SUCCESS", "https://example.org/1.tif", "01/01/2023")],
+        columns=["source", "action", "status", "url", "date"],
+    ).to_sql("log", con=engine, index=False)
+    pd.DataFrame(
+        [("test", "1", "https://example.org/1.tif", "cyanotype")],
+        columns=["source", "id", "url", "medium"],
+    ).to_sql("images", con=engine, index=False)
+    engine.dispose()
+    database = Database(db_name=config["db_name"])
+    try:
+        with database.engine.connect() as connection:
+            version = connection.exec_driver_sql("pragma user_version").scalar()
+            status = connection.exec_driver_sql(
+                "select download_status FROM images"
+            ).scalar()
+        assert version == SCHEMA_VERSION
+        assert status == "SUCCESS"
+        assert database.check_log(DBAction.DOWNLOAD, "https://example.org/1.tif")
+    finally:
+        database.close()
+
+
+def test_check_log_uses_the_log_index(database):
+    with database.engine.connect() as connection:
+        plan = connection.exec_driver_sql(
+            "explain query plan select exists(select 1 FROM log "
+            "where action = 'download' and url = 'https://example.org/1.tif')"
+        ).fetchall()
+    assert any("ix_log_action_url" in row[-1] for row in plan)
+
+
+def test_replacing_a_managed_table_keeps_its_indexes(database):
+    save_images(database, [("test", "1", "https://example.org/1.tif", "cyanotype")])
+    database.save_data(
+        pd.DataFrame(
+            [("test", "2", "https://example.org/2.tif", "cyanotype")],
+            columns=["source", "id", "url", "medium"],
+        ),
+        "images",
+        if_exists="replace",
+    )
+    with database.engine.connect() as connection:
+        indexes = [
+            row[1] for row in connection.exec_driver_sql("pragma index_list(images)")
+        ]
+        ids = [row[0] for row in connection.exec_driver_sql("select id FROM images")]
+    assert "ix_images_url" in indexes
+    assert ids == ["2"]
+
+
+def test_logged_downloads_leave_the_download_queue(database):
+    save_images(
+        database,
+        [
+            ("test", "1", "https://example.org/1.tif", "cyanotype"),
+            ("test", "2", "https://example.org/2.tif", "cyanotype"),
+            ("test", "3", "https://example.org/3.tif", "cyanotype"),
+        ],
+    )
+    database.write_log(
+        "test", DBAction.DOWNLOAD, DBActionStatus.SUCCESS, "https://example.org/1.tif"
+    )
+    database.write_log(
+        "test", DBAction.DOWNLOAD, DBActionStatus.FAILURE, "https://example.org/2.tif"
+    )
+    database.flush_log()
+    assert [id for _, _, id, _ in database.claim_downloads()] == ["3"]
+    assert [id for _, _, id, _ in database.claim_downloads(retry_failed=True)] == [
+        "2",
+        "3",
+    ]
+    assert database.get_next_image_download() == (
+        "test",
+        "3",
+        "https://example.org/3.tif",
+    )
+
+
+def test_pragmas_are_set_on_every_connection(config):
+    database = Database(
+        db_name=config["db_name"], pragmas={**DEFAULT_PRAGMAS, "busy_timeout": 1234}
+    )
+    try:
+        for _ in range(2):
+            with database.engine.connect() as connection:
+                assert (
+                    connection.exec_driver_sql("pragma journal_mode").scalar() == "wal"
+                )
+                assert (
+                    connection.exec_driver_sql("pragma busy_timeout").scalar() == 1234
+                )
+    finally:
+        database.close()
+
+
+def test_queries_bind_quoted_values(database):
+    url = "https://example.org/search?q=o'sullivan"
+    database.write_log("test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, url)
+    database.flush_log()
+    assert database.check_log(DBAction.PAGE_PROCESS, url)
+    assert not database.check_log(DBAction.PAGE_PROCESS, "' or 1=1 --")
+
+
+def test_iter_table_chunks_bounds_the_chunk_size(database):
+    save_images(
+        database,
+        [
+            ("test", str(i), f"https://example.org/{i}.tif", medium)
+            for i, medium in enumerate(["cyanotype", "albumen", "cyanotype"] * 3)
+        ],
+    )
+    chunks = list(database.iter_table_chunks("images", ["id", "medium"], 4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 1]
+    assert list(pd.concat(chunks)["id"]) == [str(i) for i in range(9)]
+    assert [id for _, id, _ in database.iter_images(chunk_size=2)] == [
+        str(i) for i in range(9)
+    ]
+    assert sorted(database.iter_all_mediums_count(chunk_size=1)) == [
+        ("albumen", 3),
+        ("cyanotype", 6),
+    ]
+
+
+def test_export_table_writes_one_header(database, tmp_path):
+    save_images(
+        database,
+        [
+            ("test", str(i), f"https://example.org/{i}.tif", "cyanotype")
+            for i in range(5)
+        ],
+    )
+    path = str(tmp_path / "images.csv")
+    database.export_table("images", path, ["source", "id"], chunk_size=2)
+    exported = pd.read_csv(path, dtype=str)
+    assert list(exported.columns) == ["source", "id"]
+    assert list(exported["id"]) == [str(i) for i in range(5)]
+
+
+def test_save_data_chunks_replaces_rows_in_one_transaction(database):
+    save_images(database, [("test", "0", "https://example.org/0.tif", "cyanotype")])
+    chunks = (
+        pd.DataFrame(
+            [("test", str(i), f"https://example.org/{i}.tif", "albumen")],
+            columns=["source", "id", "url", "medium"],
+        )
+        for i in range(1, 4)
+    )
+    database.save_data_chunks(chunks, "images", if_exists="replace")
+    assert [id for _, id, _ in database.iter_images()] == ["1", "2", "3"]
+
+    def failing_chunks():
+        yield pd.DataFrame(
+            [("test", "4", "https://example.org/4.tif", "albumen")],
+            columns=["source", "id", "url", "medium"],
+        )
+        raise IOError("Interrupted")
+
+    with pytest.raises(IOError):
+        database.save_data_chunks(failing_chunks(), "images", if_exists="replace")
+    assert [id for _, id, _ in database.iter_images()] == ["1", "2", "3"]
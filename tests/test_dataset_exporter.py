@@ -0,0 +1,81 @@
+import csv
+import os
+import pandas as pd
+from ppi.dataset_exporter import DatasetExporter, read_shards
+
+"""Tests of the sharded dataset export"""
+
+
+def add_crops(config, database, medium: str, ids: list) -> None:
+    crop_dir = os.path.join(config["dir"]["crop"], medium)
+    os.makedirs(crop_dir, exist_ok=True)
+    for id in ids:
+        with open(os.path.join(crop_dir, f"test_{id}.jpg"), "wb") as file:
+            file.write(f"{medium} {id}".encode())
+    database.save_data(
+        pd.DataFrame(
+            [("test", id, medium) for id in ids],
+            columns=["source", "id", "new_medium"],
+        ),
+        "mediums",
+    )
+
+
+def exporter_for(
+    config, database, tmp_path, clusters: dict = None, shard_size_mb: int = 256
+):
+    config["dir"]["crop"] = str(tmp_path / "CROP")
+    config["dataset"] = {"val_fraction": 0.5, "shard_size_mb": shard_size_mb}
+    add_crops(config, database, "CYANOTYPE", [f"c{i}" for i in range(20)])
+    add_crops(config, database, "SALTED_PAPER_PRINT", [f"s{i}" for i in range(8)])
+    if clusters:
+        database.save_data(
+            pd.DataFrame(
+                [("test", id, cluster) for id, cluster in clusters.items()],
+                columns=["source", "id", "cluster"],
+            ),
+            "image_hashes",
+        )
+    return DatasetExporter(config, database)
+
+
+def test_split_is_class_balanced_and_deterministic(config, database, tmp_path):
+    exporter = exporter_for(config, database, tmp_path)
+    train, val = exporter.split()
+    assert [sum(label == i for *_, label, _ in val) for i in range(2)] == [4, 4]
+    assert len(train) == 20
+    assert exporter.split() == (train, val)
+    config["dataset"]["seed"] = 2
+    assert DatasetExporter(config, database).split()[1] != val
+
+
+def test_near_duplicates_do_not_straddle_the_split(config, database, tmp_path):
+    clusters = {f"c{i}": "cluster" for i in range(10)}
+    exporter = exporter_for(config, database, tmp_path, clusters)
+    train, val = exporter.split()
+    val_ids = {id for _, _, id, _, _ in val}
+    train_ids = {id for _, _, id, _, _ in train}
+    assert set(clusters) <= val_ids or not set(clusters) & val_ids
+    assert not val_ids & train_ids
+    assert len(val_ids | train_ids) == 28
+
+
+def test_export_writes_readable_shards(config, database, tmp_path):
+    # Each shard is closed once it holds a sample
+    exporter = exporter_for(config, database, tmp_path, shard_size_mb=0)
+    output_dir = str(tmp_path / "DATASET")
+    manifest = exporter.export(output_dir)
+    assert manifest["splits"]["val"]["class_counts"] == [4, 4]
+    assert len(manifest["splits"]["train"]["shards"]) == 20
+    paths = [
+        os.path.join(output_dir, shard) for shard in manifest["splits"]["val"]["shards"]
+    ]
+    samples = list(read_shards(paths))
+    assert sorted(label for _, label in samples) == [0] * 4 + [1] * 4
+    with open(os.path.join(output_dir, "val.index.csv"), newline="") as file:
+        for row in csv.DictReader(file):
+            with open(os.path.join(output_dir, row["shard"]), "rb") as shard:
+                shard.seek(int(row["offset"]))
+                data = shard.read(int(row["size"]))
+            medium = "CYANOTYPE" if row["label"] == "0" else "SALTED_PAPER_PRINT"
+            assert data == f"{medium} {row['id']}".encode()
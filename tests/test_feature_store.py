@@ -0,0 +1,74 @@
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tensorflow import keras
+from ppi.dataset_exporter import DatasetExporter
+from ppi.feature_store import FeatureStore
+
+"""Tests of the backbone feature store"""
+
+
+MEDIUMS = {"c0": "CYANOTYPE", "c1": "CYANOTYPE"}
+MEDIUMS.update({"s0": "SALTED_PAPER_PRINT", "s1": "SALTED_PAPER_PRINT"})
+
+COLORS = {"c0": (255, 0, 0), "c1": (0, 255, 0), "s0": (0, 0, 255), "s1": (255, 255, 0)}
+
+
+def save_crop(config, id: str, color: tuple) -> None:
+    crop_dir = os.path.join(config["dir"]["crop"], MEDIUMS[id])
+    os.makedirs(crop_dir, exist_ok=True)
+    Image.new("RGB", (80, 100), color).save(os.path.join(crop_dir, f"test_{id}.png"))
+
+
+def feature_store_for(config, database, tmp_path) -> FeatureStore:
+    config["dir"]["crop"] = str(tmp_path / "CROP")
+    config["dir"]["features"] = str(tmp_path / "FEATURES")
+    # One training and one validation image per class
+    config["dataset"] = {"val_fraction": 0.5}
+    config["features"] = {
+        "image_size": 64,
+        "crop_size": 32,
+        "random_crops": 2,
+        "batch_size": 3,
+    }
+    for id, color in COLORS.items():
+        save_crop(config, id, color)
+    database.save_data(
+        pd.DataFrame(
+            [("test", id, medium) for id, medium in MEDIUMS.items()],
+            columns=["source", "id", "new_medium"],
+        ),
+        "mediums",
+    )
+    # Solid crops pool to their color
+    inputs = keras.Input(shape=(32, 32, 3))
+    backbone = keras.Model(inputs, keras.layers.GlobalAveragePooling2D()(inputs))
+    return FeatureStore(config, database, backbone=backbone)
+
+
+def test_features_are_computed_once_per_crop(config, database, tmp_path):
+    feature_store = feature_store_for(config, database, tmp_path)
+    # Training images have the center and two random crops, validation images the center
+    assert feature_store.extract(workers=2) == 8
+    assert feature_store.dim == 3
+    assert feature_store.extract(workers=2) == 0
+    train, _ = DatasetExporter(config, database).split()
+    changed = train[0][2]
+    save_crop(config, changed, (0, 0, 0))
+    assert feature_store.extract(workers=2) == 3
+    assert os.path.getsize(feature_store.path) == 11 * 3 * 2
+
+
+def test_load_returns_the_features_of_each_split(config, database, tmp_path):
+    feature_store = feature_store_for(config, database, tmp_path)
+    feature_store.extract(workers=1)
+    train, val = DatasetExporter(config, database).split()
+    for split, samples, crops_per_image in [("train", train, 3), ("val", val, 1)]:
+        features, labels = feature_store.load(split)
+        assert features.dtype == np.float16
+        assert features.shape == (2 * crops_per_image, 3)
+        expected = [
+            (COLORS[id], label) for _, _, id, label, _ in samples
+        ] * crops_per_image
+        assert sorted(zip(map(tuple, np.round(features)), labels)) == sorted(expected)
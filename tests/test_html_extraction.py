@@ -0,0 +1,29 @@
+import re
+from ppi.html_extraction import extract_head, extract_links
+
+"""Tests of the single-pass HTML extraction, on pages of loc.gov"""
+
+
+def test_extract_links_of_search_page(read_fixture):
+    links = extract_links(
+        read_fixture("loc", "search_1.html"),
+        re.compile("^https://www.loc.gov/pictures/item/"),
+    )
+    # Each item is linked from its thumbnail and its title
+    assert len(links) == 12
+    assert links[:2] == [
+        "https://www.loc.gov/pictures/item/2004664403/",
+        "https://www.loc.gov/pictures/item/2006690578/",
+    ]
+
+
+def test_extract_head_of_item_page(read_fixture):
+    meta, links = extract_head(read_fixture("loc", "item_2.html"))
+    assert meta["dc.format"] == ["1 photographic print : cyanotype."]
+    assert [link["href"] for link in links if link.get("type") == "image/tif"] == [
+        "//tile.loc.gov/storage-services/master/pnp/ppmsca/10900/10943u.tif"
+    ]
+    assert {
+        "rel": "canonical",
+        "href": "https://www.loc.gov/pictures/item/2006690578/",
+    } in links
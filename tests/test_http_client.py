@@ -0,0 +1,39 @@
+from ppi.http_client import HttpClient
+
+"""Tests of the shared HTTP client"""
+
+
+def test_sessions_are_shared_per_host(config):
+    client = HttpClient(config)
+    session = client._session("https://www.loc.gov/item/1/")
+    assert client._session("https://www.loc.gov/item/2/") is session
+    assert client._session("https://tile.loc.gov/1.jpg") is not session
+    assert "gzip" in session.headers["Accept-Encoding"]
+    assert session.headers["User-Agent"].startswith("ppi")
+    client.close()
+    assert client._sessions == {}
+
+
+def test_throttled_requests_are_retried(config, http_server):
+    base_url, site = http_server
+    site.add_page("/item/1/", "page")
+    site.errors["/item/1/"] = [429, 503]
+    config["rate_limits"]["default"]["backoff_delay"] = 0.01
+    client = HttpClient(config)
+    response = client.get(f"{base_url}/item/1/")
+    assert response.status_code == 200
+    assert response.text == "page"
+    assert site.requests == ["/item/1/"] * 3
+    client.close()
+
+
+def test_throttled_retries_are_bounded(config, http_server):
+    base_url, site = http_server
+    site.add_page("/item/1/", "page")
+    site.errors["/item/1/"] = [429] * 5
+    config["rate_limits"]["default"]["backoff_delay"] = 0.01
+    config["http"]["max_throttled_retries"] = 2
+    client = HttpClient(config)
+    assert client.get(f"{base_url}/item/1/").status_code == 429
+    assert len(site.requests) == 3
+    client.close()
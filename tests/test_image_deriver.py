@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pandas as pd
+from PIL import Image
+from ppi.image_deriver import ImageDeriver, derive_image, to_rgb
+
+"""Tests of the derivation of resized training images"""
+
+
+def test_derive_image_resizes_the_largest_frame(tmp_path):
+    file_path = str(tmp_path / "scan.tif")
+    Image.new("RGB", (300, 200), "blue").save(
+        file_path, save_all=True, append_images=[Image.new("RGB", (3000, 2000), "red")]
+    )
+    path, thumbnail_path = str(tmp_path / "crop.jpg"), str(tmp_path / "thumb.jpg")
+    derivative = derive_image(file_path, path, thumbnail_path, 1000, 256, "JPEG", 90)
+    assert (derivative["width"], derivative["height"]) == (1500, 1000)
+    with Image.open(path) as image:
+        assert image.size == (1500, 1000)
+        assert image.getpixel((750, 500))[0] > 200
+    with Image.open(thumbnail_path) as image:
+        assert image.size == (256, 171)
+
+
+def test_derive_image_does_not_upscale(tmp_path):
+    file_path = str(tmp_path / "small.png")
+    Image.new("L", (400, 600)).save(file_path)
+    path = str(tmp_path / "crop.jpg")
+    derivative = derive_image(
+        file_path, path, str(tmp_path / "thumb.jpg"), 1000, 256, "JPEG", 90
+    )
+    assert (derivative["width"], derivative["height"]) == (400, 600)
+
+
+def test_to_rgb_scales_16_bit_images():
+    image = Image.fromarray(np.array([[0, 32768, 65535]], dtype=np.uint16))
+    rgb = to_rgb(image)
+    assert [rgb.getpixel((x, 0)) for x in range(3)] == [
+        (0, 0, 0),
+        (128, 128, 128),
+        (255, 255, 255),
+    ]
+
+
+def test_derive_images_skips_up_to_date_derivatives(config, database, tmp_path):
+    config["dir"]["crop"] = str(tmp_path / "CROP")
+    config["dir"]["thumbnail"] = str(tmp_path / "THUMBNAIL")
+    file_path = str(tmp_path / "LibraryOfCongressCrawler_1.jpg")
+    Image.new("RGB", (2000, 1500), "white").save(file_path)
+    database.save_data(
+        pd.DataFrame(
+            [("LibraryOfCongressCrawler", "1", "https://example.org/1.jpg", "c")],
+            columns=["source", "id", "url", "medium"],
+        ),
+        "images",
+    )
+    database.save_data(
+        pd.DataFrame(
+            [("LibraryOfCongressCrawler", "1", "CYANOTYPE")],
+            columns=["source", "id", "new_medium"],
+        ),
+        "mediums",
+    )
+    database.save_image_file(
+        "LibraryOfCongressCrawler", "1", "abc", 1, file_path, file_path
+    )
+    image_deriver = ImageDeriver(config, database)
+    assert image_deriver.derive_images(workers=1) == 1
+    assert os.path.exists(
+        tmp_path / "CROP" / "CYANOTYPE" / "LibraryOfCongressCrawler_1.jpg"
+    )
+    assert image_deriver.derive_images(workers=1) == 0
+    assert image_deriver.derive_images(workers=1, force=True) == 1
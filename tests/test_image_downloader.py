@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import re
+import pytest
+from ppi.image_downloader import ImageDownloader
+
+"""Tests of the streamed, resumable downloads of ImageDownloader"""
+
+
+IMAGE = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 4
+
+
+class FakeStreamResponse:
+    def __init__(self, status_code: int, headers: dict, body: bytes) -> None:
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def __enter__(self) -> "FakeStreamResponse":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def raise_for_status(self) -> None:
+        assert self.status_code < 400
+
+    def iter_content(self, chunk_size: int):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start : start + chunk_size]
+
+
+class FakeImageServer:
+    """Serves an image, answering `Range` requests like a server that never sends 416."""
+
+    def __init__(
+        self,
+        body: bytes,
+        content_type: str = "image/jpeg",
+        extra: bytes = b"",
+        etag: str = None,
+    ) -> None:
+        self.body = body
+        self.content_type = content_type
+        self.extra = extra
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url: str, headers: dict = None, stream: bool = False, **kwargs):
+        self.requests.append(headers)
+        headers = headers or {}
+        range_match = re.match(r"bytes=([0-9]+)-", headers.get("Range", ""))
+        start = int(range_match.group(1)) if range_match else 0
+        if "If-Range" in headers and headers["If-Range"] != self.etag:
+            start = 0
+        if start:
+            # Out of range requests get the last byte instead of a 416
+            start = min(start, len(self.body) - 1)
+            return FakeStreamResponse(
+                206,
+                {
+                    "Content-Type": self.content_type,
+                    "Content-Length": str(len(self.body) - start),
+                    "Content-Range": f"bytes {start}-{len(self.body) - 1}/{len(self.body)}",
+                },
+                self.body[start:],
+            )
+        return FakeStreamResponse(
+            200,
+            {"Content-Type": self.content_type, "Content-Length": str(len(self.body))},
+            self.body + self.extra,
+        )
+
+
+def write_part(path: str, data: bytes, url: str, etag: str = None) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".part", "wb") as file:
+        file.write(data)
+    with open(path + ".part.json", "w") as file:
+        json.dump({"url": url, "etag": etag, "last_modified": None}, file)
+
+
+@pytest.mark.parametrize(
+    "url, content_type, extension",
+    [
+        ("https://example.org/a/1.jpeg", "image/jpeg", ".jpg"),
+        ("https://example.org/a/1.tif", "image/tiff; charset=binary", ".tif"),
+        ("https://example.org/a/1", "image/png", ".png"),
+        ("https://example.org/a/1.jpg", "application/octet-stream", ".jpg"),
+        ("https://example.org/a/1.tif", "text/html; charset=utf-8", ".tif"),
+        ("https://example.org/a/1.jpg", None, ".jpg"),
+    ],
+)
+def test_extension_trusts_image_content_types_only(
+    config, database, url, content_type, extension
+):
+    downloader = ImageDownloader(config, database, http_client=FakeImageServer(b""))
+    assert downloader._extension(url, content_type) == extension
+
+
+def test_download_resumes_part_file(config, database, tmp_path):
+    server = FakeImageServer(IMAGE)
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    write_part(path, IMAGE[:100], "https://example.org/1.jpg")
+    file_path, sha256 = downloader._download_url("https://example.org/1.jpg", path)
+    assert server.requests == [{"Range": "bytes=100-"}]
+    with open(file_path, "rb") as file:
+        assert file.read() == IMAGE
+    assert sha256 == hashlib.sha256(IMAGE).hexdigest()
+    assert os.listdir(tmp_path / "images") == ["LibraryOfCongressCrawler_1.jpg"]
+
+
+def test_download_discards_part_file_of_another_url(config, database, tmp_path):
+    server = FakeImageServer(IMAGE)
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    write_part(path, b"\0" * 100, "https://example.org/old.jpg")
+    file_path, sha256 = downloader._download_url("https://example.org/1.jpg", path)
+    assert server.requests == [None]
+    assert sha256 == hashlib.sha256(IMAGE).hexdigest()
+
+
+def test_download_discards_part_file_without_source(config, database, tmp_path):
+    server = FakeImageServer(IMAGE)
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    os.makedirs(os.path.dirname(path))
+    with open(path + ".part", "wb") as file:
+        file.write(b"\0" * 100)
+    file_path, sha256 = downloader._download_url("https://example.org/1.jpg", path)
+    assert server.requests == [None]
+    assert sha256 == hashlib.sha256(IMAGE).hexdigest()
+
+
+@pytest.mark.parametrize("etag", ['"v1"', '"v2"'])
+def test_download_resumes_with_if_range(config, database, tmp_path, etag):
+    server = FakeImageServer(IMAGE, etag='"v2"')
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    write_part(path, IMAGE[:100], "https://example.org/1.jpg", etag=etag)
+    file_path, sha256 = downloader._download_url("https://example.org/1.jpg", path)
+    assert server.requests == [{"Range": "bytes=100-", "If-Range": etag}]
+    with open(file_path, "rb") as file:
+        assert file.read() == IMAGE
+    assert sha256 == hashlib.sha256(IMAGE).hexdigest()
+
+
+def test_download_restarts_part_file_larger_than_image(config, database, tmp_path):
+    server = FakeImageServer(IMAGE)
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    write_part(path, b"\0" * (len(IMAGE) + 10), "https://example.org/1.jpg")
+    file_path, sha256 = downloader._download_url("https://example.org/1.jpg", path)
+    assert server.requests == [{"Range": f"bytes={len(IMAGE) + 10}-"}, None]
+    assert file_path == path + ".jpg"
+    assert os.path.getsize(file_path) == len(IMAGE)
+    assert sha256 == hashlib.sha256(IMAGE).hexdigest()
+
+
+def test_download_discards_body_larger_than_content_length(config, database, tmp_path):
+    server = FakeImageServer(IMAGE, extra=b"trailing")
+    downloader = ImageDownloader(config, database, http_client=server)
+    path = str(tmp_path / "images" / "LibraryOfCongressCrawler_1")
+    os.makedirs(os.path.dirname(path))
+    with pytest.raises(IOError):
+        downloader._download_url("https://example.org/1.jpg", path)
+    assert os.listdir(tmp_path / "images") == []
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import pandas as pd
+import pytest
+from ppi.database import DBAction, DBActionStatus
+from ppi.image_metadata_crawler import LibraryOfCongressCrawler
+
+"""Tests of the image metadata crawlers, against pages served locally"""
+
+
+ITEM_PAGE = """<html><head>
+<meta name="dc.format" content="1 photographic print : cyanotype.">
+<link rel="alternate" type="image/jpeg" href="//tile.loc.gov/storage-services/service/pnp/test/{id}v.jpg">
+<link rel="alternate" type="image/tif" href="//tile.loc.gov/storage-services/master/pnp/test/{id}u.tif">
+</head><body><h1>Item {id}</h1></body></html>"""
+
+
+def add_search_pages(site, item_base: str, pages: dict) -> None:
+    """Serves search pages linking to the given item IDs, and the item pages."""
+    for page, ids in pages.items():
+        links = "".join(
+            f'<a href="{item_base}/pictures/item/{id}/">{id}</a>' for id in ids
+        )
+        site.add_page(
+            f"/pictures/search/?q=cyanotype&sp={page}",
+            f"<html><body><h1>Results</h1>{links}</body></html>",
+        )
+        for id in ids:
+            site.add_page(f"/pictures/item/{id}/", ITEM_PAGE.format(id=id))
+
+
+def crawler_for(config, database, item_base: str) -> LibraryOfCongressCrawler:
+    return LibraryOfCongressCrawler(
+        config, database, regex_for_image_links=f"^{item_base}/pictures/item/"
+    )
+
+
+def stored_ids(database) -> list:
+    return sorted(
+        id
+        for chunk in database.iter_table_chunks("images", ["id"])
+        for id in chunk["id"]
+    )
+
+
+def item_requests(site) -> list:
+    return [path for path in site.requests if path.startswith("/pictures/item/")]
+
+
+def test_async_crawl_stores_each_item_once(config, database, http_server):
+    base, site = http_server
+    add_search_pages(
+        site, base, {1: ["101", "102", "103"], 2: ["104", "101"], 3: ["105"]}
+    )
+    crawler = crawler_for(config, database, base)
+    asyncio.run(
+        crawler.save_pages_img_url_metadata_async(
+            f"{base}/pictures/search/?q=cyanotype&sp=", 1, 3
+        )
+    )
+    assert stored_ids(database) == ["101", "102", "103", "104", "105"]
+    assert sorted(item_requests(site)) == [
+        f"/pictures/item/{id}/" for id in ["101", "102", "103", "104", "105"]
+    ]
+    assert database.count_log([DBAction.PAGE_PROCESS]) == 3
+    assert database.count_log([DBAction.IMAGE_PROCESS]) == 5
+    images = pd.concat(database.iter_table_chunks("images"))
+    assert set(images["medium"]) == {"CYANOTYPE"}
+    assert set(images["url"]) == {
+        f"https://tile.loc.gov/storage-services/master/pnp/test/{id}u.tif"
+        for id in ["101", "102", "103", "104", "105"]
+    }
+
+
+def test_async_crawl_skips_logged_pages_and_images(config, database, http_server):
+    base, site = http_server
+    add_search_pages(site, base, {1: ["101", "102"], 2: ["103"]})
+    prefix = f"{base}/pictures/search/?q=cyanotype&sp="
+    database.write_log(
+        "LibraryOfCongressCrawler",
+        DBAction.IMAGE_PROCESS,
+        DBActionStatus.SUCCESS,
+        f"{base}/pictures/item/102/",
+    )
+    database.write_log(
+        "LibraryOfCongressCrawler",
+        DBAction.PAGE_PROCESS,
+        DBActionStatus.SUCCESS,
+        prefix + "2",
+    )
+    crawler = crawler_for(config, database, base)
+    asyncio.run(crawler.save_pages_img_url_metadata_async(prefix, 1, 2))
+    assert site.requests == [
+        "/pictures/search/?q=cyanotype&sp=1",
+        "/pictures/item/101/",
+    ]
+    assert stored_ids(database) == ["101"]
+
+    # A second crawl, with a new index loaded from the log, fetches nothing
+    site.requests.clear()
+    crawler = crawler_for(config, database, base)
+    asyncio.run(crawler.save_pages_img_url_metadata_async(prefix, 1, 2))
+    assert site.requests == []
+    assert stored_ids(database) == ["101"]
+
+
+def test_async_crawl_bounds_concurrency_per_host(config, database, http_server):
+    base, site = http_server
+    port = base.rsplit(":", 1)[1]
+    # Search pages are served through a second host name of the same server
+    search_base = f"http://127.0.0.1:{port}"
+    add_search_pages(
+        site,
+        base,
+        {page: [str(page * 100 + i) for i in range(6)] for page in range(1, 5)},
+    )
+    site.delay = 0.05
+    crawler = crawler_for(config, database, base)
+    asyncio.run(
+        crawler.save_pages_img_url_metadata_async(
+            f"{search_base}/pictures/search/?q=cyanotype&sp=",
+            1,
+            4,
+            concurrency_per_host=2,
+        )
+    )
+    assert len(stored_ids(database)) == 24
+    assert site.max_in_flight == {f"127.0.0.1:{port}": 2, f"localhost:{port}": 2}
+
+
+def json_results(read_fixture) -> list:
+    return json.loads(read_fixture("loc", "search_json_1.json"))["results"]
+
+
+def test_json_result_id(read_fixture):
+    assert [
+        LibraryOfCongressCrawler._json_result_id(result)
+        for result in json_results(read_fixture)
+    ] == ["2004664403", "2006690578", "2002719284"]
+
+
+def test_json_result_id_without_id():
+    with pytest.raises(ValueError):
+        LibraryOfCongressCrawler._json_result_id({"id": "http://www.loc.gov/item/"})
+
+
+def test_json_image_link(read_fixture):
+    assert [
+        LibraryOfCongressCrawler._json_image_link(result)
+        for result in json_results(read_fixture)
+    ] == [
+        # The largest JPEG derivative, as no TIFF is linked
+        "https://tile.loc.gov/storage-services/service/pnp/cwpb/04300/04337v.jpg",
+        "https://tile.loc.gov/storage-services/master/pnp/ppmsca/10900/10943u.tif",
+        "https://cdn.loc.gov/service/pnp/cph/3c00000/3c00100/3c00123r.jpg",
+    ]
+
+
+def test_json_image_link_without_image():
+    with pytest.raises(ValueError):
+        LibraryOfCongressCrawler._json_image_link({"pk": "1", "title": "No image"})
+
+
+def test_json_medium(read_fixture):
+    assert [
+        LibraryOfCongressCrawler._json_medium(result)
+        for result in json_results(read_fixture)
+    ] == [
+        "1 photographic print : salted paper.",
+        "1 photographic print : cyanotype.",
+        "1 photographic print : albumen.",
+    ]
+    assert LibraryOfCongressCrawler._json_medium({"item": {}}) == ""
+
+
+def test_json_mode_paginates_until_no_results(
+    config, database, http_server, read_fixture
+):
+    base, site = http_server
+    prefix = f"{base}/pictures/search/?q=ferns&sp="
+    site.add_page(
+        "/pictures/search/?q=ferns&sp=1&fo=json&c=3",
+        read_fixture("loc", "search_json_1.json"),
+        "application/json",
+    )
+    site.add_page(
+        "/pictures/search/?q=ferns&sp=2&fo=json&c=3",
+        json.dumps({"results": []}),
+        "application/json",
+    )
+    crawler = LibraryOfCongressCrawler(config, database)
+    crawler.save_pages_json_metadata(prefix, 1, 5, page_size=3)
+    assert site.requests == [
+        "/pictures/search/?q=ferns&sp=1&fo=json&c=3",
+        "/pictures/search/?q=ferns&sp=2&fo=json&c=3",
+    ]
+    images = pd.concat(database.iter_table_chunks("images"))
+    assert list(images["id"]) == ["2004664403", "2006690578", "2002719284"]
+    assert list(images["medium"]) == [
+        "1 photographic print : salted paper.",
+        "1 photographic print : cyanotype.",
+        "1 photographic print : albumen.",
+    ]
+    assert {url for _, url in database.iter_log([DBAction.IMAGE_PROCESS])} == {
+        f"https://www.loc.gov/pictures/item/{id}/"
+        for id in ["2004664403", "2006690578", "2002719284"]
+    }
+    variants = database.get_variants([("LibraryOfCongressCrawler", "2004664403")])
+    sizes = {
+        variant["url"]: (variant["width"], variant["height"])
+        for variant in variants[("LibraryOfCongressCrawler", "2004664403")]
+        if variant["kind"] == "file"
+    }
+    storage = "https://tile.loc.gov/storage-services/service/pnp/cwpb/04300/"
+    assert sizes == {
+        storage + "04337r.jpg": (640, 474),
+        storage + "04337v.jpg": (1024, 758),
+    }
+
+    # Logged pages are skipped, and pages are read until a page has no results
+    site.requests.clear()
+    crawler = LibraryOfCongressCrawler(config, database)
+    crawler.save_pages_json_metadata(prefix, 1, 5, page_size=3)
+    assert site.requests == ["/pictures/search/?q=ferns&sp=2&fo=json&c=3"]
+
+
+def test_reparse_replays_logged_pages_from_the_cache(
+    config, database, http_server, tmp_path
+):
+    base, site = http_server
+    add_search_pages(site, base, {1: ["101", "102"], 2: ["102", "103"]})
+    prefix = f"{base}/pictures/search/?q=cyanotype&sp="
+    config["http"]["cache_dir"] = str(tmp_path / "HTTP_CACHE")
+    crawler_for(config, database, base).save_pages_img_url_metadata(prefix, 1, 2)
+    with database.engine.begin() as connection:
+        connection.exec_driver_sql("update images set medium = 'outdated'")
+
+    # Without the server, and without reparse, logged pages are skipped
+    site.pages.clear()
+    site.requests.clear()
+    config["http"]["cache_mode"] = "replay"
+    crawler_for(config, database, base).save_pages_img_url_metadata(prefix, 1, 2)
+    images = pd.concat(database.iter_table_chunks("images"))
+    assert set(images["medium"]) == {"outdated"}
+
+    crawler_for(config, database, base).save_pages_img_url_metadata(
+        prefix, 1, 2, reparse=True
+    )
+    assert site.requests == []
+    images = pd.concat(database.iter_table_chunks("images"))
+    assert list(images["id"]) == ["101", "102", "103"]
+    assert set(images["medium"]) == {"CYANOTYPE"}
+    variants = pd.concat(database.iter_table_chunks("image_variants"))
+    assert len(variants) == len(variants.drop_duplicates())
+    # Each image is parsed once per crawl, even if linked from several pages
+    assert database.count_log([DBAction.IMAGE_PROCESS]) == 6
+
+
+def test_reparse_replaces_the_registered_url_index(config, database, http_server):
+    base, site = http_server
+    add_search_pages(site, base, {1: ["101"]})
+    prefix = f"{base}/pictures/search/?q=cyanotype&sp="
+    crawler = crawler_for(config, database, base)
+    for reparse in [False, True, True, False]:
+        crawler.save_pages_img_url_metadata(prefix, 1, 1, reparse=reparse)
+        assert database.url_indexes == [crawler.url_index]
+        assert crawler.url_index.ignore_log == reparse
+    # The last crawl loaded the log again, so it fetched nothing
+    assert site.requests.count("/pictures/item/101/") == 3
@@ -0,0 +1,71 @@
+import os
+import threading
+import pandas as pd
+import pytest
+from ppi.image_store import ImageStore, file_sha256
+
+"""Tests of the content-addressed image store"""
+
+
+def write_file(path: str, data: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(data)
+    return path
+
+
+def test_concurrent_links_to_the_same_path(config, database, tmp_path):
+    image_store = ImageStore(config, database)
+    source_path = write_file(str(tmp_path / "blob.jpg"), b"image")
+    destination_path = str(tmp_path / "links" / "image.jpg")
+    errors = []
+
+    def link() -> None:
+        try:
+            for _ in range(50):
+                image_store.link(source_path, destination_path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=link) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path / "links") == ["image.jpg"]
+    assert os.path.samefile(source_path, destination_path)
+
+
+def test_failed_link_leaves_no_temp_file(config, database, tmp_path):
+    image_store = ImageStore(config, database)
+    links_dir = tmp_path / "links"
+    with pytest.raises(OSError):
+        image_store.link(str(tmp_path / "missing.jpg"), str(links_dir / "image.jpg"))
+    assert os.listdir(links_dir) == []
+
+
+def test_import_downloads(config, database):
+    medium_dir = os.path.join(config["dir"]["download"], "CYANOTYPE")
+    database.save_data(
+        pd.DataFrame(
+            [
+                ("LibraryOfCongressCrawler", "1", "https://example.org/1.tif", None),
+                ("LibraryOfCongressCrawler", "2", "https://example.org/2.tif", None),
+            ],
+            columns=["source", "id", "url", "medium"],
+        ),
+        "images",
+    )
+    first = write_file(os.path.join(medium_dir, "LibraryOfCongressCrawler_1.jpg"), b"1")
+    second = write_file(
+        os.path.join(medium_dir, "LibraryOfCongressCrawler_2.jpg"), b"2"
+    )
+    write_file(os.path.join(medium_dir, "LibraryOfCongressCrawler_3.part"), b"3")
+    image_store = ImageStore(config, database)
+    assert image_store.import_downloads() == 2
+    assert database.get_stored_file_paths() == {first, second}
+    blob_path = image_store.blob_path(file_sha256(first).hexdigest(), ".jpg")
+    assert os.path.samefile(first, blob_path)
+    assert image_store.import_downloads() == 0
+    assert image_store.backup() == 2
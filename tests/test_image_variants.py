@@ -0,0 +1,113 @@
+import requests
+from ppi.image_downloader import ImageDownloader
+from ppi.image_metadata_crawler import LibraryOfCongressCrawler
+
+"""Tests of the size variants recorded by the crawler and selected by the downloader"""
+
+
+SOURCE = "LibraryOfCongressCrawler"
+ITEM_URL = "https://www.loc.gov/pictures/item/2004664403/"
+MASTER_URL = "https://tile.loc.gov/storage-services/master/pnp/cwpb/04300/04337u.tif"
+IIIF_PREFIX = "https://tile.loc.gov/image-services/iiif/service:pnp:cwpb:04300:"
+
+
+class FakeResponse:
+    def __init__(self, url: str, status_code: int, data: dict) -> None:
+        self.url = url
+        self.status_code = status_code
+        self.data = data
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} for {self.url}")
+
+    def json(self) -> dict:
+        return self.data
+
+
+class FakeHttpClient:
+    """Answers IIIF `info.json` requests of a 4000x3000 image, except for missing services."""
+
+    def __init__(self, missing: tuple = ()) -> None:
+        self.missing = missing
+        self.urls = []
+
+    def get(self, url: str, **kwargs) -> FakeResponse:
+        self.urls.append(url)
+        if any(url.startswith(service) for service in self.missing):
+            return FakeResponse(url, 404, {})
+        return FakeResponse(
+            url,
+            200,
+            {
+                "@context": "http://iiif.io/api/image/2/context.json",
+                "width": 4000,
+                "height": 3000,
+            },
+        )
+
+
+def parse_item(config, database, read_fixture):
+    crawler = LibraryOfCongressCrawler(config, database)
+    return crawler._parse_img_metadata(ITEM_URL, read_fixture("loc", "item_1.html"))
+
+
+def test_html_variants_map_storage_files_to_iiif(config, database, read_fixture):
+    metadata, variants = parse_item(config, database, read_fixture)
+    assert metadata.loc[0, "id"] == "2004664403"
+    assert metadata.loc[0, "url"] == MASTER_URL
+    assert metadata.loc[0, "medium"] == "1 photographic print : salted paper."
+    assert MASTER_URL in list(variants["url"])
+    assert list(variants[variants["kind"] == "iiif"]["url"]) == [
+        IIIF_PREFIX + "04337u",
+        IIIF_PREFIX + "04337r",
+        IIIF_PREFIX + "04337v",
+    ]
+
+
+def test_select_url_picks_iiif_rendering_from_html_metadata(
+    config, database, read_fixture
+):
+    metadata, variants = parse_item(config, database, read_fixture)
+    database.save_data(variants, "image_variants")
+    image_variants = database.get_variants([(SOURCE, "2004664403")])
+    http_client = FakeHttpClient()
+    downloader = ImageDownloader(config, database, http_client=http_client)
+    url = downloader._select_url(
+        metadata.loc[0, "url"], image_variants[(SOURCE, "2004664403")]
+    )
+    assert url == IIIF_PREFIX + "04337u/full/,1000/0/default.jpg"
+    assert http_client.urls == [IIIF_PREFIX + "04337u/info.json"]
+
+
+def test_select_url_skips_missing_iiif_services(config, database, read_fixture):
+    metadata, variants = parse_item(config, database, read_fixture)
+    http_client = FakeHttpClient(missing=(IIIF_PREFIX + "04337u",))
+    downloader = ImageDownloader(config, database, http_client=http_client)
+    url = downloader._select_url(
+        metadata.loc[0, "url"], variants.to_dict(orient="records")
+    )
+    assert url == IIIF_PREFIX + "04337r/full/,1000/0/default.jpg"
+
+
+def test_select_url_keeps_master_without_target_resolution(
+    config, database, read_fixture
+):
+    del config["download"]["target_resolution"]
+    metadata, variants = parse_item(config, database, read_fixture)
+    downloader = ImageDownloader(config, database, http_client=FakeHttpClient())
+    url = downloader._select_url(
+        metadata.loc[0, "url"], variants.to_dict(orient="records")
+    )
+    assert url == MASTER_URL
+
+
+def test_select_url_falls_back_to_fetchable_master(config, database, read_fixture):
+    metadata, variants = parse_item(config, database, read_fixture)
+    http_client = FakeHttpClient(missing=(IIIF_PREFIX,))
+    downloader = ImageDownloader(config, database, http_client=http_client)
+    url = downloader._select_url(
+        metadata.loc[0, "url"], variants.to_dict(orient="records")
+    )
+    assert len(http_client.urls) == 3
+    assert url == MASTER_URL
@@ -0,0 +1,63 @@
+import pandas as pd
+from ppi.medium_mapper import MediumMapper
+from ppi.medium_rules import MediumRuleEngine
+
+"""Tests of the incremental medium mapping"""
+
+
+RULES = {
+    "rules": [
+        {"medium": "CYANOTYPE", "exact": ["CYANOTYPE"]},
+        {"medium": "SALTED_PAPER_PRINT", "exact": ["SALT PRINT"]},
+    ],
+    "default": "UNDEFINED",
+}
+
+
+def add_images(database, mediums: dict) -> None:
+    database.save_data(
+        pd.DataFrame(
+            [
+                ("test", id, f"https://example.org/{id}.tif", medium)
+                for id, medium in mediums.items()
+            ],
+            columns=["source", "id", "url", "medium"],
+        ),
+        "images",
+    )
+
+
+def mapped_mediums(database) -> dict:
+    return {
+        id: medium
+        for chunk in database.iter_table_chunks("mediums", ["id", "new_medium"])
+        for id, medium in chunk.itertuples(index=False)
+    }
+
+
+def test_update_mediums_maps_new_and_remapped_images_only(config, database):
+    config["medium_rules"] = RULES
+    add_images(database, {"1": "Cyanotype", "2": "salt print", "3": "Albumen print"})
+    mapper = MediumMapper(config, database)
+    mapper.update_mediums()
+    assert mapped_mediums(database) == {
+        "1": "CYANOTYPE",
+        "2": "SALTED_PAPER_PRINT",
+        "3": "UNDEFINED",
+    }
+    assert database.get_meta("mediums_watermark") == "3"
+    add_images(database, {"4": "cyanotype"})
+    mapper.update_mediums()
+    assert mapped_mediums(database)["4"] == "CYANOTYPE"
+    assert database.map_mediums(database.get_last_image_rowid()) == 0
+    mapper.rules = MediumRuleEngine(
+        {
+            **RULES,
+            "rules": RULES["rules"]
+            + [{"medium": "ALBUMEN_PRINT", "exact": ["ALBUMEN PRINT"]}],
+        }
+    )
+    mapper.update_mediums()
+    assert mapped_mediums(database)["3"] == "ALBUMEN_PRINT"
+    assert database.map_mediums(database.get_last_image_rowid()) == 0
+    assert database.map_mediums(database.get_last_image_rowid(), full=True) == 4
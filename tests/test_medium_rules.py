@@ -0,0 +1,67 @@
+import os
+import yaml
+from ppi.medium_rules import MediumRuleEngine
+
+"""Tests of the medium rule engine"""
+
+
+RULES = {
+    "synonyms": {"CYANOTYPES": "CYANOTYPE", "SALT": "SALTED"},
+    "rules": [
+        {"medium": "REMOVE", "regex": "INKJET|LITHOGRAPH"},
+        {"medium": "CYANOTYPE", "exact": ["CYANOTYPE"], "regex": "^CYANOTYPE ON"},
+        {"medium": "SALTED_PAPER_PRINT", "exact": ["SALTED PRINT", "SALTED PAPER"]},
+        {"medium": "LITHOGRAPH", "exact": ["LITHOGRAPH"]},
+    ],
+    "default": "UNDEFINED",
+}
+
+
+def test_exact_descriptions_are_normalized():
+    rules = MediumRuleEngine(RULES)
+    assert rules.propose("Cyanotype.") == "CYANOTYPE"
+    assert rules.propose("  cyanotypes ") == "CYANOTYPE"
+    assert rules.propose("salt  print") == "SALTED_PAPER_PRINT"
+    assert rules.propose("cyanotype print") == "UNDEFINED"
+
+
+def test_regexes_match_anywhere_and_keep_the_rule_order():
+    rules = MediumRuleEngine(RULES)
+    assert rules.propose("Cyanotype on paper") == "CYANOTYPE"
+    assert rules.propose("inkjet print of a cyanotype") == "REMOVE"
+    # The regex of an earlier rule wins over an exact description of a later one
+    assert rules.propose("Lithograph") == "REMOVE"
+
+
+def test_propose_many_keeps_the_order():
+    rules = MediumRuleEngine(RULES)
+    descriptions = ["Cyanotype", "Inkjet", "Cyanotype", "Unknown"]
+    assert rules.propose_many(descriptions) == [
+        "CYANOTYPE",
+        "REMOVE",
+        "CYANOTYPE",
+        "UNDEFINED",
+    ]
+
+
+def test_explain():
+    rules = MediumRuleEngine(RULES)
+    assert rules.explain("Salt print") == {
+        "description": "Salt print",
+        "canonical": "SALTED PRINT",
+        "medium": "SALTED_PAPER_PRINT",
+        "rule": 2,
+        "match": "exact",
+    }
+    assert rules.explain("Cyanotype on silk")["match"] == "regex"
+    assert rules.explain("Daguerreotype")["rule"] is None
+    assert rules.explain("Daguerreotype")["match"] == "default"
+
+
+def test_configured_rules_compile():
+    with open(os.path.join(os.path.dirname(__file__), "..", "config.yaml")) as file:
+        config = yaml.safe_load(file)
+    rules = MediumRuleEngine(config["medium_rules"])
+    assert rules.propose("Cyanotypes") == "CYANOTYPE"
+    assert rules.propose("Albumen silver print printed later") == "ALBUMEN_PRINT"
+    assert rules.propose("Chromogenic print") == "REMOVE"
@@ -0,0 +1,75 @@
+import json
+import os
+import numpy as np
+import pytest
+from ppi.model_export import ModelExporter, dequantize, quantize, read_tfjs_model
+from ppi.model_export import write_tfjs_model
+
+"""Tests of the quantized export of the TensorFlow.js models"""
+
+
+WEIGHTS = np.random.default_rng(1).normal(0, 0.5, (64, 32)).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype", ["uint8", "uint16"])
+def test_quantize_round_trip(dtype):
+    values = np.concatenate([WEIGHTS.ravel(), [0.0]]).astype(np.float32)
+    quantized, quantization = quantize(values, dtype)
+    assert quantized.dtype == np.dtype(dtype)
+    restored = dequantize(quantized, quantization)
+    assert restored.dtype == np.float32
+    assert np.abs(restored - values).max() <= quantization["scale"] / 2 + 1e-6
+    assert restored[-1] == 0
+
+
+def test_quantize_float16_and_constant_weights():
+    quantized, quantization = quantize(WEIGHTS, "float16")
+    assert quantized.dtype == np.float16
+    assert np.allclose(dequantize(quantized, quantization), WEIGHTS, atol=1e-3)
+    constant = np.full(4, 0.25, np.float32)
+    assert (dequantize(*quantize(constant, "uint8")) == constant).all()
+    with pytest.raises(ValueError):
+        quantize(WEIGHTS, "int4")
+
+
+def write_model(model_dir: str) -> None:
+    weights = [
+        ({"name": "dense/kernel", "shape": [64, 32], "dtype": "float32"}, WEIGHTS),
+        (
+            {"name": "embedding/ids", "shape": [3], "dtype": "int32"},
+            np.array([1, 2, 3], np.int32),
+        ),
+    ]
+    write_tfjs_model({"format": "layers-model"}, weights, model_dir, "float32", 4096)
+    with open(os.path.join(model_dir, "class_names.txt"), "w") as file:
+        file.write("CYANOTYPE\nSALTED_PAPER_PRINT\n")
+
+
+def test_sharded_model_round_trip(tmp_path):
+    write_model(str(tmp_path / "tfjs"))
+    model_json, weights = read_tfjs_model(str(tmp_path / "tfjs"))
+    assert model_json["format"] == "layers-model"
+    assert len(model_json["weightsManifest"][0]["paths"]) == 3
+    assert (weights[0][1] == WEIGHTS).all()
+    assert weights[1][1].tolist() == [1, 2, 3]
+
+
+def test_export_writes_each_variant(config, database, tmp_path):
+    write_model(str(tmp_path / "tfjs"))
+    config["model_export"] = {"variants": ["float32", "float16", "uint8"]}
+    variants = ModelExporter(config, database).export(
+        str(tmp_path / "tfjs"), str(tmp_path / "web")
+    )
+    assert [variants[variant]["bytes"] for variant in variants] == [
+        64 * 32 * size + 3 * 4 for size in [4, 2, 1]
+    ]
+    for variant, tolerance in [("float16", 1e-3), ("uint8", 0.02)]:
+        model_dir = str(tmp_path / "web" / variant)
+        assert os.path.exists(os.path.join(model_dir, "class_names.txt"))
+        with open(os.path.join(model_dir, "model.json")) as file:
+            specs = json.load(file)["weightsManifest"][0]["weights"]
+        assert specs[0]["quantization"]["dtype"] == variant
+        assert "quantization" not in specs[1]
+        _, weights = read_tfjs_model(model_dir)
+        assert np.abs(weights[0][1] - WEIGHTS).max() < tolerance
+        assert weights[1][1].tolist() == [1, 2, 3]
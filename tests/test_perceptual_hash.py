@@ -0,0 +1,55 @@
+import random
+import numpy as np
+from PIL import Image
+from ppi.perceptual_hash import BKTree, PerceptualHashIndex, dhash, file_hashes
+from ppi.perceptual_hash import hamming, phash
+
+"""Tests of the perceptual hashes and the near-duplicate index"""
+
+
+def noise_image(seed: int, size: int = 512) -> Image.Image:
+    pixels = np.random.default_rng(seed).integers(0, 256, (16, 16, 3), np.uint8)
+    return Image.fromarray(pixels).resize((size, size), Image.Resampling.BICUBIC)
+
+
+def test_hashes_match_resized_and_recompressed_copies(tmp_path):
+    image = noise_image(1)
+    image.resize((200, 200)).save(tmp_path / "copy.jpg", quality=60)
+    copy_phash, copy_dhash = file_hashes(str(tmp_path / "copy.jpg"))
+    assert hamming(phash(image), copy_phash) <= 8
+    assert hamming(dhash(image), copy_dhash) <= 8
+    other = noise_image(2)
+    assert hamming(phash(image), phash(other)) > 16
+    assert hamming(dhash(image), dhash(other)) > 16
+
+
+def test_bk_tree_search_matches_a_linear_scan():
+    rng = random.Random(1)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    # Near copies of a few values, within a few bits
+    values += [value ^ (1 << rng.randrange(64)) for value in values[:50]]
+    tree = BKTree()
+    for key, value in enumerate(values):
+        tree.add(value, key)
+    assert tree.size == len(values)
+    for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+        expected = sorted(
+            (hamming(query, value), key)
+            for key, value in enumerate(values)
+            if hamming(query, value) <= 12
+        )
+        assert sorted(tree.search(query, 12)) == expected
+
+
+def test_index_clusters_near_duplicates_and_reloads(config, database):
+    index = PerceptualHashIndex(config, database)
+    base = (1 << 63) | 0x0F0F
+    assert index.add("test", "1", base, base) == "test_1"
+    assert index.add("test", "2", base ^ 0b111, base ^ 0b1) == "test_1"
+    # A close pHash is not enough if the dHash differs
+    assert index.add("test", "3", base ^ 0b1, ~base & (2**64 - 1)) == "test_3"
+    assert index.find(base, base, "test", "1") == ("test", "2", "test_1")
+    index.flush()
+    reloaded = PerceptualHashIndex(config, database)
+    assert reloaded.contains("test", "2")
+    assert reloaded.add("test", "4", base, base) == "test_1"
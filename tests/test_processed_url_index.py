@@ -0,0 +1,63 @@
+from ppi.database import DBAction, DBActionStatus
+from ppi.processed_url_index import BloomFilter, ProcessedUrlIndex
+
+"""Tests of the in-memory processed-URL index"""
+
+
+def log_pages(database, urls) -> None:
+    for url in urls:
+        database.write_log("test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, url)
+    database.flush_log()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom_filter = BloomFilter(1000, 0.01)
+    keys = [f"https://example.org/{i}".encode() for i in range(1000)]
+    for key in keys:
+        bloom_filter.add(key)
+    assert all(key in bloom_filter for key in keys)
+    false_positives = sum(
+        f"https://example.org/new/{i}".encode() in bloom_filter for i in range(10000)
+    )
+    assert false_positives < 300
+    assert 0.005 < bloom_filter.false_positive_rate < 0.02
+
+
+def test_exact_index_follows_the_log(database):
+    log_pages(database, ["https://example.org/1"])
+    index = ProcessedUrlIndex(database, [DBAction.PAGE_PROCESS])
+    database.write_log(
+        "test", DBAction.PAGE_PROCESS, DBActionStatus.SUCCESS, "https://example.org/2"
+    )
+    database.write_log(
+        "test", DBAction.DOWNLOAD, DBActionStatus.SUCCESS, "https://example.org/3"
+    )
+    assert index.exact
+    assert index.contains(DBAction.PAGE_PROCESS, "https://example.org/1")
+    assert index.contains(DBAction.PAGE_PROCESS, "https://example.org/2")
+    assert not index.contains(DBAction.DOWNLOAD, "https://example.org/3")
+    assert not index.contains(DBAction.PAGE_PROCESS, "https://example.org/4")
+    assert index.stats()["entries"] == 2
+    assert index.num_database_checks == 0
+
+
+def test_bloom_index_confirms_matches_in_the_log(database):
+    log_pages(database, [f"https://example.org/{i}" for i in range(100)])
+    index = ProcessedUrlIndex(database, [DBAction.PAGE_PROCESS], max_exact_entries=10)
+    assert not index.exact
+    assert index.contains(DBAction.PAGE_PROCESS, "https://example.org/1")
+    assert index.num_database_checks == 1
+    # A key in the filter without a log entry behaves like a false positive
+    index._keys.add(index._key(DBAction.PAGE_PROCESS, "https://example.org/new"))
+    assert not index.contains(DBAction.PAGE_PROCESS, "https://example.org/new")
+    assert index.num_database_checks == 2
+    assert index.num_false_positives == 1
+    assert index.stats()["representation"] == "bloom"
+
+
+def test_index_ignoring_the_log_starts_empty(database):
+    log_pages(database, ["https://example.org/1"])
+    index = ProcessedUrlIndex(database, [DBAction.PAGE_PROCESS], ignore_log=True)
+    assert not index.contains(DBAction.PAGE_PROCESS, "https://example.org/1")
+    log_pages(database, ["https://example.org/1"])
+    assert index.contains(DBAction.PAGE_PROCESS, "https://example.org/1")
@@ -0,0 +1,64 @@
+import email.utils
+import time
+import pytest
+import requests
+from ppi.rate_limiter import DEFAULT_LIMITS, RateLimiter, TokenBucket
+from ppi.rate_limiter import _parse_retry_after
+
+"""Tests of the per-host token-bucket rate limiter"""
+
+
+def response(status_code: int, retry_after: str = None) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers["Retry-After"] = retry_after
+    return response
+
+
+def test_parse_retry_after():
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after("120") == 120.0
+    assert _parse_retry_after("-5") == 0.0
+    assert _parse_retry_after("soon") is None
+    retry_date = email.utils.formatdate(time.time() + 60, usegmt=True)
+    assert 55 < _parse_retry_after(retry_date) <= 60
+
+
+def test_bucket_waits_for_tokens_after_a_burst():
+    bucket = TokenBucket({**DEFAULT_LIMITS, "rate": 20.0, "burst": 2})
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # The burst is free, the two other tokens take 1/20 s each
+    assert 0.08 <= time.monotonic() - start < 1.0
+
+
+def test_bucket_backs_off_exponentially_and_ramps_up():
+    bucket = TokenBucket({**DEFAULT_LIMITS, "rate": 1.0, "max_backoff_delay": 3.0})
+    assert bucket.on_throttled() == 1.0
+    assert bucket.on_throttled() == 2.0
+    assert bucket.on_throttled() == 3.0
+    assert bucket.on_throttled(retry_after=10.0) == 10.0
+    assert bucket.rate == 0.0625
+    bucket.on_throttled()
+    assert bucket.rate == DEFAULT_LIMITS["min_rate"]
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(0.1)
+    assert bucket.on_throttled() == 1.0
+
+
+def test_rate_limiter_pauses_the_throttled_host_only():
+    rate_limiter = RateLimiter(
+        {
+            "default": {"rate": 1000.0, "burst": 1000},
+            "hosts": {"tile.loc.gov": {"backoff_delay": 0.2}},
+        }
+    )
+    assert rate_limiter.update("https://tile.loc.gov/1.jpg", response(429, "0.1"))
+    assert not rate_limiter.update("https://www.loc.gov/1/", response(200))
+    start = time.monotonic()
+    rate_limiter.acquire("https://www.loc.gov/2/")
+    assert time.monotonic() - start < 0.1
+    rate_limiter.acquire("https://tile.loc.gov/2.jpg")
+    assert time.monotonic() - start >= 0.15
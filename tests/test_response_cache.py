@@ -0,0 +1,91 @@
+import os
+import threading
+import pytest
+import requests
+from ppi.http_client import HttpClient
+from ppi.response_cache import CacheMissError, ResponseCache
+
+"""Tests of the on-disk HTTP response cache"""
+
+
+def cached_client(config, tmp_path, mode: str = "revalidate") -> HttpClient:
+    config["http"] = {**config["http"], "cache_dir": str(tmp_path / "cache")}
+    config["http"]["cache_mode"] = mode
+    return HttpClient(config)
+
+
+def test_concurrent_writes_to_the_same_file(tmp_path):
+    path = str(tmp_path / "entries" / "entry.json")
+    errors = []
+
+    def write(data: bytes) -> None:
+        try:
+            for _ in range(50):
+                ResponseCache._write(path, data)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=write, args=(bytes([i]) * 1000,)) for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path / "entries") == ["entry.json"]
+    with open(path, "rb") as file:
+        data = file.read()
+    assert data in [bytes([i]) * 1000 for i in range(4)]
+
+
+def test_store_and_load(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "text/html"
+    response.headers["Content-Length"] = "4"
+    response.headers["ETag"] = '"v1"'
+    response.encoding = "utf-8"
+    response._content = b"page"
+    cache.store("https://www.loc.gov/item/1/", response)
+    entry = cache.lookup("https://www.loc.gov/item/1/")
+    assert cache.conditional_headers(entry) == {"If-None-Match": '"v1"'}
+    loaded = cache.load("https://www.loc.gov/item/1/", entry)
+    assert loaded.status_code == 200
+    assert loaded.text == "page"
+    assert loaded.headers["content-type"] == "text/html"
+    assert "Content-Length" not in loaded.headers
+    assert cache.lookup("https://www.loc.gov/item/2/") is None
+
+
+def test_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        ResponseCache(str(tmp_path), mode="offline")
+
+
+def test_revalidates_cached_responses(config, tmp_path, http_server):
+    base_url, site = http_server
+    site.add_page("/item/1/", "page")
+    site.etags["/item/1/"] = '"v1"'
+    client = cached_client(config, tmp_path)
+    assert client.get(f"{base_url}/item/1/", cache=True).text == "page"
+    response = client.get(f"{base_url}/item/1/", cache=True)
+    assert response.status_code == 200
+    assert response.text == "page"
+    assert site.not_modified == 1
+    client.close()
+
+
+def test_replays_cached_responses_offline(config, tmp_path, http_server):
+    base_url, site = http_server
+    site.add_page("/item/1/", "page")
+    client = cached_client(config, tmp_path)
+    client.get(f"{base_url}/item/1/", cache=True)
+    client.close()
+    client = cached_client(config, tmp_path, mode="replay")
+    assert client.get(f"{base_url}/item/1/", cache=True).text == "page"
+    with pytest.raises(CacheMissError):
+        client.get(f"{base_url}/item/2/", cache=True)
+    assert site.requests == ["/item/1/"]
+    client.close()